@@ -1,26 +1,36 @@
 ﻿# app.py — COEIROINK v2 専用・完全版 + オートモード(感情推定でTTS最適化)
 import os
 import sys
+import asyncio
 import threading
+import queue
+import atexit
 import platform
 import subprocess
 import time
 import uuid
 import json
+import hashlib
 import random
 import math
+import wave
+import zlib
+import unicodedata
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Callable, AsyncIterator, Awaitable, Iterable, Iterator
 
-import requests
-import psutil
-import speech_recognition as sr
-from fastapi import FastAPI, UploadFile, File, Form, Query
+import httpx
+from fastapi import FastAPI, UploadFile, File, Form, Query, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from google import genai
-from pydub import AudioSegment
+from starlette.background import BackgroundTask
 
 # ==========================
 # 基本設定とパス
@@ -30,47 +40,286 @@ FRONT_DIR = BASE_DIR.parent / "frontend"
 OUT_DIR = BASE_DIR.parent / "outputs" / "tts"
 LOG_DIR = BASE_DIR.parent / "outputs"
 LOG_FILE = LOG_DIR / "server.log"
+CHAT_HISTORY_FILE = BASE_DIR.parent / "chat_history.txt"
+CHAT_HISTORY_JSONL_FILE = LOG_DIR / "chat_history.jsonl"
+DIRECTOR_LOG_JSONL_FILE = LOG_DIR / "director.jsonl"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
+
+def _env_flag(name: str, default: bool) -> bool:
+    v = os.getenv(name)
+    if v is None or v == "":
+        return default
+    return v.lower() in {"1", "true", "t", "yes", "y", "on"}
+
+
+# ログ/会話履歴の書き込み（リクエスト処理はキューに積むだけ。書くのは専用スレッド）
+LOG_MAX_BYTES = int(float(os.getenv("LOG_MAX_MB", "10")) * 1024 * 1024)  # 超えたら .1, .2 ... に回す（0 で無効）
+LOG_BACKUPS = max(0, int(os.getenv("LOG_BACKUPS", "3")))
+LOG_FLUSH_SEC = float(os.getenv("LOG_FLUSH_SEC", "0.5"))
+LOG_QUEUE_MAX = max(1, int(os.getenv("LOG_QUEUE_MAX", "10000")))          # 溢れた分は捨てる（応答を待たせない）
+CHAT_HISTORY_JSONL = _env_flag("CHAT_HISTORY_JSONL", False)               # 機械処理用に JSONL でも残す
+DIRECTOR_LOG_JSONL = _env_flag("DIRECTOR_LOG_JSONL", False)               # 音声監督の判断を残す（分類器の学習用）
+
+
+class _LogWriter:
+    """追記専用のバックグラウンドライター。write() は待たずに返り、専用スレッドがまとめて書く。
+
+    ファイルは開いたままにして LOG_FLUSH_SEC ごとに flush し、LOG_MAX_BYTES を超えたら回転する。
+    close() 後（終了処理中）の write() はその場で同期的に書く。
+    """
+
+    def __init__(self, *, max_bytes: int, backups: int, flush_sec: float, queue_max: int):
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_sec = flush_sec
+        self._q: "queue.Queue[Optional[Tuple[Path, str]]]" = queue.Queue(maxsize=queue_max)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, path: Path, text: str) -> None:
+        if self._closed:
+            self._write_now(path, text)
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._q.put_nowait((path, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    @staticmethod
+    def _write_now(path: Path, text: str) -> None:
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(text)
+        except Exception:
+            pass
+
+    def _rotate(self, path: Path) -> None:
+        if self.backups <= 0:
+            path.unlink(missing_ok=True)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = path.with_name(f"{path.name}.{i}")
+            if src.exists():
+                os.replace(src, path.with_name(f"{path.name}.{i + 1}"))
+        os.replace(path, path.with_name(f"{path.name}.1"))
+
+    def _append(self, files: Dict[Path, Any], path: Path, data: str) -> None:
+        f = files.get(path)
+        if f is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = files[path] = open(path, "a", encoding="utf-8")
+        if self.max_bytes > 0 and f.tell() > 0 and f.tell() + len(data.encode("utf-8")) > self.max_bytes:
+            f.close()
+            self._rotate(path)
+            f = files[path] = open(path, "a", encoding="utf-8")
+        f.write(data)
+
+    def _run(self) -> None:
+        files: Dict[Path, Any] = {}
+        last_flush = time.monotonic()
+        stop = False
+        while not stop:
+            batch: List[Tuple[Path, str]] = []
+            try:
+                item = self._q.get(timeout=self.flush_sec)
+                while True:
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                    item = self._q.get_nowait()
+            except queue.Empty:
+                pass
+            grouped: Dict[Path, List[str]] = {}
+            for path, text in batch:
+                grouped.setdefault(path, []).append(text)
+            for path, chunks in grouped.items():
+                try:
+                    self._append(files, path, "".join(chunks))
+                    self.written += len(chunks)
+                except Exception:
+                    files.pop(path, None)
+            if stop or time.monotonic() - last_flush >= self.flush_sec:
+                for f in files.values():
+                    try:
+                        f.flush()
+                    except Exception:
+                        pass
+                last_flush = time.monotonic()
+        for f in files.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+
+    def close(self, timeout: float = 3.0) -> None:
+        """溜まっている分を書き切ってスレッドを止める（shutdown / atexit から呼ぶ）。"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            try:
+                self._q.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+
+    def pending(self) -> int:
+        return self._q.qsize()
+
+
+log_writer = _LogWriter(
+    max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, flush_sec=LOG_FLUSH_SEC, queue_max=LOG_QUEUE_MAX
+)
+
+
 def _log(msg: str):
-    try:
-        LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(msg.rstrip() + "\n")
-    except Exception:
-        pass
+    log_writer.write(LOG_FILE, msg.rstrip() + "\n")
 
 # --------------------------
-# small util: sentence split
+# 文の切り出し（LLM のトークン列 → TTS に渡す単位）
 # --------------------------
-_SENT_END = {"。", "！", "？", ".", "!", "?", "．"}
+_SENT_END = {"。", "！", "？", ".", "!", "?", "．", "\n"}
+_CLAUSE_END = {"、", "，", ",", "；", ";", "：", "…", "‥"}
+_OPEN_BRACKETS = set("「『（(【［[〈《“")
+_CLOSE_BRACKETS = set("」』）)】］]〉》”")
+SEG_MIN_CHARS = int(os.getenv("SEG_MIN_CHARS", "8"))                    # これより短い文（「うん！」など）は次の文とまとめる
+SEG_MAX_CHARS = int(os.getenv("SEG_MAX_CHARS", "80"))                   # 句点が来なくてもこの長さで読点（無ければその場）で切る
+SEG_FIRST_MIN_CHARS = int(os.getenv("SEG_FIRST_MIN_CHARS", "2"))        # 最初の1文だけは短くても出す（最初の音声を早く）
+# 最初の1文は読点でもこの長さで切る（0 で無効。既定は SEG_FIRST_MIN_CHARS と同じ = 最初の区切りで出す）
+SEG_FIRST_CLAUSE_CHARS = int(os.getenv("SEG_FIRST_CLAUSE_CHARS", str(SEG_FIRST_MIN_CHARS)))
+
+
+def _speakable_len(s: str) -> int:
+    """読み上げる文字の数（句読点・括弧・絵文字・空白は数えない）。"""
+    return sum(1 for ch in s if ch.isalnum())
+
 
+class _Segmenter:
+    """トークンを feed() するたびに、TTS に渡せるようになった文を返す。最後に flush() で残りを返す。
 
-def _split_sentences(accum: str) -> Tuple[List[str], str]:
-    """Split accum by Japanese/Latin sentence terminators, keeping the terminator.
-    Returns (complete_sentences, remainder).
+    走査位置を覚えているので、1回の feed() で見るのは新しく来た文字だけ。
+    - 句点で切る。直後に続く ！？・閉じ括弧・絵文字・空白は前の文に付ける（「すごい！？😊」で1文）
+    - 括弧の中の句点では切らない（改行で括弧は閉じたものとみなす）。"3.14" や "1,000" でも切らない
+    - min_chars に満たない文は次の文とまとめる / max_chars を超えたら読点で切る（読点までが min_chars 未満なら次の読点まで延ばす）
+    - 最初の1文だけは first_min_chars で、句点を見た時点で出す。first_clause_chars に達したら読点（括弧の中も）でも切る
     """
-    if not accum:
-        return [], ""
-    out: List[str] = []
-    start = 0
-    for i, ch in enumerate(accum):
-        if ch in _SENT_END:
-            seg = accum[start:i + 1].strip()
-            if seg:
-                out.append(seg)
-            start = i + 1
-    remainder = accum[start:].lstrip()
-    return out, remainder
+
+    def __init__(
+        self,
+        *,
+        min_chars: int = SEG_MIN_CHARS,
+        max_chars: int = SEG_MAX_CHARS,
+        first_min_chars: int = SEG_FIRST_MIN_CHARS,
+        first_clause_chars: int = SEG_FIRST_CLAUSE_CHARS,
+    ):
+        self.min_chars = min_chars
+        self.max_chars = max(1, max_chars)
+        self.first_min_chars = first_min_chars
+        self.first_clause_chars = first_clause_chars
+        self.emitted = 0
+        self._buf = ""
+        self._pos = 0       # 次に見る位置
+        self._start = 0     # まだ返していない部分の先頭
+        self._clause = 0    # 最後の読点の直後（0 なら無し）
+        self._depth = 0     # 括弧の深さ
+        self._tail = False  # 句点の直後（句点に付く記号が続いている間）
+
+    def _cut(self, end: int, out: List[str]) -> None:
+        seg = self._buf[self._start:end].strip()
+        while seg and not seg[0].isalnum() and seg[0] not in _OPEN_BRACKETS:
+            seg = seg[1:]  # 前の文に付けきれなかった ！？・絵文字など
+        self._start = end
+        self._clause = 0
+        if _speakable_len(seg):
+            out.append(seg)
+            self.emitted += 1
+
+    def feed(self, text: str) -> List[str]:
+        out: List[str] = []
+        buf = self._buf = self._buf + text
+        i, n = self._pos, len(buf)
+        while i < n:
+            ch = buf[i]
+            if self._tail:
+                if not ch.isalnum() and ch not in _OPEN_BRACKETS:
+                    if ch in _CLOSE_BRACKETS:
+                        self._depth = max(0, self._depth - 1)
+                    i += 1
+                    continue
+                self._tail = False
+                decimal = ch.isdigit() and i >= 2 and buf[i - 1] == "." and buf[i - 2].isdigit()
+                min_chars = self.first_min_chars if not self.emitted else self.min_chars
+                if not decimal and _speakable_len(buf[self._start:i]) >= min_chars:
+                    self._cut(i, out)
+            if ch in _OPEN_BRACKETS:
+                self._depth += 1
+            elif ch in _CLOSE_BRACKETS:
+                self._depth = max(0, self._depth - 1)
+            elif ch in _SENT_END and (self._depth == 0 or ch == "\n"):
+                self._tail = True
+                self._depth = 0
+                maybe_decimal = ch == "." and i > 0 and buf[i - 1].isdigit()
+                if (
+                    not self.emitted and not maybe_decimal
+                    and _speakable_len(buf[self._start:i + 1]) >= self.first_min_chars
+                ):
+                    # 最初の1文は続く記号を待たずに出す（続きは次の文の頭で捨てる）
+                    self._cut(i + 1, out)
+            elif ch in _CLAUSE_END or ch in _SENT_END:
+                # 括弧の中の句点は読点と同じ扱い。最初の1文だけは括弧が閉じるのを待たずにここで切る
+                if not (ch == "," and i > 0 and buf[i - 1].isdigit()):
+                    self._clause = i + 1
+                    if (
+                        not self.emitted and self.first_clause_chars
+                        and _speakable_len(buf[self._start:i + 1]) >= self.first_clause_chars
+                    ):
+                        self._cut(i + 1, out)
+            i += 1
+            if not self._tail and i - self._start >= self.max_chars:
+                if self._clause <= self._start:
+                    self._cut(i, out)  # 読点が無い: その場で切る
+                elif _speakable_len(buf[self._start:self._clause]) >= self.min_chars:
+                    self._cut(self._clause, out)
+                elif i - self._start >= 2 * self.max_chars:
+                    self._cut(i, out)
+                # 読点までが短すぎる（「それから、」だけ）ときは切らずに次の読点まで延ばす（上限は max_chars の2倍）
+        # 返し終えた部分を捨てて添字を詰める
+        if self._start:
+            self._buf = buf[self._start:]
+            i -= self._start
+            self._clause = max(0, self._clause - self._start)
+            self._start = 0
+        self._pos = i
+        return out
+
+    def flush(self) -> List[str]:
+        """残りを返す。記号や絵文字だけなら合成しても意味がないので捨てる。"""
+        out: List[str] = []
+        self._cut(len(self._buf), out)
+        self._buf, self._pos, self._start, self._clause, self._depth, self._tail = "", 0, 0, 0, 0, False
+        return out
 
 # ==========================
 # 環境変数
 # ==========================
 # Gemini
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise RuntimeError("GEMINI_API_KEY が未設定です")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")  # 未設定でも起動はする（Gemini を使う経路だけが失敗する）
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "").rstrip("/")  # 任意: API の向き先を差し替える（ベンチ用の偽サーバーなど）
 
 # COEIROINK
 COEIROINK_URL = os.getenv("COEIROINK_URL", "http://127.0.0.1:50032").rstrip("/")
@@ -81,11 +330,38 @@ COEIROINK_STYLE_NAME = os.getenv("COEIROINK_STYLE_NAME")
 # 背景LLM（Gemma via Ollama）設定
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434").rstrip("/")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "gemma3:4b")
+# 会話の API: chat（/api/chat に構造化メッセージ。先頭が毎ターン同じなので KV キャッシュが効く）/ generate（従来）
+OLLAMA_CHAT_API = os.getenv("OLLAMA_CHAT_API", "chat").strip().lower()
+if OLLAMA_CHAT_API not in ("chat", "generate"):
+    OLLAMA_CHAT_API = "chat"
+# モデルをメモリに残す時間（"30m" などの期間、秒数、-1 で無期限）
+_keep_alive_raw = os.getenv("OLLAMA_KEEP_ALIVE", "30m").strip()
+OLLAMA_KEEP_ALIVE: Any = int(_keep_alive_raw) if _keep_alive_raw.lstrip("-").isdigit() else _keep_alive_raw
+OLLAMA_WARMUP = _env_flag("OLLAMA_WARMUP", True)  # 起動時にモデルを読み込んでおく
 
 # ==========================
-# Gemini クライアント
+# Gemini クライアント（google-genai の import が重いので最初に使うときに作る）
 # ==========================
-client = genai.Client(api_key=GEMINI_API_KEY)
+_gemini_client: Any = None
+_gemini_client_lock = threading.Lock()
+
+
+def gemini_client() -> Any:
+    global _gemini_client
+    if _gemini_client is None:
+        with _gemini_client_lock:
+            if _gemini_client is None:
+                if not GEMINI_API_KEY:
+                    raise RuntimeError("GEMINI_API_KEY が未設定です")
+                from google import genai
+
+                _gemini_client = genai.Client(
+                    api_key=GEMINI_API_KEY,
+                    http_options={"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None,
+                )
+    return _gemini_client
+
+
 system_instruction = """あなたは私専用の会話パートナーです。
 - 関西弁は禁止
 - 語尾に「〜よ〜」「〜な〜」は禁止
@@ -97,8 +373,6 @@ system_instruction = """あなたは私専用の会話パートナーです。
 - 「あら」は禁止
 - 一人称は「わたし」
 """
-history = [system_instruction]
-
 # 会話履歴は直近10往復（20メッセージ）だけを参照に使う
 HISTORY_TURNS = 10  # 往復数
 
@@ -113,6 +387,778 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("shutdown")
+def _close_log_writer():
+    log_writer.close()
+
+# ==========================
+# 非同期I/Oエンジン（Ollama / COEIROINK は共有の keep-alive プール経由）
+# ==========================
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "32"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "16"))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "8"))        # 1ホストあたりの同時リクエスト数
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+CPU_WORKERS = max(1, int(os.getenv("CPU_WORKERS", "4")))             # 音声の変換・解析や STT などブロッキング処理用
+
+_http_client: Optional[httpx.AsyncClient] = None
+_host_slots: Dict[str, asyncio.Semaphore] = {}
+_CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+
+
+def _http() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(60.0, connect=HTTP_CONNECT_TIMEOUT),
+        )
+    return _http_client
+
+
+def _host_slot(url: str) -> asyncio.Semaphore:
+    host = httpx.URL(url).netloc.decode("ascii", "ignore")
+    sem = _host_slots.get(host)
+    if sem is None:
+        sem = _host_slots[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return sem
+
+
+async def _http_post(url: str, *, timeout: float, **kwargs) -> httpx.Response:
+    async with _host_slot(url):
+        return await _http().post(url, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT), **kwargs)
+
+
+@asynccontextmanager
+async def _http_stream(url: str, *, timeout: float, **kwargs) -> AsyncIterator[httpx.Response]:
+    async with _host_slot(url):
+        async with _http().stream(
+            "POST", url, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT), **kwargs
+        ) as resp:
+            yield resp
+
+
+_background_tasks: "set[asyncio.Task]" = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """参照を保持したままタスクを起動する（途中で GC されないように）。"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _run_blocking(fn: Callable[..., Any], *args: Any) -> Any:
+    """CPUバウンド/ブロッキングな処理をイベントループ外で実行する。"""
+    return await asyncio.get_running_loop().run_in_executor(_CPU_EXECUTOR, fn, *args)
+
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+
+# ==========================
+# メトリクス（/metrics: Prometheus テキスト形式）
+#   summary … 処理段階ごとの所要時間（直近ウィンドウの p50/p95/p99）
+#   counter … キャッシュヒット・フォールバック・エラーなど
+#   gauge   … 各コンポーネントの現在値（collector で出力時に読む）
+# ==========================
+class _LatencyStat:
+    """所要時間（ms）の集計。p50/p95 は直近 window 件から計算する。"""
+
+    def __init__(self, window: int = 256):
+        self._recent: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+
+    def add(self, ms: float, ok: bool = True) -> None:
+        with self._lock:
+            self.count += 1
+            self.total_ms += ms
+            self._recent.append(ms)
+            if not ok:
+                self.errors += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            recent = sorted(self._recent)
+            count, errors, total = self.count, self.errors, self.total_ms
+
+        def pct(p: float) -> float:
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))], 1) if recent else 0.0
+
+        return {
+            "count": count,
+            "errors": errors,
+            "avg_ms": round(total / count, 1) if count else 0.0,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(recent[-1], 1) if recent else 0.0,
+        }
+
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape_label(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metrics:
+    PREFIX = "vrm_talk_"
+
+    def __init__(self):
+        self._summaries: Dict[Tuple[str, _Labels], _LatencyStat] = {}
+        self._counters: Dict[Tuple[str, _Labels], float] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, Dict[str, Any], float]]]] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, _Labels]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def summary(self, name: str, **labels: Any) -> _LatencyStat:
+        key = self._key(name, labels)
+        with self._lock:
+            stat = self._summaries.get(key)
+            if stat is None:
+                stat = self._summaries[key] = _LatencyStat()
+            return stat
+
+    def observe(self, name: str, ms: float, ok: bool = True, **labels: Any) -> None:
+        self.summary(name, **labels).add(ms, ok)
+
+    def inc(self, name: str, n: float = 1.0, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + n
+
+    def collector(self, fn: Callable[[], Iterable[Tuple[str, str, Dict[str, Any], float]]]):
+        """(name, "gauge"|"counter", labels, value) を返す関数を登録する（デコレータとして使う）。"""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _fmt_labels(labels: Iterable[Tuple[str, str]], **extra: str) -> str:
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        body = ",".join(f'{k}="{_escape_label(v)}"' for k, v in items)
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+        typed: set = set()
+
+        def _type(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            summaries = sorted(self._summaries.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), stat in summaries:
+            full = self.PREFIX + name
+            snap = stat.snapshot()
+            _type(full, "summary")
+            for q, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lines.append(f"{full}{self._fmt_labels(labels, quantile=q)} {snap[key]}")
+            lines.append(f"{full}_sum{self._fmt_labels(labels)} {round(stat.total_ms, 1)}")
+            lines.append(f"{full}_count{self._fmt_labels(labels)} {snap['count']}")
+        for (name, labels), value in counters:
+            full = self.PREFIX + name
+            _type(full, "counter")
+            lines.append(f"{full}{self._fmt_labels(labels)} {value:g}")
+        for fn in self._collectors:
+            try:
+                rows = list(fn())
+            except Exception as e:
+                _log(f"[ERR] metrics collector {getattr(fn, '__name__', fn)}: {e}")
+                continue
+            for name, kind, labels, value in rows:
+                full = self.PREFIX + name
+                _type(full, kind)
+                lines.append(f"{full}{self._fmt_labels(sorted((k, str(v)) for k, v in labels.items()))} {float(value):g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = _Metrics()
+
+# 1リクエスト分の段階別所要時間（レスポンスの timings / steps になる）
+_request_timings: "ContextVar[Optional[Dict[str, Any]]]" = ContextVar("request_timings", default=None)
+
+
+def _begin_request_timings(timings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """このタスク（と、ここから起動する子タスク）の計測先を設定する。"""
+    if timings is None:
+        timings = {}
+    timings.setdefault("_t0", time.perf_counter())
+    _request_timings.set(timings)
+    return timings
+
+
+def record_stage(stage: str, ms: float, ok: bool = True, *, repeated: bool = False) -> None:
+    metrics.observe("stage_ms", ms, ok, stage=stage)
+    timings = _request_timings.get()
+    if timings is None:
+        return
+    if repeated:
+        timings.setdefault(stage, []).append(round(ms, 1))
+    else:
+        timings[stage] = round(ms, 1)
+
+
+def record_since_request_start(stage: str) -> None:
+    timings = _request_timings.get()
+    if timings is not None and "_t0" in timings and stage not in timings:
+        record_stage(stage, (time.perf_counter() - timings["_t0"]) * 1000)
+
+
+@contextmanager
+def stage_span(stage: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_stage(stage, (time.perf_counter() - t0) * 1000, ok)
+
+
+_STAGE_LABELS = {
+    "stt": "音声認識",
+    "queue_ollama": "Ollama の順番待ち",
+    "queue_coeiroink": "音声合成の順番待ち",
+    "llm_ttft": "LLM 最初のトークン",
+    "llm": "LLM 応答",
+    "director": "音声監督",
+    "pose": "ポーズ",
+    "tts": "音声合成",
+    "tts_segment": "文ごとの音声合成",
+    "lipsync": "口パク解析",
+    "first_audio": "最初の音声まで",
+    "total": "合計",
+}
+
+
+def _public_timings(timings: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """(timings, steps) を返す。steps はフロントの処理ステータス欄にそのまま出す文字列。"""
+    public = {k: v for k, v in timings.items() if not k.startswith("_")}
+    steps: List[str] = []
+    for stage, label in _STAGE_LABELS.items():
+        v = public.get(stage)
+        if isinstance(v, list) and v:
+            steps.append(f"{label}: {len(v)}件（平均 {sum(v) / len(v):.0f}ms / 最大 {max(v):.0f}ms）")
+        elif isinstance(v, (int, float)):
+            steps.append(f"{label}: {v:.0f}ms")
+    return public, steps
+
+
+@metrics.collector
+def _log_writer_metrics():
+    yield "log_lines_written_total", "counter", {}, log_writer.written
+    yield "log_lines_dropped_total", "counter", {}, log_writer.dropped
+    yield "log_queue_depth", "gauge", {}, log_writer.pending()
+
+
+@app.get("/metrics")
+def metrics_view():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ==========================
+# サーキットブレーカー（Ollama / Gemini / COEIROINK ごと）
+#   連続 BREAKER_FAILURES 回失敗したら open にして即座に失敗させ、呼び出し側は安いフォールバックへ進む。
+#   BREAKER_COOLDOWN_SEC 後に1件だけ試しに通し（half-open）、成功すれば閉じる。
+# ==========================
+BREAKER_FAILURES = max(1, int(os.getenv("BREAKER_FAILURES", "3")))
+BREAKER_COOLDOWN_SEC = float(os.getenv("BREAKER_COOLDOWN_SEC", "30"))
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class _CircuitBreaker:
+    """async with breaker: ... で使う。中で例外が出れば失敗、抜ければ成功として数える。"""
+
+    def __init__(self, name: str, *, failure_threshold: int, cooldown_sec: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """cooldown 中で、いま呼んでも即座に断られる状態か。"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.cooldown_sec
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.cooldown_sec:
+                    self.rejected += 1
+                    return False
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    self.rejected += 1
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                _log(f"[INFO] breaker {self.name} closed")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                    _log(f"[WARN] breaker {self.name} open failures={self.failures} cooldown={self.cooldown_sec:.0f}s")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def _release(self) -> None:
+        # キャンセルされた試行・流量制御で断られた試行は成否に数えない
+        with self._lock:
+            self._probing = False
+
+    async def __aenter__(self) -> "_CircuitBreaker":
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} は停止中とみなしています（circuit open）")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.record_success()
+        elif issubclass(exc_type, (asyncio.CancelledError, AdmissionRejected)):
+            self._release()
+        else:
+            self.record_failure()
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "trips": self.trips, "rejected": self.rejected}
+
+
+breakers: Dict[str, _CircuitBreaker] = {
+    name: _CircuitBreaker(name, failure_threshold=BREAKER_FAILURES, cooldown_sec=BREAKER_COOLDOWN_SEC)
+    for name in ("ollama", "gemini", "coeiroink")
+}
+
+
+async def _hedged(primary: Callable[[], Awaitable[Any]], backup: Callable[[], Awaitable[Any]], delay: float, label: str) -> Any:
+    """primary が delay 秒以内に成功しなければ backup も投げ、先に成功した方を返す（遅い方は取り消す）。"""
+    first = asyncio.create_task(primary())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done and first.exception() is None:
+        return first.result()
+    _log(f"[INFO] {label} hedge start ({'primary failed' if done else f'no answer in {delay:.1f}s'})")
+    pending = {asyncio.create_task(backup())}
+    if not done:
+        pending.add(first)
+    error: Optional[BaseException] = first.exception() if done else None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    _log(f"[INFO] {label} hedge won by {'primary' if task is first else 'backup'}")
+                    return task.result()
+                error = task.exception()
+        raise error or RuntimeError(f"{label} hedge failed")
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+@metrics.collector
+def _breaker_metrics():
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    for name, b in breakers.items():
+        snap = b.snapshot()
+        yield "breaker_state", "gauge", {"backend": name}, states[snap["state"]]
+        yield "breaker_trips_total", "counter", {"backend": name}, snap["trips"]
+        yield "breaker_rejected_total", "counter", {"backend": name}, snap["rejected"]
+
+
+@app.get("/api/breakers")
+def breaker_states():
+    return {name: b.snapshot() for name, b in breakers.items()}
+
+# ==========================
+# 流量制御（COEIROINK / Ollama の同時実行数を絞り、待ち行列はセッション間で公平に回す）
+# ==========================
+ADMIT_QUEUE_MAX = int(os.getenv("ADMIT_QUEUE_MAX", "32"))                # 依存先ごとの待ち行列の上限（超えたら 503）
+ADMIT_SESSION_QUEUE_MAX = int(os.getenv("ADMIT_SESSION_QUEUE_MAX", "8"))  # 1セッションが並べられる数（超えたら 429）
+ADMIT_WAIT_SEC = float(os.getenv("ADMIT_WAIT_SEC", "20"))                # これ以上待たされたら諦めて 503
+
+# 公平に並べる単位。_process_chat_request が設定し、そこから起動した子タスクにも引き継がれる
+_request_session: "ContextVar[str]" = ContextVar("request_session", default="default")
+
+
+class AdmissionRejected(RuntimeError):
+    """混雑で受け付けられなかった。status は 429（そのセッションが並べすぎ）か 503（全体が飽和）。"""
+
+    def __init__(self, backend: str, reason: str, status: int, retry_after: int):
+        super().__init__(f"{backend} is saturated ({reason})")
+        self.backend = backend
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _FairLimiter:
+    """async with limiter.slot(): ... で使う同時実行数の上限付きセマフォ。
+
+    空きが無いときはセッションごとの FIFO に並び、空いた枠はセッションを順番に回して渡す
+    （1人が大量に投げても他の人の1件目が後ろに回されない）。イベントループ上でだけ使う。
+    """
+
+    def __init__(self, name: str, *, limit: int, queue_max: int, session_queue_max: int, wait_sec: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_max = queue_max
+        self.session_queue_max = session_queue_max
+        self.wait_sec = wait_sec
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+        self._queues: "OrderedDict[str, deque[asyncio.Future]]" = OrderedDict()
+        self._hold_ms = 1000.0  # 1件あたりの占有時間（指数移動平均）。Retry-After の見積もりに使う
+        self._wait = metrics.summary("admission_wait_ms", backend=name)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil((self.queued / self.limit + 1) * self._hold_ms / 1000))
+
+    def _reject(self, reason: str, status: int) -> AdmissionRejected:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        _log(f"[WARN] admission {self.name} rejected reason={reason} active={self.active} queued={self.queued}")
+        return AdmissionRejected(self.name, reason, status, self._retry_after())
+
+    async def acquire(self) -> None:
+        t0 = time.perf_counter()
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+        else:
+            sid = _request_session.get()
+            if self.queued >= self.queue_max:
+                raise self._reject("queue_full", 503)
+            q = self._queues.get(sid)
+            if q is not None and len(q) >= self.session_queue_max:
+                raise self._reject("session_queue_full", 429)
+            fut: asyncio.Future = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(sid, deque()).append(fut)
+            self.queued += 1
+            try:
+                await asyncio.wait_for(fut, self.wait_sec)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if fut.done() and not fut.cancelled():
+                    self.release()  # 枠を渡された直後に諦めた
+                else:
+                    self._drop(sid, fut)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._wait.add((time.perf_counter() - t0) * 1000, ok=False)
+                raise self._reject("wait_timeout", 503)
+        ms = (time.perf_counter() - t0) * 1000
+        self.admitted += 1
+        self._wait.add(ms)
+        record_stage(f"queue_{self.name}", ms, repeated=True)
+
+    def _drop(self, sid: str, fut: asyncio.Future) -> None:
+        q = self._queues.get(sid)
+        if q is not None and fut in q:
+            q.remove(fut)
+            self.queued -= 1
+            if not q:
+                del self._queues[sid]
+
+    def release(self) -> None:
+        # 空いた枠は active を減らさずに次のセッションの先頭へ直接渡す
+        while self._queues:
+            sid, q = next(iter(self._queues.items()))
+            fut = q.popleft()
+            self.queued -= 1
+            if q:
+                self._queues.move_to_end(sid)
+            else:
+                del self._queues[sid]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold_ms = 0.8 * self._hold_ms + 0.2 * (time.perf_counter() - t0) * 1000
+            self.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "sessions_waiting": len(self._queues),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "hold_ms": round(self._hold_ms, 1),
+            "wait_ms": self._wait.snapshot(),
+        }
+
+
+def _admit_env(backend: str, key: str, default: Any) -> str:
+    """ADMIT_<BACKEND>_<KEY> があればそれを、無ければ全体の既定値を使う。"""
+    return os.getenv(f"ADMIT_{backend.upper()}_{key}", str(default))
+
+
+def _make_limiter(backend: str, default_limit: int) -> _FairLimiter:
+    return _FairLimiter(
+        backend,
+        limit=int(_admit_env(backend, "CONCURRENCY", default_limit)),
+        queue_max=int(_admit_env(backend, "QUEUE_MAX", ADMIT_QUEUE_MAX)),
+        session_queue_max=int(_admit_env(backend, "SESSION_QUEUE_MAX", ADMIT_SESSION_QUEUE_MAX)),
+        wait_sec=float(_admit_env(backend, "WAIT_SEC", ADMIT_WAIT_SEC)),
+    )
+
+
+# COEIROINK は従来の TTS_WORKERS を既定の同時合成数として引き継ぐ
+admission: Dict[str, _FairLimiter] = {
+    "ollama": _make_limiter("ollama", 2),
+    "coeiroink": _make_limiter("coeiroink", int(os.getenv("TTS_WORKERS", "2"))),
+}
+
+
+@metrics.collector
+def _admission_metrics():
+    for name, lim in admission.items():
+        yield "admission_active", "gauge", {"backend": name}, lim.active
+        yield "admission_queue_depth", "gauge", {"backend": name}, lim.queued
+        yield "admission_admitted_total", "counter", {"backend": name}, lim.admitted
+        for reason, n in lim.rejected.items():
+            yield "admission_rejected_total", "counter", {"backend": name, "reason": reason}, n
+
+
+@app.get("/api/admission")
+def admission_states():
+    return {name: lim.snapshot() for name, lim in admission.items()}
+
+# ==========================
+# 起動状態（/healthz: プロセスが生きているか / /readyz: 依存先の準備ができたか）
+# ==========================
+# /readyz が 200 を返す条件にする依存先（ollama を足すとウォームアップ完了まで 503）
+READYZ_REQUIRE = [s.strip() for s in os.getenv("READYZ_REQUIRE", "coeiroink").split(",") if s.strip()]
+READY_RETRY_SEC = float(os.getenv("READY_RETRY_SEC", "5"))       # 確認に失敗したときの再試行間隔（倍々で延ばす）
+READY_RETRY_MAX_SEC = float(os.getenv("READY_RETRY_MAX_SEC", "60"))
+_STARTED_AT = time.time()
+
+
+class _Readiness:
+    """依存先ごとの状態: pending → ready / unavailable（再試行中）。disabled は確認しない。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items: Dict[str, Dict[str, Any]] = {}
+
+    def set(self, name: str, state: str, **detail: Any) -> None:
+        with self._lock:
+            self._items[name] = {"state": state, "since": round(time.time(), 3), **detail}
+
+    def state(self, name: str) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(name)
+            return item["state"] if item else None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {k: dict(v) for k, v in self._items.items()}
+
+
+readiness = _Readiness()
+readiness.set("coeiroink", "pending")
+readiness.set("ollama", "pending")
+readiness.set("gemini", "ready" if GEMINI_API_KEY else "disabled")
+
+
+async def _until_ready(name: str, probe: Callable[[], Awaitable[Optional[Dict[str, Any]]]]) -> None:
+    """probe が通るまで間隔を延ばしながら繰り返し、結果を readiness に反映する。"""
+    delay = READY_RETRY_SEC
+    attempt = 0
+    while True:
+        attempt += 1
+        t0 = time.perf_counter()
+        try:
+            detail = await probe() or {}
+        except Exception as e:
+            readiness.set(name, "unavailable", attempts=attempt, error=str(e)[:200] or type(e).__name__)
+            if attempt == 1:
+                _log(f"[WARN] {name} not ready yet: {e}")
+            await asyncio.sleep(delay)
+            delay = min(READY_RETRY_MAX_SEC, delay * 2)
+            continue
+        ms = (time.perf_counter() - t0) * 1000
+        readiness.set(name, "ready", attempts=attempt, ms=round(ms, 1), **detail)
+        _log(f"[INFO] {name} ready attempts={attempt} ms={ms:.0f}")
+        return
+
+
+@metrics.collector
+def _readiness_metrics():
+    for name, item in readiness.snapshot().items():
+        yield "backend_ready", "gauge", {"backend": name}, 1 if item["state"] == "ready" else 0
+
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok", "uptime_sec": round(time.time() - _STARTED_AT, 1)}
+
+
+@app.get("/readyz")
+def readyz():
+    backends = readiness.snapshot()
+    for name, b in breakers.items():
+        if name in backends:
+            backends[name]["breaker"] = b.snapshot()["state"]
+    ready = all(backends.get(n, {}).get("state") in ("ready", "disabled") for n in READYZ_REQUIRE)
+    return JSONResponse(
+        {"ready": ready, "require": READYZ_REQUIRE, "backends": backends},
+        status_code=200 if ready else 503,
+    )
+
+# ==========================
+# 共有状態（uvicorn --workers N や複数ノードで動かすとき）
+#   STATE_BACKEND=memory（既定）… 会話・キャッシュ・音声の索引はこのプロセスの中だけ（1ワーカー前提）
+#   STATE_BACKEND=redis         … Redis 互換サーバー（Redis / Valkey / KeyDB など）に置き、ワーカー間で共有する
+#   BLOB_STORE=local（既定）… 音声ファイルは OUT_DIR（複数ノードなら共有マウントにする）
+#   BLOB_STORE=redis        … 音声ファイルも共有ストアに置き、各ノードの OUT_DIR は手元のキャッシュとして使う
+# 流量制御（ADMIT_*）とブレーカーはワーカーごと。COEIROINK の話者/スタイルは各ワーカーが起動時に同じ値を解決する。
+# ==========================
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").strip().lower()
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "vrm_talk:")
+STATE_TIMEOUT_SEC = float(os.getenv("STATE_TIMEOUT_SEC", "1"))
+BLOB_STORE = os.getenv("BLOB_STORE", "local").strip().lower()
+
+
+class _RedisState:
+    """Redis 互換サーバーへの接続（遅延生成）。redis パッケージが必要（pip install redis）。
+
+    呼び出しは同期（同じホスト/LAN 内のサーバーを想定し、STATE_TIMEOUT_SEC で打ち切る）。
+    イベントループからは _run_blocking 経由で呼ぶ（会話履歴は _session_turns / _session_append）。
+    """
+
+    def __init__(self, url: str, prefix: str, timeout: float):
+        self.url = url
+        self.prefix = prefix
+        self.timeout = timeout
+        self._client: Any = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        import redis  # 任意依存: STATE_BACKEND=redis のときだけ
+                    except ImportError as e:
+                        raise RuntimeError("STATE_BACKEND=redis には redis パッケージが必要です（pip install redis）") from e
+
+                    self._client = redis.Redis.from_url(
+                        self.url, socket_timeout=self.timeout, socket_connect_timeout=self.timeout
+                    )
+        return self._client
+
+    def key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    async def probe(self) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        await _run_blocking(self.client.ping)
+        return {"backend": "redis", "rtt_ms": round((time.perf_counter() - t0) * 1000, 2)}
+
+
+if STATE_BACKEND not in ("memory", "redis"):
+    _log(f"[WARN] unknown STATE_BACKEND={STATE_BACKEND!r}, using memory")
+    STATE_BACKEND = "memory"
+if BLOB_STORE == "redis" and STATE_BACKEND != "redis":
+    _log("[WARN] BLOB_STORE=redis requires STATE_BACKEND=redis, using local")
+    BLOB_STORE = "local"
+
+# None ならプロセス内（既定）
+shared_state: Optional[_RedisState] = (
+    _RedisState(STATE_REDIS_URL, STATE_PREFIX, STATE_TIMEOUT_SEC) if STATE_BACKEND == "redis" else None
+)
+if shared_state is not None:
+    readiness.set("state", "pending")
+    if "state" not in READYZ_REQUIRE:
+        READYZ_REQUIRE.append("state")  # 共有ストアに届かないワーカーには振り分けない
+
+
+@app.on_event("startup")
+async def _start_shared_state():
+    if shared_state is not None:
+        _spawn(_until_ready("state", shared_state.probe))
+
+
+class _RedisBlobStore:
+    """返答音声（WAV と付随ファイル）を共有ストアに置く。名前は /audio/<name> と同じ。
+
+    置いてから AUDIO_TTL_SEC で消える。各ノードは必要になったときに OUT_DIR へ取ってきて配信する。
+    """
+
+    def __init__(self, state: _RedisState, *, ttl_sec: float):
+        self.state = state
+        self.ttl_sec = ttl_sec
+
+    def put(self, path: Path) -> None:
+        self.state.client.set(self.state.key("blob", path.name), path.read_bytes(), ex=max(1, int(self.ttl_sec)))
+
+    def fetch(self, name: str, dst: Path) -> bool:
+        data = self.state.client.get(self.state.key("blob", name))
+        if data is None:
+            return False
+        tmp = dst.with_name(f"{dst.name}.{uuid.uuid4().hex}.part")
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, dst)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return True
+
+    def delete(self, names: List[str]) -> None:
+        if names:
+            self.state.client.delete(*(self.state.key("blob", n) for n in names))
+
 # ==========================
 # Webからの終了（必要ならログを開く）
 # ==========================
@@ -125,6 +1171,8 @@ def shutdown(show_log: int = Query(0, ge=0, le=1)):
         # The original code had Windows-specific logic to kill parent shells
         # and open log files. This is replaced with a simple exit.
         print("Shutting down server...")
+        # os._exit は atexit を通らないので、溜まっているログはここで書き切る
+        log_writer.close()
         os._exit(0)
 
     threading.Thread(target=_shutdown, daemon=True).start()
@@ -161,29 +1209,18 @@ STYLE_PRESETS = [
 ]
 VALID_STYLE_IDS = {s["id"] for s in STYLE_PRESETS}
 
-def _fetch_speakers() -> list:
-    """COEIROINKから話者一覧を取得（リトライ付き）"""
-    max_retries = 10
-    retry_delay = 5  # seconds
-
-    for attempt in range(max_retries):
-        try:
-            print(f"COEIROINK /v1/speakers へ接続試行 ({attempt + 1}/{max_retries})...")
-            r = requests.get(f"{COEIROINK_URL}/v1/speakers", timeout=10)
-            r.raise_for_status()
-            print("COEIROINK 接続成功")
-            return r.json()
-        except requests.exceptions.RequestException as e:
-            print(f"COEIROINK 接続失敗: {e}")
-            if attempt < max_retries - 1:
-                print(f"{retry_delay}秒後に再試行します。")
-                time.sleep(retry_delay)
-            else:
-                print("COEIROINKへの最大リトライ回数に達しました。")
-                raise
+async def _fetch_speakers() -> Dict[str, Any]:
+    """COEIROINK に話者一覧を問い合わせる（1回だけ。再試行は _until_ready が行う）。"""
+    global CACHED_SPEAKERS
+    r = await _http().get(f"{COEIROINK_URL}/v1/speakers", timeout=10)
+    if r.status_code == 200:
+        CACHED_SPEAKERS = r.json()
+        return {"speakers": len(CACHED_SPEAKERS)}
+    # 2.5.1 は meta_manager のバグで 500 を返すが、エンジン自体は起動していて合成はできる
+    return {"speakers": None, "status": r.status_code}
 
 @app.on_event("startup")
-def resolve_coeiroink_style():
+async def resolve_coeiroink_style():
     """
     WORKAROUND: coeiroink:2.5.1の /v1/speakers には meta_manager is not defined というバグがあるため、
     API呼び出しをバイパスし、固定の話者情報で初期化する。
@@ -212,455 +1249,2702 @@ def resolve_coeiroink_style():
     print("COEIROINKの /v1/speakers API呼び出しをスキップしました。")
     print(f"固定話者情報: speakerUuid={RESOLVED_SPEAKER_UUID}, styleId={RESOLVED_STYLE_ID}")
     print("="*50)
+    # 接続確認は起動を待たせずにバックグラウンドで行い、結果は /readyz で見る
+    _spawn(_until_ready("coeiroink", _fetch_speakers))
 
 # ==========================
-# Gemini 応答（テキスト生成）
+# 会話セッション（クライアントごとのリングバッファ）
 # ==========================
-def _limited_contents():
-    # 先頭は system_instruction、以降は末尾20件に制限
-    tail = history[1:][-HISTORY_TURNS*2:]
-    return [system_instruction] + tail
+SESSION_IDLE_SEC = float(os.getenv("SESSION_IDLE_SEC", str(6 * 3600)))   # 最終発話からこの秒数で破棄
+SESSION_MAX = max(1, int(os.getenv("SESSION_MAX", "200")))              # 保持するセッション数の上限
+SESSION_SNAPSHOT = os.getenv("SESSION_SNAPSHOT", "")                     # 指定時のみ JSON に退避/復元
+SESSION_SWEEP_SEC = float(os.getenv("SESSION_SWEEP_SEC", "60"))
+DEFAULT_SESSION_ID = "default"
 
 
-def gemini_reply(user_text: str) -> str:
-    history.append(f"User: {user_text}")
-    try:
-        res = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=_limited_contents()
-        )
-        reply = getattr(res, "text", "").strip()
-        if not reply:
-            reply = "ごめん、返答を作れなかった。"
-    except Exception as e:
-        _log(f"[ERR][GEMINI] {e}")
-        reply = "ごめん、AIモデルとのお話に失敗しちゃった。コンソールでログを確認してみて。もしかしてAPIキーが違うかも？"
+class _Session:
+    __slots__ = ("turns", "last_seen")
 
-    history.append(f"Gemini: {reply}")
+    def __init__(self, turns: Optional[List[Tuple[str, str]]] = None, last_seen: Optional[float] = None):
+        # (role, text) を直近 HISTORY_TURNS 往復分だけ保持する
+        self.turns: "deque[Tuple[str, str]]" = deque(turns or [], maxlen=HISTORY_TURNS * 2)
+        self.last_seen = last_seen if last_seen is not None else time.time()
 
-    with open(BASE_DIR.parent / "chat_history.txt", "a", encoding="utf-8") as f:
-        f.write(f"あなた: {user_text}\n")
-        f.write(f"Gemini: {reply}\n\n")
-    _log(f"[TEXT] user='{user_text}' reply='{reply}'")
-    return reply
 
+class SessionStore:
+    """session id → 固定長リングバッファ。アイドル破棄と上限超過時の LRU 破棄つき。"""
 
-# ローカル会話（Ollama: gemma3:12b）
-LOCAL_CHAT_MODEL = os.getenv("OLLAMA_MODEL_CHAT", "gemma3:12b")
-LOCAL_CHAT_MODEL_4B = os.getenv("OLLAMA_MODEL_CHAT_4B", "gemma3:4b")
+    def __init__(self, *, max_sessions: int, idle_sec: float, snapshot_path: Optional[Path] = None):
+        self.max_sessions = max_sessions
+        self.idle_sec = idle_sec
+        self.snapshot_path = snapshot_path
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._lock = threading.Lock()
 
-def local_reply_ollama(user_text: str, model: Optional[str] = None) -> str:
-    # 簡易プロンプト: システム指示 + 直近履歴 + 今回のUser
-    tail = history[1:][-HISTORY_TURNS*2:]
-    convo = "\n".join(tail + [f"User: {user_text}", "Assistant:"])
-    use_model = model or LOCAL_CHAT_MODEL
-    # 4B のときは少し長めに話すよう追加指示を付与
-    extra = ""
-    if "4b" in str(use_model).lower():
-        extra = (
-            "\n出力ルール: 簡潔にし過ぎず、3〜6文で自然に。"
-            " 友達感覚で喋って"
-            " です・ます調は極力使わない\n"
-        )
-    prompt = system_instruction + extra + "\n" + convo
+    def _get_locked(self, sid: str) -> _Session:
+        sess = self._sessions.get(sid)
+        if sess is None:
+            sess = self._sessions[sid] = _Session()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(sid)
+        sess.last_seen = time.time()
+        return sess
+
+    def turns(self, sid: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._get_locked(sid).turns)
+
+    def append(self, sid: str, user_text: str, reply: str) -> None:
+        with self._lock:
+            sess = self._get_locked(sid)
+            sess.turns.append(("user", user_text))
+            sess.turns.append(("assistant", reply))
+
+    def sweep(self) -> int:
+        cutoff = time.time() - self.idle_sec
+        with self._lock:
+            stale = [sid for sid, s in self._sessions.items() if s.last_seen < cutoff]
+            for sid in stale:
+                del self._sessions[sid]
+        return len(stale)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def save(self) -> None:
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            data = {
+                sid: {"last_seen": s.last_seen, "turns": [list(t) for t in s.turns]}
+                for sid, s in self._sessions.items()
+            }
+        tmp = self.snapshot_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.snapshot_path)
+
+    def load(self) -> None:
+        if not self.snapshot_path or not self.snapshot_path.exists():
+            return
+        data = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+        with self._lock:
+            for sid, s in sorted(data.items(), key=lambda kv: kv[1].get("last_seen", 0)):
+                turns = [(str(r), str(t)) for r, t in s.get("turns", [])]
+                self._sessions[sid] = _Session(turns, float(s.get("last_seen", time.time())))
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class _RedisSessionStore:
+    """SessionStore と同じ API を共有状態の上に作る（STATE_BACKEND=redis）。
+
+    会話は list（直近 HISTORY_TURNS 往復）、最終発話時刻は sorted set に置く。アイドル破棄は list の TTL と
+    sweep、上限超過は古い順に消す。状態はストア側にあるので snapshot は使わない。
+    """
+
+    snapshot_path = None
+
+    def __init__(self, state: _RedisState, *, max_sessions: int, idle_sec: float):
+        self.state = state
+        self.max_sessions = max_sessions
+        self.idle_sec = idle_sec
+        self._zkey = state.key("sessions")
+
+    def _lkey(self, sid: str) -> str:
+        return self.state.key("session", sid)
+
+    def turns(self, sid: str) -> List[Tuple[str, str]]:
+        pipe = self.state.client.pipeline(transaction=False)
+        pipe.lrange(self._lkey(sid), 0, -1)
+        pipe.expire(self._lkey(sid), max(1, int(self.idle_sec)))
+        raw = pipe.execute()[0]
+        if raw:
+            # 会話があるときだけ索引の時刻を更新する（無い会話まで足すと上限を超え、追い出した会話も索引に戻る）
+            self.state.client.zadd(self._zkey, {sid: time.time()})
+            self._trim()
+        return [tuple(json.loads(x)) for x in raw]
+
+    def append(self, sid: str, user_text: str, reply: str) -> None:
+        key = self._lkey(sid)
+        pipe = self.state.client.pipeline(transaction=True)
+        pipe.rpush(key, json.dumps(["user", user_text], ensure_ascii=False),
+                   json.dumps(["assistant", reply], ensure_ascii=False))
+        pipe.ltrim(key, -HISTORY_TURNS * 2, -1)
+        pipe.expire(key, max(1, int(self.idle_sec)))
+        pipe.zadd(self._zkey, {sid: time.time()})
+        pipe.execute()
+        self._trim()
+
+    def _drop(self, sids: List[str]) -> None:
+        if sids:
+            self.state.client.delete(*(self._lkey(s) for s in sids))
+
+    def _trim(self) -> None:
+        over = self.state.client.zcard(self._zkey) - self.max_sessions
+        if over > 0:
+            self._drop([m.decode() for m, _ in self.state.client.zpopmin(self._zkey, over)])
+
+    def sweep(self) -> int:
+        cutoff = time.time() - self.idle_sec
+        stale = [m.decode() for m in self.state.client.zrangebyscore(self._zkey, "-inf", cutoff)]
+        if stale:
+            self.state.client.zrem(self._zkey, *stale)
+            self._drop(stale)
+        return len(stale)
+
+    def __len__(self) -> int:
+        return int(self.state.client.zcard(self._zkey))
+
+    def save(self) -> None:
+        pass
+
+    def load(self) -> None:
+        pass
+
+
+sessions: Any
+if shared_state is not None:
+    sessions = _RedisSessionStore(shared_state, max_sessions=SESSION_MAX, idle_sec=SESSION_IDLE_SEC)
+else:
+    sessions = SessionStore(
+        max_sessions=SESSION_MAX,
+        idle_sec=SESSION_IDLE_SEC,
+        snapshot_path=Path(SESSION_SNAPSHOT) if SESSION_SNAPSHOT else None,
+    )
+
+
+@metrics.collector
+def _session_metrics():
+    yield "sessions", "gauge", {}, len(sessions)
+
+_SESSION_ID_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_")
+
+
+def _session_id(*candidates: Optional[str]) -> str:
+    """フォーム/ヘッダの session id を検証する。使えなければ共有の default。"""
+    for raw in candidates:
+        sid = (raw or "").strip()
+        if sid and len(sid) <= 64 and set(sid) <= _SESSION_ID_CHARS:
+            return sid
+    return DEFAULT_SESSION_ID
+
+
+def _append_chat_history(session_id: str, speaker: str, user_text: str, reply: str) -> None:
+    """会話ログ（人が読む chat_history.txt と、任意で JSONL）に1往復ぶん追記する。"""
+    log_writer.write(CHAT_HISTORY_FILE, f"あなた: {user_text}\n{speaker}: {reply}\n\n")
+    if CHAT_HISTORY_JSONL:
+        rec = {"ts": time.time(), "session": session_id, "engine": speaker, "user": user_text, "reply": reply}
+        log_writer.write(CHAT_HISTORY_JSONL_FILE, json.dumps(rec, ensure_ascii=False) + "\n")
+
+
+def _history_lines(turns: List[Tuple[str, str]]) -> List[str]:
+    # 従来のプロンプト形式（"User: ..." / "Gemini: ..."）で直近の履歴を返す
+    return [f"User: {t}" if r == "user" else f"Gemini: {t}" for r, t in turns]
+
+
+async def _session_turns(sid: str) -> List[Tuple[str, str]]:
+    # 共有ストアはネットワーク往復になるのでイベントループの外で引く
+    if shared_state is None:
+        return sessions.turns(sid)
+    return await _run_blocking(sessions.turns, sid)
+
+
+async def _session_append(sid: str, user_text: str, reply: str) -> None:
+    if shared_state is None:
+        sessions.append(sid, user_text, reply)
+    else:
+        await _run_blocking(sessions.append, sid, user_text, reply)
+
+
+async def _session_janitor():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SEC)
+        try:
+            dropped = await _run_blocking(sessions.sweep)
+            if dropped:
+                _log(f"[INFO] session sweep dropped={dropped} live={await _run_blocking(len, sessions)}")
+            if sessions.snapshot_path:
+                await _run_blocking(sessions.save)
+        except Exception as e:
+            _log(f"[ERR] session janitor: {e}")
+
+
+@app.on_event("startup")
+async def _start_sessions():
+    try:
+        sessions.load()
+    except Exception as e:
+        _log(f"[ERR] session snapshot load failed: {e}")
+    _spawn(_session_janitor())
+
+
+@app.on_event("shutdown")
+def _save_sessions():
+    try:
+        sessions.save()
+    except Exception as e:
+        _log(f"[ERR] session snapshot save failed: {e}")
+
+# ==========================
+# Gemini 応答（テキスト生成）
+# ==========================
+def _limited_contents(turns: List[Tuple[str, str]], user_text: str):
+    # 先頭は system_instruction、以降はセッションの直近20件 + 今回の発話
+    return [system_instruction] + _history_lines(turns) + [f"User: {user_text}"]
+
+
+async def gemini_reply(user_text: str, session_id: str = DEFAULT_SESSION_ID) -> str:
+    turns = await _session_turns(session_id)
     try:
+        async with breakers["gemini"]:
+            res = await gemini_client().aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=_limited_contents(turns, user_text)
+            )
+        reply = getattr(res, "text", "").strip()
+        if not reply:
+            reply = "ごめん、返答を作れなかった。"
+    except Exception as e:
+        _log(f"[ERR][GEMINI] {e}")
+        metrics.inc("errors_total", stage="llm")
+        reply = "ごめん、AIモデルとのお話に失敗しちゃった。コンソールでログを確認してみて。もしかしてAPIキーが違うかも？"
+
+    await _session_append(session_id, user_text, reply)
+
+    _append_chat_history(session_id, "Gemini", user_text, reply)
+    _log(f"[TEXT] user='{user_text}' reply='{reply}'")
+    return reply
+
+
+# ローカル会話（Ollama: gemma3:12b）
+LOCAL_CHAT_MODEL = os.getenv("OLLAMA_MODEL_CHAT", "gemma3:12b")
+LOCAL_CHAT_MODEL_4B = os.getenv("OLLAMA_MODEL_CHAT_4B", "gemma3:4b")
+
+
+def _local_system_prompt(use_model: str) -> str:
+    # 4B のときは少し長めに話すよう追加指示を付与
+    if "4b" in str(use_model).lower():
+        return system_instruction + (
+            "\n出力ルール: 簡潔にし過ぎず、3〜6文で自然に。"
+            " 友達感覚で喋って。"
+            " です・ます調は極力使わないように。\n"
+        )
+    return system_instruction
+
+
+def _local_chat_request(
+    user_text: str, use_model: str, turns: List[Tuple[str, str]], *, stream: bool
+) -> Tuple[str, Dict[str, Any]]:
+    """ローカル会話の (url, payload) を作る。
+
+    chat モードでは system + 履歴 + 今回の発話をメッセージ列で渡す。先頭（system と古い履歴）が
+    ターンをまたいで変わらないので、Ollama は前回の KV キャッシュを再利用でき prefill が差分だけになる。
+    """
+    system = _local_system_prompt(use_model)
+    if OLLAMA_CHAT_API == "chat":
+        messages = [{"role": "system", "content": system}]
+        messages += [{"role": r, "content": t} for r, t in turns]
+        messages.append({"role": "user", "content": user_text})
+        url = f"{OLLAMA_BASE_URL}/api/chat"
+        payload: Dict[str, Any] = {"model": use_model, "messages": messages, "stream": stream}
+    else:
+        # 簡易プロンプト: システム指示 + 直近履歴 + 今回のUser
+        convo = "\n".join(_history_lines(turns) + [f"User: {user_text}", "Assistant:"])
         url = f"{OLLAMA_BASE_URL}/api/generate"
-        resp = requests.post(url, json={"model": use_model, "prompt": prompt, "stream": False}, timeout=120)
-        resp.raise_for_status()
+        payload = {"model": use_model, "prompt": system + "\n" + convo, "stream": stream}
+    payload["keep_alive"] = OLLAMA_KEEP_ALIVE
+    return url, payload
+
+
+def _ollama_text(data: Dict[str, Any]) -> str:
+    # /api/chat は message.content、/api/generate は response にテキストが入る
+    msg = data.get("message")
+    if isinstance(msg, dict):
+        return str(msg.get("content") or "")
+    return str(data.get("response") or "")
+
+async def local_reply_ollama(
+    user_text: str, model: Optional[str] = None, session_id: str = DEFAULT_SESSION_ID
+) -> str:
+    use_model = model or LOCAL_CHAT_MODEL
+    url, payload = _local_chat_request(user_text, use_model, await _session_turns(session_id), stream=False)
+    try:
+        async with admission["ollama"].slot(), breakers["ollama"]:
+            resp = await _http_post(url, json=payload, timeout=120)
+            resp.raise_for_status()
         data = resp.json()
-        reply = str(data.get("response", "")).strip()
+        reply = _ollama_text(data).strip()
         if not reply:
             reply = "…（ローカル応答なし）"
+    except AdmissionRejected:
+        raise
     except Exception as e:
         _log(f"[LOCAL_CHAT][ERR] {e}")
+        metrics.inc("errors_total", stage="llm")
         reply = "…（ローカルLLMに接続できませんでした）"
 
-    history.append(f"Gemini: {reply}")  # 形式を合わせて履歴に残す
-    try:
-        with open(BASE_DIR.parent / "chat_history.txt", "a", encoding="utf-8") as f:
-            f.write(f"あなた: {user_text}\n")
-            f.write(f"Local: {reply}\n\n")
-    except Exception:
-        pass
+    await _session_append(session_id, user_text, reply)
+    _append_chat_history(session_id, "Local", user_text, reply)
     return reply
 
 
-def local_reply_ollama_stream(
+async def _warm_ollama(models: List[str]) -> Dict[str, Any]:
+    """prompt なしの generate はモデルの読み込みだけを行う（keep_alive の間メモリに残る）。1つでも失敗したら例外。"""
+    loaded: Dict[str, float] = {}
+    for m in models:
+        t0 = time.perf_counter()
+        try:
+            # ブレーカーは通さない（起動直後の読み込み待ちや再試行の失敗で本番の呼び出しまで止めないように）
+            resp = await _http_post(
+                f"{OLLAMA_BASE_URL}/api/generate",
+                json={"model": m, "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=300,
+            )
+            resp.raise_for_status()
+        except Exception as e:
+            raise RuntimeError(f"warmup failed model={m}: {e}") from e
+        loaded[m] = round((time.perf_counter() - t0) * 1000, 1)
+        _log(f"[INFO] ollama warmup ok model={m} ms={loaded[m]:.0f}")
+    return {"models": loaded}
+
+
+async def _ping_ollama() -> Dict[str, Any]:
+    resp = await _http().get(f"{OLLAMA_BASE_URL}/api/tags", timeout=10)
+    resp.raise_for_status()
+    return {"warmup": False}
+
+
+@app.on_event("startup")
+async def _start_ollama_warmup():
+    models = list(dict.fromkeys([LOCAL_CHAT_MODEL, OLLAMA_MODEL]))
+    # 起動を待たせないようにバックグラウンドで読み込む（ウォームアップしない設定でも到達確認だけはする）
+    probe = (lambda: _warm_ollama(models)) if OLLAMA_WARMUP else _ping_ollama
+    _spawn(_until_ready("ollama", probe))
+
+
+# --------------------------
+# 文単位TTSのパイプライン（LLMトークン読み出しと合成を重ねる）
+# --------------------------
+# 同時に合成する文の数（全リクエスト共有）は admission["coeiroink"]（TTS_WORKERS / ADMIT_COEIROINK_CONCURRENCY）で絞る
+TTS_QUEUE_MAX = max(1, int(os.getenv("TTS_QUEUE_MAX", "4")))      # 1リクエストで未返却のまま抱える文の上限
+TTS_SEGMENT_RETRIES = max(0, int(os.getenv("TTS_SEGMENT_RETRIES", "1")))  # 文の合成に失敗したときの再試行回数
+TTS_SEGMENT_RETRY_DELAY_SEC = float(os.getenv("TTS_SEGMENT_RETRY_DELAY_SEC", "0.3"))
+
+
+class _TTSResult:
+    __slots__ = ("index", "text", "path", "error", "synth_ms")
+
+    def __init__(self, index: int, text: str):
+        self.index = index
+        self.text = text
+        self.path: Optional[Path] = None
+        self.error: Optional[str] = None
+        self.synth_ms = 0.0
+
+
+class _TTSPipeline:
+    """producer/consumer: submit() した文を1文1タスクで並行に合成し、on_result は投入順に呼ぶ（collector タスク）。
+
+    未返却の文が TTS_QUEUE_MAX 件に達すると submit() が待たされるので、
+    合成が追いつかないときは LLM の読み出し側が自然に待たされる。
+    """
+
+    def __init__(
+        self,
+        *,
+        params: Callable[[], Awaitable[Tuple[int, Optional[Dict[str, Any]]]]],
+        engine_label: str,
+        on_result: Callable[[_TTSResult], None],
+    ):
+        self._params = params
+        self._label = engine_label
+        self._on_result = on_result
+        self._slots = asyncio.Semaphore(TTS_QUEUE_MAX)
+        self._ordered: "asyncio.Queue[Optional[Tuple[_TTSResult, asyncio.Task]]]" = asyncio.Queue()
+        self._count = 0
+        self._started = time.perf_counter()
+        self._collector = asyncio.create_task(self._collect())
+
+    async def _synth(self, res: _TTSResult) -> None:
+        # 合成枠の待ち時間は admission_wait_ms{backend="coeiroink"} と timings.queue_coeiroink に出る
+        t0 = time.perf_counter()
+        for attempt in range(TTS_SEGMENT_RETRIES + 1):
+            try:
+                style_id, overrides = await self._params()
+                res.path = await coeiroink_tts(res.text, style_id=style_id, tts_overrides=overrides)
+                res.error = None
+                break
+            except (AdmissionRejected, CircuitOpenError) as e:
+                # 混雑・停止中はすぐ再試行しても通らない
+                res.error = str(e)
+                break
+            except Exception as e:
+                res.error = str(e)
+                if attempt < TTS_SEGMENT_RETRIES:
+                    _log(f"[WARN] engine={self._label} segment_tts retry idx={res.index} attempt={attempt + 1} err={e}")
+                    metrics.inc("fallbacks_total", kind="segment_retry")
+                    await asyncio.sleep(TTS_SEGMENT_RETRY_DELAY_SEC * (attempt + 1))
+        res.synth_ms = (time.perf_counter() - t0) * 1000
+        if res.path is not None:
+            # 文ごとに並列で解析しておく（segment 通知で _lipsync_lookup から引く）
+            await lipsync_for(res.path)
+
+    async def submit(self, text: str) -> None:
+        await self._slots.acquire()
+        res = _TTSResult(self._count, text)
+        self._count += 1
+        task = asyncio.create_task(self._synth(res))
+        self._ordered.put_nowait((res, task))
+
+    async def _collect(self) -> None:
+        while True:
+            item = await self._ordered.get()
+            if item is None:
+                return
+            res, task = item
+            try:
+                await task
+            except Exception as e:
+                res.error = res.error or str(e)
+            at_ms = (time.perf_counter() - self._started) * 1000
+            record_stage("tts_segment", res.synth_ms, res.path is not None, repeated=True)
+            if res.path is None:
+                metrics.inc("errors_total", stage="tts")
+            if res.path is not None:
+                _log(
+                    f"[INFO] engine={self._label} segment_tts ok idx={res.index} text='{res.text[:40]}' "
+                    f"file='{res.path.name}' synth_ms={res.synth_ms:.0f} at_ms={at_ms:.0f}"
+                )
+            else:
+                _log(
+                    f"[ERR] engine={self._label} segment_tts fail idx={res.index} text='{res.text[:40]}' "
+                    f"synth_ms={res.synth_ms:.0f} err={res.error}"
+                )
+            try:
+                self._on_result(res)
+            except Exception as e:
+                _log(f"[ERR] engine={self._label} tts on_result failed: {e}")
+            finally:
+                self._slots.release()
+
+    async def close(self) -> None:
+        """投入済みの文がすべて返却されるまで待つ。"""
+        self._ordered.put_nowait(None)
+        await self._collector
+
+
+async def local_reply_ollama_stream(
     user_text: str,
     *,
     model: Optional[str] = None,
     tts_style_id: int,
     tts_overrides: Optional[Dict[str, Any]] = None,
     engine_label: str = "local",
+    on_segment: Optional[Callable[[Dict[str, Any]], None]] = None,
+    on_segment_error: Optional[Callable[[Dict[str, Any]], None]] = None,
+    tts_params: Optional[Callable[[], Awaitable[Tuple[int, Optional[Dict[str, Any]]]]]] = None,
+    session_id: str = DEFAULT_SESSION_ID,
 ) -> Tuple[str, List[str]]:
-    """Stream tokens from Ollama and run TTS per sentence. Returns (full_text, audio_paths)."""
-    tail = history[1:][-HISTORY_TURNS * 2:]
-    convo = "\n".join(tail + [f"User: {user_text}", "Assistant:"])
-    use_model = model or LOCAL_CHAT_MODEL
-    extra = ""
-    if "4b" in str(use_model).lower():
-        extra = (
-            "\n出力ルール: 簡潔にし過ぎず、3〜6文で自然に。"
-            " 友達感覚で喋って。"
-            " です・ます調は極力使わないように。\n"
-        )
-    prompt = system_instruction + extra + "\n" + convo
+    """Stream tokens from Ollama and run TTS per sentence. Returns (full_text, audio_paths).
+    on_segment が指定されていれば、各文の音声ができ次第 {"index","text","audio"} で通知する。
+    再試行しても合成できなかった文は on_segment_error に {"index","text","error"} で通知する
+    （index はその文が入るはずだった audio の位置）。
+    tts_params を渡すと (styleId, overrides) を合成の直前に解決する（音声監督と会話を並行させる用）。
+    """
+    if tts_params is None:
+        async def tts_params() -> Tuple[int, Optional[Dict[str, Any]]]:
+            return tts_style_id, tts_overrides
 
-    url = f"{OLLAMA_BASE_URL}/api/generate"
-    payload = {"model": use_model, "prompt": prompt, "stream": True}
+    use_model = model or LOCAL_CHAT_MODEL
+    url, payload = _local_chat_request(user_text, use_model, await _session_turns(session_id), stream=True)
 
-    _log(f"[INFO] engine={engine_label} model={use_model} streaming start")
+    _log(f"[INFO] engine={engine_label} model={use_model} api={OLLAMA_CHAT_API} streaming start")
     full_text = ""
-    buffer = ""
+    segmenter = _Segmenter()
     audio_paths: List[str] = []
     fallback_reason: Optional[str] = None
 
-    try:
-        with requests.post(url, json=payload, stream=True, timeout=300) as resp:
-            resp.raise_for_status()
-            resp.encoding = "utf-8"
-            for line in resp.iter_lines(decode_unicode=True):
-                if not line:
-                    continue
+    def _emit(seg_text: str, audio_url: str) -> None:
+        if on_segment is None:
+            return
+        try:
+            on_segment({
+                "index": len(audio_paths) - 1, "text": seg_text, "audio": audio_url,
+                "lipsync": _lipsync_lookup(audio_url),
+            })
+        except Exception as e:
+            _log(f"[ERR] engine={engine_label} on_segment callback failed: {e}")
+
+    def _on_tts_result(res: "_TTSResult") -> None:
+        # collector タスクから投入順に呼ばれる
+        nonlocal fallback_reason
+        if res.path is not None:
+            if not audio_paths:
+                record_since_request_start("first_audio")
+            audio_paths.append(f"/audio/{res.path.name}")
+            _emit(res.text, audio_paths[-1])
+        else:
+            fallback_reason = fallback_reason or "segment_fail"
+            if on_segment_error is not None:
                 try:
-                    data = json.loads(line)
-                except Exception:
-                    continue
-                token = str(data.get("response", ""))
-                if token:
-                    full_text += token
-                    buffer += token
-                    segs, buffer = _split_sentences(buffer)
-                    for seg in segs:
-                        try:
-                            path = coeiroink_tts(seg, style_id=tts_style_id, tts_overrides=tts_overrides)
-                            audio_paths.append(f"/audio/{path.name}")
-                            _log(f"[INFO] engine={engine_label} segment_tts ok text='{seg[:40]}' file='{path.name}'")
-                        except Exception as e:
-                            _log(f"[ERR] engine={engine_label} segment_tts fail text='{seg[:40]}' err={e}")
-                            fallback_reason = fallback_reason or "segment_fail"
-                if data.get("done"):
-                    break
+                    on_segment_error({"index": len(audio_paths), "text": res.text, "error": res.error or "synthesis failed"})
+                except Exception as e:
+                    _log(f"[ERR] engine={engine_label} on_segment_error callback failed: {e}")
+
+    pipeline = _TTSPipeline(
+        params=tts_params,
+        engine_label=engine_label,
+        on_result=_on_tts_result,
+    )
+
+    t_llm = time.perf_counter()
+    llm_ok = False
+    try:
+        async with admission["ollama"].slot(), breakers["ollama"]:
+            async with _http_stream(url, json=payload, timeout=300) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except Exception:
+                        continue
+                    token = _ollama_text(data)
+                    if token:
+                        if not full_text:
+                            record_stage("llm_ttft", (time.perf_counter() - t_llm) * 1000)
+                        full_text += token
+                        for seg in segmenter.feed(token):
+                            # キューが埋まっている間はここで待つ（back-pressure）
+                            await pipeline.submit(seg)
+                    if data.get("done"):
+                        break
+        llm_ok = True
+    except AdmissionRejected:
+        # 混雑で1トークンも読めなかった（枠を待つ間に読み始めることはない）→ 応答全体を 429/503 にする
+        await pipeline.close()
+        raise
     except Exception as e:
         _log(f"[LOCAL_CHAT][ERR][stream] engine={engine_label} {e}")
+        metrics.inc("errors_total", stage="llm")
         if not full_text:
             full_text = "…（ローカルLLMに接続できませんでした）"
+    # TTS の back-pressure で待たされた時間も含む（トークンを読み終えるまで）
+    record_stage("llm", (time.perf_counter() - t_llm) * 1000, llm_ok)
 
-    last = buffer.strip()
-    if last:
-        try:
-            path = coeiroink_tts(last, style_id=tts_style_id, tts_overrides=tts_overrides)
-            audio_paths.append(f"/audio/{path.name}")
-            _log(f"[INFO] engine={engine_label} segment_tts ok (final) text='{last[:40]}' file='{path.name}'")
-        except Exception as e:
-            _log(f"[ERR] engine={engine_label} segment_tts final fail text='{last[:40]}' err={e}")
-            fallback_reason = fallback_reason or "segment_fail"
+    for seg in segmenter.flush():
+        await pipeline.submit(seg)
+    await pipeline.close()
 
     if not full_text.strip():
         full_text = "（空の応答）"
     if not audio_paths:
         fallback_reason = fallback_reason or "no_audio"
 
-    if fallback_reason and full_text.strip():
+    if fallback_reason and on_segment is not None and audio_paths:
+        # ストリーミング中は既に再生済みの文があるので、全文の再合成はしない（欠けた文は segment_error で通知済み）
+        _log(f"[WARN] engine={engine_label} fallback skipped (streaming) reason={fallback_reason}")
+    elif fallback_reason and full_text.strip():
         try:
             _log(f"[WARN] engine={engine_label} fallback full_tts start reason={fallback_reason}")
-            if audio_paths:
-                for prev in list(audio_paths):
-                    try:
-                        prev_name = prev.split("/")[-1]
-                        if prev_name:
-                            (OUT_DIR / prev_name).unlink(missing_ok=True)
-                    except Exception:
-                        pass
-            path = coeiroink_tts(full_text, style_id=tts_style_id, tts_overrides=tts_overrides)
+            metrics.inc("fallbacks_total", kind="full_tts")
+            for prev in list(audio_paths):
+                await _run_blocking(_discard_audio, prev)
+            style_id, overrides = await tts_params()
+            path = await coeiroink_tts(full_text, style_id=style_id, tts_overrides=overrides)
+            await lipsync_for(path)
             audio_paths = [f"/audio/{path.name}"]
             _log(f"[WARN] engine={engine_label} fallback full_tts ok file='{path.name}'")
+            _emit(full_text, audio_paths[-1])
+        except AdmissionRejected:
+            raise
         except Exception as e:
             _log(f"[ERR] engine={engine_label} fallback full_tts fail reason={fallback_reason}: {e}")
 
-    history.append(f"User: {user_text}")
-    history.append(f"Gemini: {full_text}")
-    try:
-        with open(BASE_DIR.parent / "chat_history.txt", "a", encoding="utf-8") as f:
-            f.write(f"あなた: {user_text}\n")
-            f.write(f"Local: {full_text}\n\n")
-    except Exception:
-        pass
+    await _session_append(session_id, user_text, full_text)
+    _append_chat_history(session_id, "Local", user_text, full_text)
+
+    _log(f"[INFO] engine={engine_label} streaming done text_len={len(full_text)} segs={len(audio_paths)}")
+    return full_text, audio_paths
+
+# ==========================
+# 音声監督・ポーズの結果キャッシュ（同じ・よく似た発話では背景 LLM を呼ばない）
+# ==========================
+DIRECTOR_CACHE_ENABLED = _env_flag("DIRECTOR_CACHE", True)
+DIRECTOR_CACHE_MAX = int(os.getenv("DIRECTOR_CACHE_MAX", "2000"))
+DIRECTOR_CACHE_TTL_SEC = float(os.getenv("DIRECTOR_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+DIRECTOR_CACHE_PATH = os.getenv("DIRECTOR_CACHE_PATH", str(OUT_DIR / "director_cache.json"))  # 空なら保存しない
+DIRECTOR_CACHE_SAVE_SEC = float(os.getenv("DIRECTOR_CACHE_SAVE_SEC", "60"))
+# 任意: 完全一致で外れたら埋め込みの類似度で「ほぼ同じ発話」も当てる（Ollama の埋め込みモデル名。空なら無効）
+DIRECTOR_CACHE_EMBED_MODEL = os.getenv("DIRECTOR_CACHE_EMBED_MODEL", "").strip()
+DIRECTOR_CACHE_MIN_SIM = float(os.getenv("DIRECTOR_CACHE_MIN_SIM", "0.93"))
+DIRECTOR_CACHE_EMBED_TIMEOUT = float(os.getenv("DIRECTOR_CACHE_EMBED_TIMEOUT", "2"))
+
+
+def _normalize_utterance(text: str) -> str:
+    """NFKC・小文字化し、句読点と空白を落とす（「おはよう！」「おはよう 。」「ｵﾊﾖｳ」の表記ゆれを寄せる）。"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(ch for ch in text if not ch.isspace() and not unicodedata.category(ch).startswith("P"))
+
+
+class _DirectorCache:
+    """(種類, 正規化した発話) → 監督/ポーズの結果。TTL と LRU で捨て、JSON に退避/復元する。
+
+    LLM が実際に返した結果だけを put する（キーワード推定などのフォールバックは入れない）。
+    埋め込み tier では、完全一致で外れたときのベクトルを覚えておき、put でそのまま索引に足す。
+    """
+
+    def __init__(self, *, max_entries: int, ttl_sec: float, path: Optional[Path]):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.path = path
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()  # key → (値の JSON, 作成時刻)
+        self._vectors: Dict[str, List[float]] = {}  # key → 単位ベクトル
+        self._pending: "OrderedDict[str, List[float]]" = OrderedDict()  # 外れたキーのベクトル（put 待ち）
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits: Dict[Tuple[str, str], int] = {}  # (種類, exact|semantic) → 件数
+        self.misses: Dict[str, int] = {}
+
+    @staticmethod
+    def key(kind: str, *texts: str) -> str:
+        return kind + "\t" + "|".join(_normalize_utterance(t) for t in texts)
+
+    def _pop_locked(self, key: str) -> None:
+        self._entries.pop(key, None)
+        self._vectors.pop(key, None)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl_sec:
+                self._pop_locked(key)
+                self._dirty = True
+                return None
+            self._entries.move_to_end(key)
+            return json.loads(entry[0])
+
+    def nearest(self, kind: str, vec: List[float], min_sim: float) -> Optional[Any]:
+        """同じ種類の登録済み発話から、コサイン類似度が min_sim 以上で最も近いものの値を返す。"""
+        import numpy as np  # 任意依存（埋め込み tier を使うときだけ）
+
+        prefix = kind + "\t"
+        with self._lock:
+            keys = [k for k in self._vectors if k.startswith(prefix)]
+            if not keys:
+                return None
+            sims = np.asarray([self._vectors[k] for k in keys], dtype=np.float32) @ np.asarray(vec, dtype=np.float32)
+        best = int(np.argmax(sims))
+        if float(sims[best]) < min_sim:
+            return None
+        return self.get(keys[best])
+
+    def remember_vector(self, key: str, vec: List[float]) -> None:
+        with self._lock:
+            self._pending[key] = vec
+            while len(self._pending) > 256:
+                self._pending.popitem(last=False)
+
+    def put(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (json.dumps(value, ensure_ascii=False), time.time())
+            self._entries.move_to_end(key)
+            vec = self._pending.pop(key, None)
+            if vec is not None:
+                self._vectors[key] = vec
+            while len(self._entries) > self.max_entries:
+                old, _ = self._entries.popitem(last=False)
+                self._vectors.pop(old, None)
+            self._dirty = True
+
+    def record(self, kind: str, tier: Optional[str]) -> None:
+        with self._lock:
+            if tier is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+            else:
+                self.hits[(kind, tier)] = self.hits.get((kind, tier), 0) + 1
+
+    def sweep(self) -> int:
+        cutoff = time.time() - self.ttl_sec
+        with self._lock:
+            stale = [k for k, (_, created) in self._entries.items() if created < cutoff]
+            for k in stale:
+                self._pop_locked(k)
+            if stale:
+                self._dirty = True
+        return len(stale)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = [
+                {"key": k, "value": v, "created": created, "vec": self._vectors.get(k)}
+                for k, (v, created) in self._entries.items()
+            ]
+            self._dirty = False
+        tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.tmp")  # ワーカーごとに別名
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def load(self) -> None:
+        if not self.path or not self.path.exists():
+            return
+        cutoff = time.time() - self.ttl_sec
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        with self._lock:
+            for item in data:
+                if float(item.get("created", 0)) < cutoff:
+                    continue
+                self._entries[item["key"]] = (item["value"], float(item["created"]))
+                if item.get("vec"):
+                    self._vectors[item["key"]] = item["vec"]
+            while len(self._entries) > self.max_entries:
+                old, _ = self._entries.popitem(last=False)
+                self._vectors.pop(old, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            kinds = sorted({k for k, _ in self.hits} | set(self.misses))
+            out: Dict[str, Any] = {"entries": len(self._entries), "vectors": len(self._vectors)}
+            for kind in kinds:
+                exact = self.hits.get((kind, "exact"), 0)
+                semantic = self.hits.get((kind, "semantic"), 0)
+                total = exact + semantic + self.misses.get(kind, 0)
+                out[kind] = {
+                    "hits": exact, "semantic_hits": semantic, "misses": self.misses.get(kind, 0),
+                    "hit_rate": round((exact + semantic) / total, 3) if total else 0.0,
+                }
+            return out
+
+
+director_cache = _DirectorCache(
+    max_entries=DIRECTOR_CACHE_MAX,
+    ttl_sec=DIRECTOR_CACHE_TTL_SEC,
+    path=Path(DIRECTOR_CACHE_PATH) if DIRECTOR_CACHE_PATH else None,
+)
+
+
+async def _embed_utterance(text: str) -> Optional[List[float]]:
+    """Ollama の埋め込み（単位ベクトル）。失敗しても会話には影響させない（ブレーカーにも数えない）。"""
+    if breakers["ollama"].is_open():
+        return None
+    try:
+        resp = await _http_post(
+            f"{OLLAMA_BASE_URL}/api/embed",
+            json={"model": DIRECTOR_CACHE_EMBED_MODEL, "input": text, "keep_alive": OLLAMA_KEEP_ALIVE},
+            timeout=DIRECTOR_CACHE_EMBED_TIMEOUT,
+        )
+        resp.raise_for_status()
+        vec = [float(v) for v in resp.json()["embeddings"][0]]
+    except Exception as e:
+        _log(f"[WARN] director cache embed failed: {e}")
+        return None
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [round(v / norm, 5) for v in vec]
+
+
+async def _director_cache_get(kind: str, *texts: str, semantic: bool = True) -> Optional[Any]:
+    """当たれば保存済みの値（毎回新しいコピー）。外れたら None（LLM の結果は _director_cache_put で足す）。"""
+    if not DIRECTOR_CACHE_ENABLED:
+        return None
+    key = _DirectorCache.key(kind, *texts)
+    hit = director_cache.get(key)
+    if hit is None and shared_state is not None:
+        hit = await _run_blocking(_director_shared_get, key)
+    if hit is not None:
+        director_cache.record(kind, "exact")
+        return hit
+    if semantic and DIRECTOR_CACHE_EMBED_MODEL:
+        vec = await _embed_utterance(" ".join(texts))
+        if vec is not None:
+            try:
+                hit = director_cache.nearest(kind, vec, DIRECTOR_CACHE_MIN_SIM)
+            except ImportError:
+                hit = None
+            director_cache.remember_vector(key, vec)
+            if hit is not None:
+                director_cache.record(kind, "semantic")
+                return hit
+    director_cache.record(kind, None)
+    return None
+
+
+def _director_cache_put(value: Any, kind: str, *texts: str) -> None:
+    if DIRECTOR_CACHE_ENABLED:
+        key = _DirectorCache.key(kind, *texts)
+        director_cache.put(key, value)
+        if shared_state is not None:
+            _spawn(_run_blocking(_director_shared_put, key, value))
+
+
+# STATE_BACKEND=redis では完全一致の結果をワーカー間で共有する（埋め込みの索引はワーカーごと）
+def _director_shared_key(key: str) -> str:
+    return shared_state.key("director", hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def _director_shared_get(key: str) -> Optional[Any]:
+    try:
+        raw = shared_state.client.get(_director_shared_key(key))
+    except Exception as e:
+        _log(f"[ERR] director cache shared get failed: {e}")
+        return None
+    if raw is None:
+        return None
+    value = json.loads(raw)
+    director_cache.put(key, value)  # put は JSON 文字列で持つので、呼び出し側が value を書き換えても影響しない
+    return value
+
+
+def _director_shared_put(key: str, value: Any) -> None:
+    try:
+        shared_state.client.set(
+            _director_shared_key(key), json.dumps(value, ensure_ascii=False), ex=max(1, int(DIRECTOR_CACHE_TTL_SEC))
+        )
+    except Exception as e:
+        _log(f"[ERR] director cache shared put failed: {e}")
+
+
+async def _director_cache_janitor():
+    while True:
+        await asyncio.sleep(DIRECTOR_CACHE_SAVE_SEC)
+        try:
+            director_cache.sweep()
+            await _run_blocking(director_cache.save)
+        except Exception as e:
+            _log(f"[ERR] director cache janitor: {e}")
+
+
+@app.on_event("startup")
+async def _start_director_cache():
+    if not DIRECTOR_CACHE_ENABLED:
+        return
+    try:
+        await _run_blocking(director_cache.load)
+        _log(f"[INFO] director cache loaded entries={director_cache.stats()['entries']}")
+    except Exception as e:
+        _log(f"[ERR] director cache load failed: {e}")
+    _spawn(_director_cache_janitor())
+
+
+@app.on_event("shutdown")
+def _save_director_cache():
+    if DIRECTOR_CACHE_ENABLED:
+        try:
+            director_cache.save()
+        except Exception as e:
+            _log(f"[ERR] director cache save failed: {e}")
+
+
+@metrics.collector
+def _director_cache_metrics():
+    yield "director_cache_entries", "gauge", {}, len(director_cache._entries)
+    for (kind, tier), n in list(director_cache.hits.items()):
+        yield "director_cache_hits_total", "counter", {"kind": kind, "tier": tier}, n
+    for kind, n in list(director_cache.misses.items()):
+        yield "director_cache_misses_total", "counter", {"kind": kind}, n
+
+
+@app.get("/api/director/cache")
+def director_cache_stats():
+    return director_cache.stats()
+
+# ==========================
+# TTS パラメータ自動決定（基本: Gemma via Ollama、フォールバック: Gemini）
+# ==========================
+VOICE_DIRECTOR_PROMPT = """あなたはTTS音声監督。ユーザー発話の感情・文脈から、以下のJSONだけを厳密に出力して。
+- styleId: 次の集合のいずれかだけ [1,7,40,41,42,43,44,45,46,47]
+- speedScale: 0.7〜1.4 の小数
+- volumeScale: 0.8〜1.3 の小数
+- pitchScale: -0.3〜0.3 の小数
+- intonationScale: 0.8〜1.6 の小数
+- prePhonemeLength: 0.05〜0.15 の小数
+- postPhonemeLength: 0.35〜0.7 の小数
+- outputSamplingRate: 24000 または 48000
+- reason: 50字以内の短い説明（ログ用）
+
+出力は JSON オブジェクト1個のみ。説明や前置きは一切なし。"""
+
+def _clamp(v, lo, hi, default):
+    try:
+        v = float(v)
+    except Exception:
+        return default
+    return max(lo, min(hi, v))
+
+
+def _keyword_style(user_text: str) -> int:
+    """キーワードだけで決める軽量なスタイル推定（LLM が使えない/外したとき用）"""
+    low = user_text.lower()
+    if any(k in low for k in ["内緒", "ないしょ", "ひそひそ"]):
+        return 43
+    if any(k in low for k in ["楽しい", "最高", "嬉", "やった", "草", "ｗ"]):
+        return 40
+    if any(k in low for k in ["しょんぼり", "悲", "落ち込", "ごめん"]):
+        return 42
+    if any(k in low for k in ["怒", "ムカ", "ふくれ"]):
+        return 41
+    return 1
+
+
+def _normalize_tts_params(obj: Dict[str, Any], style_id: int, reason_default: str) -> Dict[str, Any]:
+    try:
+        rate = 48000 if int(obj.get("outputSamplingRate", 24000)) == 48000 else 24000
+    except Exception:
+        rate = 24000
+    return {
+        "styleId": int(style_id),
+        "speedScale": _clamp(obj.get("speedScale", 1.0), 0.7, 1.4, 1.0),
+        "volumeScale": _clamp(obj.get("volumeScale", 1.0), 0.8, 1.3, 1.0),
+        "pitchScale": _clamp(obj.get("pitchScale", 0.0), -0.3, 0.3, 0.0),
+        "intonationScale": _clamp(obj.get("intonationScale", 1.0), 0.8, 1.6, 1.0),
+        "prePhonemeLength": _clamp(obj.get("prePhonemeLength", 0.1), 0.05, 0.15, 0.1),
+        "postPhonemeLength": _clamp(obj.get("postPhonemeLength", 0.5), 0.35, 0.7, 0.5),
+        "outputSamplingRate": rate,
+        "reason": str(obj.get("reason", reason_default))
+    }
+
+
+def _keyword_tts(user_text: str) -> Dict[str, Any]:
+    # ネットワークを使わない最後の手段（キーワードでスタイルだけ決め、他は既定値）
+    return _normalize_tts_params({}, _keyword_style(user_text), "キーワード推定")
+
+
+async def _gemini_choose_tts(user_text: str) -> Dict[str, Any]:
+    """Gemini の答えだけを返す。使えない・答えが壊れているときは例外（hedge の backup 用）。"""
+    async with breakers["gemini"]:
+        res = await gemini_client().aio.models.generate_content(
+            model="gemini-2.5-flash",
+            contents=[VOICE_DIRECTOR_PROMPT, f"ユーザー発話:{user_text}"]
+        )
+    obj = json.loads(getattr(res, "text", "").strip())
+    style_id = obj.get("styleId") if isinstance(obj, dict) else None
+    if style_id not in VALID_STYLE_IDS:
+        raise ValueError(f"invalid styleId: {style_id!r}")
+    tts = _normalize_tts_params(obj, style_id, "推定で選択")
+    _director_cache_put(tts, "tts", user_text)
+    _log_director_decision(user_text, tts, "gemini")
+    return tts
+
+
+async def gemini_choose_tts(user_text: str) -> Dict[str, Any]:
+    """Gemini で音声パラメータを決める。Gemini が使えなければキーワード推定を返す（例外は出さない）。"""
+    if breakers["gemini"].is_open():
+        return _keyword_tts(user_text)
+    try:
+        return await _gemini_choose_tts(user_text)
+    except Exception as e:
+        _log(f"[ERR][GEMINI] choose_tts: {e}")
+        return _keyword_tts(user_text)
+
+# ==========================
+# 背景LLM（Gemma via Ollama）でTTSとポーズを決める
+# 失敗時は従来のロジックにフォールバック
+
+async def _ollama_generate(prompt: str, *, fmt: Optional[Any] = None) -> str:
+    """fmt に "json" か JSON Schema を渡すと Ollama の format で出力を拘束する。"""
+    try:
+        url = f"{OLLAMA_BASE_URL}/api/generate"
+        body: Dict[str, Any] = {
+            "model": OLLAMA_MODEL, "prompt": prompt, "stream": False, "keep_alive": OLLAMA_KEEP_ALIVE,
+        }
+        if fmt is not None:
+            body["format"] = fmt
+        async with admission["ollama"].slot(), breakers["ollama"]:
+            resp = await _http_post(url, json=body, timeout=60)
+            resp.raise_for_status()
+        data = resp.json()
+        return str(data.get("response", "")).strip()
+    except Exception as e:
+        _log(f"[OLLAMA][ERR] {e}")
+        raise
+
+# 音声監督の hedge: Ollama がこの秒数で返らなければ Gemini にも同じ依頼を投げ、早い方を使う（0 で無効）
+DIRECTOR_HEDGE_SEC = float(os.getenv("DIRECTOR_HEDGE_MS", "0")) / 1000
+
+
+async def _gemma_choose_tts(user_text: str) -> Dict[str, Any]:
+    prompt = VOICE_DIRECTOR_PROMPT + "\nユーザー発話:" + user_text
+    obj = json.loads(await _ollama_generate(prompt))
+    style_id = obj.get("styleId") if isinstance(obj, dict) else None
+    if style_id not in VALID_STYLE_IDS:
+        raise ValueError(f"invalid styleId: {style_id!r}")
+    tts = _normalize_tts_params(obj, style_id, "ollama-gemma 推定")
+    _director_cache_put(tts, "tts", user_text)
+    _log_director_decision(user_text, tts, "gemma")
+    return tts
+
+
+async def choose_tts_by_gemma(user_text: str) -> Dict[str, Any]:
+    cached = await _director_cache_get("tts", user_text)
+    if cached is not None:
+        return cached
+    if breakers["ollama"].is_open():
+        # Ollama が落ちているとわかっている間は Gemini にも行かずキーワード推定で即答する
+        metrics.inc("fallbacks_total", kind="director_keyword")
+        return _keyword_tts(user_text)
+    try:
+        if DIRECTOR_HEDGE_SEC > 0:
+            # backup はキーワード推定に逃げず例外を出す版（逃げると遅い Ollama の正しい答えを取り消してしまう）
+            return await _hedged(
+                lambda: _gemma_choose_tts(user_text),
+                lambda: _gemini_choose_tts(user_text),
+                DIRECTOR_HEDGE_SEC,
+                "director",
+            )
+        return await _gemma_choose_tts(user_text)
+    except Exception:
+        # フォールバック: 既存Geminiロジック
+        metrics.inc("fallbacks_total", kind="director_gemini")
+        return await gemini_choose_tts(user_text)
+
+POSE_TIMELINE_PROMPT = (
+    "あなたは3Dアバターのモーション生成AIです。JSONのみ出力してください。\n"
+    "形式: {\"head\":{\"timeline\":[[t,y], ...]}} tは0..1昇順、yは-0.6..0.6(ラジアン)。\n"
+    "終端は0付近に戻す。説明は一切不要。\n"
+)
+
+
+def _clean_pose_timeline(obj: Any) -> Optional[Dict[str, Any]]:
+    tl = (((obj or {}).get("head") or {}).get("timeline")) if isinstance(obj, dict) else None
+    if isinstance(tl, list) and tl:
+        cleaned = []
+        for kp in tl:
+            if isinstance(kp, (list, tuple)) and len(kp) == 2:
+                try:
+                    t = float(kp[0]); y = float(kp[1])
+                except Exception:
+                    continue
+                t = max(0.0, min(1.0, t))
+                y = max(-0.6, min(0.6, y))
+                cleaned.append([t, y])
+        if cleaned:
+            cleaned.sort(key=lambda x: x[0])
+            return {"head": {"timeline": cleaned}}
+    return None
+
+
+async def pose_timeline_by_gemma(user_text: str) -> Dict[str, Any]:
+    cached = await _director_cache_get("pose", user_text)
+    if cached is not None:
+        return cached
+    try:
+        txt = await _ollama_generate(POSE_TIMELINE_PROMPT + "ユーザー発話:" + user_text)
+        pose = _clean_pose_timeline(json.loads(txt))
+        if pose is not None:
+            _director_cache_put(pose, "pose", user_text)
+            return pose
+    except Exception as e:
+        _log(f"[POSE][OLLAMA][ERR] {e}")
+
+    metrics.inc("fallbacks_total", kind="pose")
+    return _fallback_pose()
+
+
+def _fallback_pose() -> Dict[str, Any]:
+    # フォールバック: 適度な小振りのタイムライン
+    return {"head": {"timeline": [[0.0, 0.0],[0.25, 0.15],[0.6, -0.1],[1.0, 0.0]]}}
+
+# --------------------------
+# 統合ディレクター: TTSパラメータと首のタイムラインを1回の Ollama 呼び出しで決める
+#   DIRECTOR_MODE=combined（既定）… 1回の呼び出し（format に JSON Schema を指定）
+#   DIRECTOR_MODE=split          … 従来どおり choose_tts_by_gemma / pose_timeline_by_gemma を別々に
+# --------------------------
+DIRECTOR_MODE = os.getenv("DIRECTOR_MODE", "combined").lower()
+
+COMBINED_DIRECTOR_PROMPT = """あなたはTTS音声監督 兼 3Dアバターのモーション担当。発話の感情・文脈から、以下のJSONだけを厳密に出力して。
+- styleId: 次の集合のいずれかだけ [1,7,40,41,42,43,44,45,46,47]
+- speedScale: 0.7〜1.4 の小数
+- volumeScale: 0.8〜1.3 の小数
+- pitchScale: -0.3〜0.3 の小数
+- intonationScale: 0.8〜1.6 の小数
+- prePhonemeLength: 0.05〜0.15 の小数
+- postPhonemeLength: 0.35〜0.7 の小数
+- outputSamplingRate: 24000 または 48000
+- reason: 50字以内の短い説明（ログ用）
+- head.timeline: [[t,y], ...] tは0..1昇順、yは-0.6..0.6(ラジアン)。終端は0付近に戻す
+
+出力は JSON オブジェクト1個のみ。説明や前置きは一切なし。"""
+
+COMBINED_DIRECTOR_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "styleId": {"type": "integer", "enum": sorted(VALID_STYLE_IDS)},
+        "speedScale": {"type": "number"},
+        "volumeScale": {"type": "number"},
+        "pitchScale": {"type": "number"},
+        "intonationScale": {"type": "number"},
+        "prePhonemeLength": {"type": "number"},
+        "postPhonemeLength": {"type": "number"},
+        "outputSamplingRate": {"type": "integer", "enum": [24000, 48000]},
+        "reason": {"type": "string"},
+        "head": {
+            "type": "object",
+            "properties": {
+                "timeline": {
+                    "type": "array",
+                    "items": {"type": "array", "items": {"type": "number"}, "minItems": 2, "maxItems": 2},
+                },
+            },
+            "required": ["timeline"],
+        },
+    },
+    "required": ["styleId", "speedScale", "volumeScale", "pitchScale", "intonationScale", "head"],
+}
+
+
+async def direct_by_gemma(user_text: str, reply_text: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(tts, pose) を1回の呼び出しで返す。壊れた項目は項目ごとに既定値へ落とす。"""
+    # 返答込みの依頼は返答ごとに結果が変わるので、埋め込みの近似一致は使わず完全一致だけ
+    cached = await _director_cache_get("combined", user_text, reply_text or "", semantic=not reply_text)
+    if cached is not None:
+        return cached["tts"], cached["pose"]
+    prompt = COMBINED_DIRECTOR_PROMPT + "\nユーザー発話:" + user_text
+    if reply_text:
+        prompt += "\nアバターの返答:" + reply_text
+
+    async def _gemma() -> Dict[str, Any]:
+        obj = json.loads(await _ollama_generate(prompt, fmt=COMBINED_DIRECTOR_SCHEMA))
+        if not isinstance(obj, dict):
+            raise ValueError("director output is not an object")
+        return obj
+
+    async def _gemini() -> Dict[str, Any]:
+        async with breakers["gemini"]:
+            res = await gemini_client().aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[prompt],
+                config={"response_mime_type": "application/json"},
+            )
+        obj = json.loads(getattr(res, "text", ""))
+        # hedge の backup なので、キーワード推定に落ちる答えは負けにして primary を待たせる
+        if not isinstance(obj, dict) or obj.get("styleId") not in VALID_STYLE_IDS:
+            raise ValueError("director output has no valid styleId")
+        return obj
+
+    obj: Dict[str, Any] = {}
+    if not breakers["ollama"].is_open():
+        try:
+            if DIRECTOR_HEDGE_SEC > 0 and not breakers["gemini"].is_open():
+                obj = await _hedged(_gemma, _gemini, DIRECTOR_HEDGE_SEC, "director")
+            else:
+                obj = await _gemma()
+        except Exception as e:
+            _log(f"[DIRECTOR][OLLAMA][ERR] {e}")
+
+    if not obj:
+        metrics.inc("fallbacks_total", kind="director_keyword")
+    src = reply_text or user_text
+    style_id = obj.get("styleId")
+    if style_id not in VALID_STYLE_IDS:
+        style_id = _keyword_style(src)
+    tts = _normalize_tts_params(obj, style_id, "ollama-gemma 統合推定" if obj else "キーワード推定")
+    pose = _clean_pose_timeline(obj) or _fallback_pose()
+    if obj:
+        _director_cache_put({"tts": tts, "pose": pose}, "combined", user_text, reply_text or "")
+        _log_director_decision(src, tts, "combined")
+    return tts, pose
+
+# ==========================
+# 音声監督の一次判定（ローカル分類器）
+#   文字 n-gram（ハッシュ）＋線形モデルで styleId を CPU だけで即答する。確信度が低いときだけ LLM の監督に回す。
+#   モデルは backend/train_director.py で監督ログ（DIRECTOR_LOG_JSONL）や監督キャッシュから学習して書き出す。
+# ==========================
+DIRECTOR_CLASSIFIER_ENABLED = _env_flag("DIRECTOR_CLASSIFIER", True)  # モデルファイルが無ければ何もしない
+DIRECTOR_CLASSIFIER_PATH = os.getenv("DIRECTOR_CLASSIFIER_PATH", str(LOG_DIR / "director_model.npz"))
+DIRECTOR_CLASSIFIER_MIN_CONF = float(os.getenv("DIRECTOR_CLASSIFIER_MIN_CONF", "0.75"))
+_CLASSIFIER_MAX_CHARS = 200  # 長い返答は頭だけで判定する（判定時間を一定に保つ）
+
+
+def _char_ngrams(text: str, *, n_max: int, buckets: int) -> Tuple[List[int], List[float]]:
+    """NFKC・小文字化した文字列の 1..n_max 文字 n-gram をハッシュして (列番号, 重み) を返す。
+
+    重みは 1+log(出現数) を L2 正規化したもの。ハッシュは実行ごとに変わらない crc32 を使う。
+    """
+    s = unicodedata.normalize("NFKC", text or "").lower()
+    s = "\x02" + "".join(ch for ch in s[:_CLASSIFIER_MAX_CHARS] if not ch.isspace()) + "\x03"
+    counts: Dict[int, int] = {}
+    for n in range(1, n_max + 1):
+        for i in range(len(s) - n + 1):
+            h = zlib.crc32(s[i:i + n].encode("utf-8")) % buckets
+            counts[h] = counts.get(h, 0) + 1
+    idx = list(counts)
+    vals = [1.0 + math.log(c) for c in counts.values()]
+    norm = math.sqrt(sum(v * v for v in vals)) or 1.0
+    return idx, [v / norm for v in vals]
+
+
+class _StyleClassifier:
+    """多クラスのロジスティック回帰（重み W: クラス数×バケット数）。
+
+    styleId を決め、数値パラメータ（話速など）は学習データでそのスタイルに付いていた値の平均を使う。
+    """
+
+    def __init__(self, W: Any, b: Any, classes: List[int], params: Any, meta: Dict[str, Any]):
+        self.W = W
+        self.b = b
+        self.classes = [int(c) for c in classes]
+        self.params = params  # クラス数×len(_TTS_PARAM_KEYS)
+        self.meta = meta
+        self.n_max = int(meta.get("n_max", 3))
+        self.buckets = int(meta.get("buckets", W.shape[1]))
+
+    @classmethod
+    def load(cls, path: Path) -> "_StyleClassifier":
+        import numpy as np  # 任意依存: pip install numpy
+
+        with np.load(path, allow_pickle=False) as z:
+            meta = json.loads(str(z["meta"]))
+            return cls(z["W"], z["b"], z["classes"].tolist(), z["params"], meta)
+
+    def save(self, path: Path) -> None:
+        import numpy as np
+
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.savez_compressed(
+                f, W=self.W, b=self.b, classes=np.asarray(self.classes), params=self.params,
+                meta=np.asarray(json.dumps(self.meta, ensure_ascii=False)),
+            )
+        os.replace(tmp, path)
+
+    def predict_proba(self, text: str) -> Any:
+        import numpy as np
+
+        idx, vals = _char_ngrams(text, n_max=self.n_max, buckets=self.buckets)
+        z = self.W[:, idx] @ np.asarray(vals, dtype=self.W.dtype) + self.b
+        e = np.exp(z - z.max())
+        return e / e.sum()
+
+    def predict(self, text: str) -> Tuple[int, float, int]:
+        """(styleId, 確信度, クラス番号)"""
+        p = self.predict_proba(text)
+        k = int(p.argmax())
+        return self.classes[k], float(p[k]), k
+
+    def tts_params(self, text: str) -> Tuple[Dict[str, Any], float]:
+        style_id, conf, k = self.predict(text)
+        obj = dict(zip(_TTS_PARAM_KEYS, (round(float(v), 3) for v in self.params[k])))
+        obj["outputSamplingRate"] = 48000 if obj["outputSamplingRate"] >= 36000 else 24000
+        return _normalize_tts_params(obj, style_id, f"ローカル分類器 (p={conf:.2f})"), conf
+
+
+_classifier_lock = threading.Lock()
+_classifier: Optional[_StyleClassifier] = None
+_classifier_mtime = 0.0  # 読み込んだモデルの更新時刻（学習し直したら次の判定で読み直す）
+
+
+def director_classifier() -> Optional[_StyleClassifier]:
+    global _classifier, _classifier_mtime
+    if not DIRECTOR_CLASSIFIER_ENABLED or not DIRECTOR_CLASSIFIER_PATH:
+        return None
+    path = Path(DIRECTOR_CLASSIFIER_PATH)
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None
+    if _classifier is not None and mtime == _classifier_mtime:
+        return _classifier
+    with _classifier_lock:
+        if _classifier is None or mtime != _classifier_mtime:
+            try:
+                _classifier = _StyleClassifier.load(path)
+                _log(f"[INFO] director classifier loaded: {path} classes={_classifier.classes}")
+            except Exception as e:
+                _log(f"[ERR] director classifier load failed: {e}")
+                _classifier = None
+            _classifier_mtime = mtime
+    return _classifier
+
+
+def classify_tts(text: str) -> Optional[Dict[str, Any]]:
+    """確信度が DIRECTOR_CLASSIFIER_MIN_CONF 以上なら TTS パラメータ、そうでなければ None（LLM に回す）。"""
+    clf = director_classifier()
+    if clf is None or not text:
+        return None
+    t0 = time.perf_counter()
+    try:
+        tts, conf = clf.tts_params(text)
+    except Exception as e:
+        _log(f"[ERR] director classifier: {e}")
+        return None
+    metrics.observe("director_classifier_ms", (time.perf_counter() - t0) * 1000)
+    confident = conf >= DIRECTOR_CLASSIFIER_MIN_CONF
+    metrics.inc("director_classifier_total", result="confident" if confident else "escalated")
+    return tts if confident else None
+
+
+def _log_director_decision(text: str, tts: Dict[str, Any], source: str) -> None:
+    """LLM の監督が決めた結果を学習用に JSONL で残す（DIRECTOR_LOG_JSONL=1 のとき）。"""
+    if DIRECTOR_LOG_JSONL and text:
+        rec = {"ts": time.time(), "source": source, "text": text, "tts": tts}
+        log_writer.write(DIRECTOR_LOG_JSONL_FILE, json.dumps(rec, ensure_ascii=False) + "\n")
+
+# 後方互換: /api/pose は 0 を返すだけ（フロントはもう使わない方針）
+@app.api_route("/api/pose", methods=["GET", "POST"])
+def api_pose_compat():
+    return {"head": {"y": 0.0}}
+
+
+# 独立したLLM呼び出し（pose / 音声監督 / 会話）を並行に走らせるときの締め切り
+POSE_DEADLINE_SEC = float(os.getenv("POSE_DEADLINE_SEC", "20"))
+DIRECTOR_DEADLINE_SEC = float(os.getenv("DIRECTOR_DEADLINE_SEC", "20"))
+
+_TTS_PARAM_KEYS = (
+    "speedScale",
+    "volumeScale",
+    "pitchScale",
+    "intonationScale",
+    "prePhonemeLength",
+    "postPhonemeLength",
+    "outputSamplingRate",
+)
+
+
+async def _with_deadline(aw: Awaitable[Any], timeout: float, fallback: Any, label: str) -> Any:
+    """aw を締め切り付きで待つ。時間切れ・例外のときは fallback を返す。"""
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        _log(f"[WARN] {label} deadline exceeded ({timeout:.1f}s), using fallback")
+    except Exception as e:
+        _log(f"[ERR] {label} failed, using fallback: {e}")
+    metrics.inc("fallbacks_total", kind=f"{label}_deadline")
+    return fallback
+
+
+async def _run_chat_request(
+    user_text: str,
+    styleId: Optional[int],
+    autoMode: Optional[str],
+    poseMode: Optional[str],
+    chatEngine: Optional[str],
+    on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    session_id: str = DEFAULT_SESSION_ID,
+) -> Dict[str, Any]:
+    """会話・音声監督・ポーズを依存関係どおりに並行実行する。
+
+    - pose は user_text だけに依存するので最初に投げておき、最後に締め切り付きで合流する。
+    - local + auto は音声監督と会話ストリームを同時に始め、最初の文の合成だけ監督の結果を待つ。
+    - cloud + auto は監督が返答本文に依存するので、返答 → 監督 → TTS の順のまま。
+    - DIRECTOR_MODE=combined の auto では監督とポーズを1回の呼び出し（direct_by_gemma）で決める。
+    - 監督はまずローカル分類器に聞き、確信度が低いときだけ LLM に回す（即答したらポーズだけ別に決める）。
+    on_event を渡すと segment / pose を準備でき次第イベントとして通知する（ストリーミング用）。
+    """
+    engine = (str(chatEngine).lower() if chatEngine is not None else "")
+    auto = _parse_bool(autoMode)
+    chosen_style = RESOLVED_STYLE_ID
+    tts_overrides = None
+    engine_name = engine or "cloud"
+    _log(f"[INFO] processing request engine={engine_name} auto={auto}")
+
+    def _notify(kind: str, body: Dict[str, Any]) -> None:
+        if on_event is not None:
+            on_event({"type": kind, **body})
+
+    if styleId is not None and int(styleId) in VALID_STYLE_IDS:
+        manual_style = int(styleId)
+    else:
+        manual_style = chosen_style if chosen_style is not None else (STYLE_PRESETS[0]["id"] if STYLE_PRESETS else None)
+
+    def _apply_auto_params(tts: Optional[Dict[str, Any]]) -> None:
+        nonlocal chosen_style, tts_overrides
+        if not tts:
+            # 監督が締め切りに間に合わなければ手動モードと同じ既定値で喋る
+            chosen_style = manual_style
+            tts_overrides = None
+            return
+        chosen_style = tts["styleId"]
+        tts_overrides = {k: tts[k] for k in _TTS_PARAM_KEYS}
+
+    pose_enabled = _parse_bool(poseMode) or auto
+    # auto では TTS とポーズの両方が要るので、combined なら1回の呼び出しにまとめる
+    combined = auto and DIRECTOR_MODE == "combined"
+
+    async def _director(reply: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        with stage_span("director"):
+            quick = classify_tts(reply or user_text)
+            if quick is not None:
+                return quick, None
+            if combined:
+                res = await _with_deadline(
+                    direct_by_gemma(user_text, reply), max(DIRECTOR_DEADLINE_SEC, POSE_DEADLINE_SEC), None, "director"
+                )
+                return res if res is not None else (None, None)
+            tts = await _with_deadline(choose_tts_by_gemma(reply or user_text), DIRECTOR_DEADLINE_SEC, None, "director")
+            return tts, None
+
+    async def _pose_job() -> Dict[str, Any]:
+        with stage_span("pose"):
+            p = await _with_deadline(
+                pose_timeline_by_gemma(user_text), POSE_DEADLINE_SEC, _fallback_pose(), "pose"
+            )
+        _notify("pose", {"pose": p})
+        return p
+
+    pose_task: Optional[asyncio.Task] = None
+    if pose_enabled and not combined:
+        pose_task = _spawn(_pose_job())
+
+    director_pose: Optional[Dict[str, Any]] = None
+    audio_field: Any
+    reply_text: str
+
+    if engine in ("local", "local12", "local4", "local-4b", "local4b"):
+        resolve_tts_params: Optional[Callable[[], Awaitable[Tuple[int, Optional[Dict[str, Any]]]]]] = None
+        if auto:
+            director_task = _spawn(_director())
+
+            async def _resolve_auto_tts_params() -> Tuple[int, Optional[Dict[str, Any]]]:
+                _apply_auto_params((await director_task)[0])
+                return chosen_style or RESOLVED_STYLE_ID or STYLE_PRESETS[0]["id"], tts_overrides
+
+            resolve_tts_params = _resolve_auto_tts_params
+
+            if combined:
+                async def _pose_from_director() -> Dict[str, Any]:
+                    tts, p = await director_task
+                    if tts is not None and p is None:
+                        # 分類器が TTS を即答した: ポーズは統合監督の代わりに単独で決める
+                        return await _pose_job()
+                    p = p or _fallback_pose()
+                    _notify("pose", {"pose": p})
+                    return p
+
+                pose_task = _spawn(_pose_from_director())
+        else:
+            chosen_style = manual_style
+
+        engine_label = "local" if engine in ("local", "local12") else "local4"
+        model_to_use = LOCAL_CHAT_MODEL if engine_label == "local" else LOCAL_CHAT_MODEL_4B
+        reply_text, audio_list = await local_reply_ollama_stream(
+            user_text,
+            model=model_to_use,
+            tts_style_id=chosen_style or RESOLVED_STYLE_ID or STYLE_PRESETS[0]["id"],
+            tts_overrides=tts_overrides,
+            tts_params=resolve_tts_params,
+            engine_label=engine_label,
+            on_segment=(lambda seg: _notify("segment", seg)) if on_event is not None else None,
+            on_segment_error=(lambda seg: _notify("segment_error", seg)) if on_event is not None else None,
+            session_id=session_id,
+        )
+        if resolve_tts_params is not None:
+            # 文が1つも無かった場合でも応答の tts 欄は埋める
+            await resolve_tts_params()
+        audio_field = audio_list
+        _log(f"[INFO] engine={engine_label} streaming ready segs={len(audio_list)}")
+    else:
+        _log(f"[INFO] engine={engine_name} full reply start")
+        with stage_span("llm"):
+            reply_text = await gemini_reply(user_text, session_id)
+        _log(f"[INFO] engine={engine_name} full reply done")
+        if auto:
+            tts, director_pose = await _director(reply_text or "")
+            _apply_auto_params(tts)
+            if combined and tts is not None and director_pose is None:
+                pose_task = _spawn(_pose_job())  # 分類器が即答したのでポーズは TTS と並行に単独で決める
+        else:
+            chosen_style = manual_style
+
+        try:
+            with stage_span("tts"):
+                outpath = await coeiroink_tts(
+                    reply_text,
+                    style_id=chosen_style,
+                    tts_overrides=tts_overrides,
+                )
+            audio_field = f"/audio/{outpath.name}"
+            record_since_request_start("first_audio")
+            await lipsync_for(outpath)
+        except AdmissionRejected:
+            if pose_task is not None:
+                pose_task.cancel()
+            raise
+        except Exception as e:
+            _log(f"[ERR] engine={engine_name} synthesis error: {e}")
+            metrics.inc("errors_total", stage="tts")
+            if pose_task is not None:
+                pose_task.cancel()
+            return {"error": f"COEIROINK error: {e}", "status_code": 502}
+        if combined and pose_task is None:
+            director_pose = director_pose or _fallback_pose()
+            _notify("pose", {"pose": director_pose})
+        _notify("segment", {
+            "index": 0, "text": reply_text, "audio": audio_field, "lipsync": _lipsync_lookup(audio_field),
+        })
+
+    pose = {"head": {"timeline": [[0.0, 0.0], [1.0, 0.0]]}}
+    if pose_task is not None:
+        pose = await pose_task
+    elif combined and director_pose is not None:
+        pose = director_pose
+
+    return {
+        "text": reply_text,
+        "audio": audio_field,
+        # audio と同じ形（local は文ごとのリスト）。トラックが無い音声は null
+        "lipsync": (
+            [_lipsync_lookup(a) for a in audio_field] if isinstance(audio_field, list) else _lipsync_lookup(audio_field)
+        ),
+        "auto": auto,
+        "tts": {"styleId": chosen_style, **(tts_overrides or {})},
+        "pose": pose,
+    }
+
+
+async def _process_chat_request(
+    user_text: str,
+    styleId: Optional[int],
+    autoMode: Optional[str],
+    poseMode: Optional[str],
+    chatEngine: Optional[str],
+    on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    session_id: str = DEFAULT_SESSION_ID,
+    timings: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """_run_chat_request を計測付きで実行し、応答に timings（段階別 ms）と steps（表示用）を付ける。
+    timings を渡すと STT など手前の段階の計測に続けて記録する。
+    """
+    timings = _begin_request_timings(timings if timings is not None else _request_timings.get())
+    _request_session.set(session_id)
+    metrics.inc("requests_total", engine=(str(chatEngine).lower() if chatEngine else "cloud"))
+    try:
+        with stage_span("total"):
+            result = await _run_chat_request(
+                user_text, styleId, autoMode, poseMode, chatEngine, on_event=on_event, session_id=session_id
+            )
+    except AdmissionRejected as e:
+        result = {
+            "error": "混み合っています。少し待ってからもう一度話しかけてね。",
+            "status_code": e.status,
+            "retry_after": e.retry_after,
+        }
+    if "error" in result:
+        metrics.inc("errors_total", stage="request")
+    else:
+        result["timings"], result["steps"] = _public_timings(timings)
+    return result
+
+# ==========================
+# 音声ファイルの管理（OUT_DIR の索引 + 掃除）
+# ==========================
+AUDIO_TTL_SEC = float(os.getenv("AUDIO_TTL_SEC", str(24 * 3600)))         # 最終アクセスからこの秒数で削除
+AUDIO_MAX_BYTES = int(float(os.getenv("AUDIO_MAX_MB", "1024")) * 1024 * 1024)  # OUT_DIR 全体の上限
+AUDIO_PROTECT_SEC = float(os.getenv("AUDIO_PROTECT_SEC", "300"))         # 作成/配信直後はこの秒数だけ削除しない
+AUDIO_SWEEP_SEC = float(os.getenv("AUDIO_SWEEP_SEC", "60"))
+
+# 圧縮版（WAV と同じ名前で拡張子違い）。AUDIO_TRANSCODE に並べた形式だけを裏で作る
+AUDIO_OPUS_BITRATE = os.getenv("AUDIO_OPUS_BITRATE", "48k")
+AUDIO_AAC_BITRATE = os.getenv("AUDIO_AAC_BITRATE", "64k")
+AUDIO_FORMATS: Dict[str, Tuple[str, str, List[str]]] = {
+    # 形式名: (拡張子, Content-Type, ffmpeg の出力オプション)
+    "opus": (".webm", "audio/webm", ["-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE, "-f", "webm"]),
+    "aac": (".m4a", "audio/mp4", ["-c:a", "aac", "-b:a", AUDIO_AAC_BITRATE, "-movflags", "+faststart", "-f", "mp4"]),
+}
+AUDIO_TRANSCODE = [
+    f for f in (x.strip().lower() for x in os.getenv("AUDIO_TRANSCODE", "").split(",")) if f in AUDIO_FORMATS
+]
+# WAV と同じ名前で置く付随ファイル（形式名 → 拡張子）。音声の圧縮版に加えて口パクトラック
+_VARIANT_EXTS: Dict[str, str] = {**{fmt: ext for fmt, (ext, _, _) in AUDIO_FORMATS.items()}, "lips": ".lips"}
+LIPSYNC_ENABLED = _env_flag("LIPSYNC", True)  # 返答に口パクトラックを付ける（numpy が必要）
+LIPSYNC_FPS = max(5, min(100, int(os.getenv("LIPSYNC_FPS", "30"))))
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or "ffmpeg"
+
+
+class _AudioArtifacts:
+    """OUT_DIR に置いた返答音声の索引。/audio はこの索引だけを引く（存在確認の stat も不要）。
+
+    名前 → (bytes, 最終アクセス時刻)。配信中のファイルは pin で、作成/配信直後のファイルは
+    AUDIO_PROTECT_SEC の猶予で削除対象から外す（フロントがまだ再生していることがあるため）。
+    """
+
+    PREFIXES = ("tts_", "reply_")
+
+    def __init__(
+        self, root: Path, *, ttl_sec: float, max_bytes: int, protect_sec: float,
+        blobs: Optional[_RedisBlobStore] = None,
+    ):
+        self.root = root
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self.protect_sec = protect_sec
+        self.blobs = blobs  # BLOB_STORE=redis のとき、作った音声を共有ストアにも置く
+        self._index: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._variants: Dict[str, Dict[str, int]] = {}  # WAV 名 → {形式: bytes}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _servable(self, name: str) -> bool:
+        return name.endswith(".wav") and name.startswith(self.PREFIXES) and "/" not in name and "\\" not in name
+
+    def _publish(self, path: Path) -> None:
+        if self.blobs is None:
+            return
+        try:
+            self.blobs.put(path)
+        except Exception as e:
+            _log(f"[ERR] blob store put failed file='{path.name}': {e}")
+
+    def register(self, path: Path) -> None:
+        """ブロッキング（BLOB_STORE=redis なら共有ストアへの書き込みを含む）。"""
+        name = path.name
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        with self._lock:
+            self._bytes += size - self._index.get(name, (0, 0.0))[0]
+            self._index[name] = (size, time.time())
+            self._index.move_to_end(name)
+        self._publish(path)
+
+    def adopt(self, name: str) -> bool:
+        """他のワーカー/ノードが作った音声を索引に取り込む（ブロッキング）。
+
+        同じ OUT_DIR にあればそのまま、無ければ共有ストアから取ってくる。付随ファイルは手元にあるものだけ。
+        """
+        if not self._servable(name):
+            return False
+        path = self.root / name
+        if not path.exists() and (self.blobs is None or not self.blobs.fetch(name, path)):
+            return False
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return False
+        found = {}
+        for fmt in _VARIANT_EXTS:
+            try:
+                found[fmt] = self.variant_path(name, fmt).stat().st_size
+            except OSError:
+                pass
+        with self._lock:
+            if name not in self._index:
+                self._bytes += size + sum(found.values()) - sum(self._variants.get(name, {}).values())
+                self._index[name] = (size, time.time())
+                if found:
+                    self._variants[name] = found
+        return True
+
+    def touch(self, name: str) -> bool:
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                return False
+            self._index[name] = (entry[0], time.time())
+            self._index.move_to_end(name)
+            return True
+
+    def resolve(self, name: str) -> Optional[Path]:
+        # 索引にある名前だけを返すので ../ などは必ず 404 になる
+        return self.root / name if self.touch(name) else None
+
+    def pin(self, name: str) -> None:
+        with self._lock:
+            self._pins[name] = self._pins.get(name, 0) + 1
+
+    def unpin(self, name: str) -> None:
+        with self._lock:
+            n = self._pins.get(name, 0) - 1
+            if n > 0:
+                self._pins[name] = n
+            else:
+                self._pins.pop(name, None)
+
+    def variant_path(self, name: str, fmt: str) -> Path:
+        return (self.root / name).with_suffix(_VARIANT_EXTS[fmt])
+
+    def add_variant(self, name: str, fmt: str) -> None:
+        path = self.variant_path(name, fmt)
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        with self._lock:
+            known = name in self._index
+            if known:
+                fmts = self._variants.setdefault(name, {})
+                self._bytes += size - fmts.get(fmt, 0)
+                fmts[fmt] = size
+        if known:
+            self._publish(path)
+            return
+        # 変換中に元の WAV が消されていた
+        path.unlink(missing_ok=True)
+
+    def variant(self, name: str, fmt: str) -> Optional[Path]:
+        with self._lock:
+            if fmt in self._variants.get(name, ()):
+                return self.variant_path(name, fmt)
+        return None
+
+    def _pop_locked(self, name: str) -> List[Path]:
+        size, _ = self._index.pop(name, (0, 0.0))
+        fmts = self._variants.pop(name, {})
+        self._bytes -= size + sum(fmts.values())
+        return [self.root / name] + [self.variant_path(name, f) for f in fmts]
+
+    def forget(self, name: str) -> List[Path]:
+        with self._lock:
+            return self._pop_locked(name)
+
+    @staticmethod
+    def _unlink(paths: List[Path]) -> None:
+        for path in paths:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+    def discard(self, name: str) -> None:
+        paths = self.forget(name)
+        self._unlink(paths)
+        if self.blobs is not None:
+            try:
+                self.blobs.delete([p.name for p in paths])
+            except Exception as e:
+                _log(f"[ERR] blob store delete failed file='{name}': {e}")
+
+    def evict(self, names: List[str]) -> List[str]:
+        """キャッシュ側の追い出し（ブロッキング）。消した名前を返す。
+
+        配信中（pin）・猶予中（AUDIO_PROTECT_SEC）のものは消さずに残し、janitor の TTL に任せる。
+        共有ストアの実体は他のノードが使うことがあるので消さない（ストア側の TTL で消える）。
+        """
+        now = time.time()
+        removed: List[str] = []
+        paths: List[Path] = []
+        with self._lock:
+            for name in names:
+                entry = self._index.get(name)
+                if entry is None or name in self._pins or now - entry[1] < self.protect_sec:
+                    continue
+                removed.append(name)
+                paths += self._pop_locked(name)
+        self._unlink(paths)
+        return removed
+
+    def load_from_disk(self) -> None:
+        """起動時に既存ファイルから索引を作る。前回の書きかけ（*.part / tmp_*）は消す。"""
+        files = []
+        variants = []
+        exts = {ext: fmt for fmt, ext in _VARIANT_EXTS.items()}
+        stale_before = time.time() - 3600
+        for p in self.root.iterdir():
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            if self._servable(p.name):
+                files.append((st.st_mtime, p.name, st.st_size))
+            elif p.suffix in exts and p.name.startswith(self.PREFIXES):
+                variants.append((p, exts[p.suffix], st.st_size))
+            elif (p.name.endswith(".part") or p.name.startswith("tmp_")) and st.st_mtime < stale_before:
+                p.unlink(missing_ok=True)
+        files.sort()
+        with self._lock:
+            for mtime, name, size in files:
+                self._index[name] = (size, mtime)
+                self._bytes += size
+            for p, fmt, size in variants:
+                name = p.stem + ".wav"
+                if name in self._index:
+                    self._variants.setdefault(name, {})[fmt] = size
+                    self._bytes += size
+                else:
+                    p.unlink(missing_ok=True)
+
+    def sweep(self) -> List[str]:
+        """TTL 超過と総量超過を古い順に削除する（ブロッキング）。消した名前を返す。"""
+        now = time.time()
+        victims: List[str] = []
+        paths: List[Path] = []
+        with self._lock:
+            total = self._bytes
+            for name, (size, last) in self._index.items():
+                size += sum(self._variants.get(name, {}).values())
+                age = now - last
+                if age < self.protect_sec or name in self._pins:
+                    continue
+                if age > self.ttl_sec:
+                    self.expired += 1
+                elif total > self.max_bytes:
+                    self.evicted += 1
+                else:
+                    continue
+                victims.append(name)
+                total -= size
+            for name in victims:
+                paths += self._pop_locked(name)
+        self._unlink(paths)
+        return victims
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "files": len(self._index),
+                "variants": sum(len(v) for v in self._variants.values()),
+                "bytes": self._bytes,
+                "pinned": len(self._pins),
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "max_bytes": self.max_bytes,
+                "ttl_sec": self.ttl_sec,
+            }
+
+
+audio_artifacts = _AudioArtifacts(
+    OUT_DIR, ttl_sec=AUDIO_TTL_SEC, max_bytes=AUDIO_MAX_BYTES, protect_sec=AUDIO_PROTECT_SEC,
+    blobs=_RedisBlobStore(shared_state, ttl_sec=AUDIO_TTL_SEC) if shared_state is not None and BLOB_STORE == "redis" else None,
+)
+
+
+_transcode_inflight: set = set()
+
+
+def _transcode_blocking(src: Path, fmt: str) -> None:
+    """WAV → 圧縮版（ブロッキング）。書きかけを配信しないよう .part に出してから置き換える。"""
+    dst = audio_artifacts.variant_path(src.name, fmt)
+    tmp = dst.with_name(f"{dst.stem}.{uuid.uuid4().hex}.part")
+    cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", "-i", str(src), "-vn", *AUDIO_FORMATS[fmt][2], str(tmp)]
+    try:
+        subprocess.run(cmd, check=True, capture_output=True, timeout=60)
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+async def _transcode(src: Path, fmt: str) -> None:
+    t0 = time.perf_counter()
+    try:
+        await _run_blocking(_transcode_blocking, src, fmt)
+        await _run_blocking(audio_artifacts.add_variant, src.name, fmt)
+        _log(f"[INFO] audio transcode ok file='{src.name}' fmt={fmt} ms={(time.perf_counter() - t0) * 1000:.0f}")
+    except subprocess.CalledProcessError as e:
+        _log(f"[ERR] audio transcode fail file='{src.name}' fmt={fmt}: {e.stderr.decode('utf-8', 'replace')[:200]}")
+    except Exception as e:
+        _log(f"[ERR] audio transcode fail file='{src.name}' fmt={fmt}: {e}")
+    finally:
+        _transcode_inflight.discard((src.name, fmt))
+
+
+def _schedule_transcode(src: Path, formats: Optional[List[str]] = None) -> None:
+    """まだ無い圧縮版をバックグラウンドで作る（応答は待たない）。"""
+    for fmt in formats if formats is not None else AUDIO_TRANSCODE:
+        key = (src.name, fmt)
+        if key in _transcode_inflight or audio_artifacts.variant(src.name, fmt) is not None:
+            continue
+        _transcode_inflight.add(key)
+        _spawn(_transcode(src, fmt))
+
+
+# --------------------------
+# 口パク（リップシンク）トラック: WAV ごとに1回だけ解析し、.lips として WAV の隣に置く
+# --------------------------
+_VISEMES = ("aa", "ih", "ou", "ee", "oh")
+# 母音ごとの (低域の重心, 中域の重心) Hz。女性話者の第1/第2フォルマントの目安
+_VISEME_F1 = (850.0, 350.0, 380.0, 550.0, 560.0)
+_VISEME_F2 = (1400.0, 2600.0, 1550.0, 2200.0, 1000.0)
+_lipsync_memo: "OrderedDict[str, Optional[Dict[str, Any]]]" = OrderedDict()
+_LIPSYNC_MEMO_MAX = 512
+_lipsync_warned = False
+
+
+def _lipsync_track_blocking(path: Path) -> Optional[Dict[str, Any]]:
+    """WAV → {"fps", "keys", "frames": [[aa, ih, ou, ee, oh], ...]}（各 0〜100）。
+
+    フレームごとの RMS で口の開き、低域/中域のスペクトル重心で母音を推定する（numpy でまとめて計算）。
+    """
+    import numpy as np  # 任意依存: pip install numpy
+
+    with wave.open(str(path), "rb") as w:
+        rate, channels, width = w.getframerate(), w.getnchannels(), w.getsampwidth()
+        raw = w.readframes(w.getnframes())
+    if width != 2 or not raw:
+        return None
+    x = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768.0
+    if channels > 1:
+        x = x[: len(x) // channels * channels].reshape(-1, channels).mean(axis=1)
+
+    hop = max(1, rate // LIPSYNC_FPS)
+    win = hop * 2
+    n = max(1, -(-len(x) // hop))
+    x = np.pad(x, (win // 2, win + hop))  # フレーム k は k*hop を中心にする
+    frames = x[np.arange(n)[:, None] * hop + np.arange(win)[None, :]] * np.hanning(win)
+
+    db = 20 * np.log10(np.sqrt((frames ** 2).mean(axis=1)) + 1e-9)
+    # 大きい方から 5% の音量を基準に、-30dB で閉じ、-6dB で全開
+    opening = np.clip((db - (np.percentile(db, 95) - 30)) / 24, 0.0, 1.0)
+
+    power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(win, 1.0 / rate)
+
+    def centroid(lo: float, hi: float):
+        band = (freqs >= lo) & (freqs < hi)
+        p = power[:, band]
+        return (p * freqs[band]).sum(axis=1) / np.maximum(p.sum(axis=1), 1e-12)
+
+    f1, f2 = centroid(200, 1000), centroid(700, 3500)
+    dist = ((f1[:, None] - np.array(_VISEME_F1)) / 180) ** 2 + ((f2[:, None] - np.array(_VISEME_F2)) / 450) ** 2
+    weights = np.exp(-0.5 * dist)
+    weights /= weights.sum(axis=1, keepdims=True) + 1e-9
+    weights *= opening[:, None]
+    if n >= 3:
+        # 1-2-1 の平滑化でフレーム間のばたつきを抑える
+        padded = np.pad(weights, ((1, 1), (0, 0)), mode="edge")
+        weights = (padded[:-2] + 2 * padded[1:-1] + padded[2:]) / 4
+    return {
+        "fps": LIPSYNC_FPS,
+        "keys": list(_VISEMES),
+        "frames": np.rint(weights * 100).astype(np.int16).tolist(),
+    }
+
+
+def _lipsync_load_or_build(path: Path) -> Optional[Dict[str, Any]]:
+    cached = audio_artifacts.variant(path.name, "lips")
+    if cached is not None:
+        try:
+            return json.loads(cached.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            pass
+    track = _lipsync_track_blocking(path)
+    if track is None:
+        return None
+    dst = audio_artifacts.variant_path(path.name, "lips")
+    tmp = dst.with_name(f"{dst.stem}.{uuid.uuid4().hex}.part")
+    try:
+        tmp.write_text(json.dumps(track, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, dst)
+    finally:
+        tmp.unlink(missing_ok=True)
+    audio_artifacts.add_variant(path.name, "lips")
+    return track
+
+
+async def lipsync_for(path: Path) -> Optional[Dict[str, Any]]:
+    """返答音声の口パクトラック（無効・numpy 無し・解析失敗なら None。フロントは音量で口を動かす）。"""
+    global _lipsync_warned
+    if not LIPSYNC_ENABLED:
+        return None
+    if path.name in _lipsync_memo:
+        _lipsync_memo.move_to_end(path.name)
+        return _lipsync_memo[path.name]
+    t0 = time.perf_counter()
+    try:
+        track = await _run_blocking(_lipsync_load_or_build, path)
+    except ImportError as e:
+        if not _lipsync_warned:
+            _lipsync_warned = True
+            _log(f"[WARN] lipsync disabled (numpy is not installed): {e}")
+        return None
+    except Exception as e:
+        _log(f"[ERR] lipsync fail file='{path.name}': {e}")
+        metrics.inc("errors_total", stage="lipsync")
+        return None
+    record_stage("lipsync", (time.perf_counter() - t0) * 1000, repeated=True)
+    _lipsync_memo[path.name] = track
+    while len(_lipsync_memo) > _LIPSYNC_MEMO_MAX:
+        _lipsync_memo.popitem(last=False)
+    return track
+
+
+def _lipsync_lookup(audio_url: str) -> Optional[Dict[str, Any]]:
+    """lipsync_for() 済みのトラックを /audio/... の URL から引く（応答の組み立て用）。"""
+    return _lipsync_memo.get(audio_url.rsplit("/", 1)[-1])
+
+def _negotiate_audio_format(requested: Optional[str], accept: Optional[str]) -> str:
+    """?format= を優先し、無ければ Accept の q 値順で opus/aac/wav を選ぶ。"""
+    req = (requested or "").strip().lower()
+    if req == "wav" or req in AUDIO_TRANSCODE:
+        return req
+    ranked = []
+    for i, part in enumerate((accept or "").split(",")):
+        media, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            k, _, v = param.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            ranked.append((-q, i, media.strip().lower()))
+    for _, _, media in sorted(ranked):
+        if media in ("audio/webm", "audio/ogg", "audio/opus") and "opus" in AUDIO_TRANSCODE:
+            return "opus"
+        if media in ("audio/mp4", "audio/aac", "audio/x-m4a") and "aac" in AUDIO_TRANSCODE:
+            return "aac"
+        if media in ("audio/wav", "audio/x-wav", "audio/wave"):
+            return "wav"
+    return "wav"
+
+
+async def _audio_janitor():
+    while True:
+        await asyncio.sleep(AUDIO_SWEEP_SEC)
+        try:
+            removed = await _run_blocking(audio_artifacts.sweep)
+            for name in removed:
+                if tts_cache.is_cached_name(name):
+                    tts_cache.forget(name)
+            if removed:
+                st = audio_artifacts.stats()
+                _log(f"[INFO] audio sweep removed={len(removed)} files={st['files']} bytes={st['bytes']}")
+        except Exception as e:
+            _log(f"[ERR] audio janitor: {e}")
+
+
+@app.on_event("startup")
+async def _start_audio_janitor():
+    await _run_blocking(audio_artifacts.load_from_disk)
+    st = audio_artifacts.stats()
+    _log(f"[INFO] audio artifacts loaded files={st['files']} bytes={st['bytes']}")
+    _spawn(_audio_janitor())
+
+
+@metrics.collector
+def _audio_metrics():
+    st = audio_artifacts.stats()
+    yield "audio_files", "gauge", {}, st["files"]
+    yield "audio_variants", "gauge", {}, st["variants"]
+    yield "audio_bytes", "gauge", {}, st["bytes"]
+    yield "audio_removed_total", "counter", {"reason": "ttl"}, st["expired"]
+    yield "audio_removed_total", "counter", {"reason": "quota"}, st["evicted"]
+
+
+@app.get("/api/audio/stats")
+def audio_stats():
+    return audio_artifacts.stats()
+
+# ==========================
+# TTS 音声キャッシュ（合成パラメータ全体のハッシュ → OUT_DIR/tts_<hash>.wav）
+# ==========================
+TTS_CACHE_ENABLED = _env_flag("TTS_CACHE", True)
+TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", "2000"))
+TTS_CACHE_MAX_BYTES = int(float(os.getenv("TTS_CACHE_MAX_MB", "512")) * 1024 * 1024)
+TTS_CACHE_MAX_AGE_SEC = float(os.getenv("TTS_CACHE_MAX_AGE_SEC", str(7 * 24 * 3600)))
+
+
+class _TTSCache:
+    """build_synthesis_payload の出力をキーにした content-addressed キャッシュ。
+
+    実体は OUT_DIR 上のファイル、メモリには LRU 順の索引（key → (bytes, 作成時刻)）だけを持つ。
+    経過時間を超えたものは並び順に関係なく、件数・総バイト数を超えた分は LRU の古い順に削除する。
+    ファイルの削除はロックの外で audio_artifacts.evict に渡す（配信中・猶予中のものはそちらで残す）。
+    """
+
+    PREFIX = "tts_"
+
+    def __init__(self, root: Path, *, max_entries: int, max_bytes: int, max_age_sec: float):
+        self.root = root
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self._index: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(payload: Dict[str, Any]) -> str:
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def path_for(self, key: str) -> Path:
+        return self.root / f"{self.PREFIX}{key}.wav"
+
+    def is_cached_name(self, filename: str) -> bool:
+        return filename.startswith(self.PREFIX)
+
+    def contains(self, key: str) -> bool:
+        """lookup と違い、当たり外れの集計も LRU の並びも変えない（一括合成の事前確認用）。"""
+        with self._lock:
+            entry = self._index.get(key)
+            return entry is not None and time.time() - entry[1] <= self.max_age_sec
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """イベントループ上で呼ぶのでファイルには触らない。
+
+        期限切れは外れとして数えるだけ（合成し直した store が同じパスに上書きする）。
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and now - entry[1] <= self.max_age_sec:
+                path = self.path_for(key)
+                if audio_artifacts.touch(path.name):
+                    self._index.move_to_end(key)
+                    self.hits += 1
+                    return path
+                # 掃除側で消されていた
+                self._pop_locked(key)
+            self.misses += 1
+            return None
+
+    def store(self, key: str, data: bytes) -> Path:
+        """ブロッキング（書き込み + 追い出し）。_run_blocking 経由で呼ぶ。"""
+        path = self.path_for(key)
+        tmp = path.with_suffix(f".{uuid.uuid4().hex}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        audio_artifacts.register(path)
+        with self._lock:
+            if key in self._index:
+                self._bytes -= self._index[key][0]
+            self._index[key] = (len(data), time.time())
+            self._index.move_to_end(key)
+            self._bytes += len(data)
+            victims = self._evict_locked()
+        self._release(victims)
+        return path
+
+    def load_from_disk(self) -> None:
+        """起動時に既存の tts_*.wav から索引を復元する（古い順に積む）。"""
+        files = []
+        for p in self.root.glob(f"{self.PREFIX}*.wav"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, p.stem[len(self.PREFIX):], st.st_size))
+        files.sort()
+        with self._lock:
+            for mtime, key, size in files:
+                self._index[key] = (size, mtime)
+                self._bytes += size
+            victims = self._evict_locked()
+        self._release(victims)
+
+    def adopt(self, key: str) -> Optional[Path]:
+        """他のワーカー/ノードが合成済みなら索引に取り込んで返す（ブロッキング）。lookup の外れを当たりに数え直す。"""
+        path = self.path_for(key)
+        if not audio_artifacts.adopt(path.name):
+            return None
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return None
+        with self._lock:
+            if key not in self._index:
+                self._index[key] = (size, time.time())
+                self._bytes += size
+            self.hits += 1
+            self.misses -= 1
+        return path
+
+    def _pop_locked(self, key: str) -> None:
+        size, _ = self._index.pop(key, (0, 0.0))
+        self._bytes -= size
+
+    def forget(self, filename: str) -> None:
+        """掃除側で消されたファイルを索引からも外す。"""
+        key = filename[len(self.PREFIX):-len(".wav")]
+        with self._lock:
+            self._pop_locked(key)
+
+    def _evict_locked(self) -> List[str]:
+        """追い出す key を索引から外して返す。ファイルは呼び出し側がロックを放してから _release で消す。"""
+        now = time.time()
+        # touch で並びが変わるので、経過時間は先頭だけでなく全件を見る
+        victims = [key for key, (_, created) in self._index.items() if now - created > self.max_age_sec]
+        for key in victims:
+            self._pop_locked(key)
+        while self._index and (len(self._index) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._index))
+            self._pop_locked(key)
+            victims.append(key)
+        self.evictions += len(victims)
+        return victims
+
+    def _release(self, victims: List[str]) -> None:
+        """ブロッキング。配信中・猶予中のファイルは audio_artifacts 側で残り、janitor の TTL で消える。"""
+        if victims:
+            audio_artifacts.evict([self.path_for(key).name for key in victims])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": TTS_CACHE_ENABLED,
+                "entries": len(self._index),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+tts_cache = _TTSCache(
+    OUT_DIR,
+    max_entries=TTS_CACHE_MAX_ENTRIES,
+    max_bytes=TTS_CACHE_MAX_BYTES,
+    max_age_sec=TTS_CACHE_MAX_AGE_SEC,
+)
+_tts_inflight: Dict[str, "asyncio.Task[Path]"] = {}
+
+
+@metrics.collector
+def _tts_cache_metrics():
+    st = tts_cache.stats()
+    yield "tts_cache_entries", "gauge", {}, st["entries"]
+    yield "tts_cache_bytes", "gauge", {}, st["bytes"]
+    for key in ("hits", "misses", "coalesced", "evictions"):
+        yield f"tts_cache_{key}_total", "counter", {}, st[key]
+
+
+@app.on_event("startup")
+async def _load_tts_cache():
+    if TTS_CACHE_ENABLED:
+        await _run_blocking(tts_cache.load_from_disk)
+        _log(f"[INFO] tts cache loaded entries={tts_cache.stats()['entries']}")
+
+
+def _discard_audio(audio_url: str) -> None:
+    """使わなくなった /audio/... を消す（ブロッキング）。キャッシュ済みの音声は他の応答でも使うので残す。"""
+    name = audio_url.split("/")[-1]
+    if not name or tts_cache.is_cached_name(name):
+        return
+    audio_artifacts.discard(name)
+
+# ==========================
+# COEIROINK 呼び出し
+# ==========================
+def build_synthesis_payload(text: str, style_id: int, tts_overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    payload = {
+        "speakerUuid": RESOLVED_SPEAKER_UUID,
+        "styleId": int(style_id),
+        "text": text,
+        **DEFAULT_TTS,
+    }
+    if tts_overrides:
+        payload.update(tts_overrides)
+    return payload
+
+async def _coeiroink_synthesize(payload: Dict[str, Any]) -> bytes:
+    try:
+        async with admission["coeiroink"].slot(), breakers["coeiroink"]:
+            s = await _http_post(
+                f"{COEIROINK_URL}/v1/synthesis",
+                json=payload,
+                headers={"Accept": "audio/wav", "Content-Type": "application/json"},
+                timeout=120,
+            )
+            if not s.is_success:
+                raise RuntimeError(f"/v1/synthesis 失敗: HTTP {s.status_code} {s.reason_phrase} body={s.text}")
+        return s.content
+    except RuntimeError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"/v1/synthesis 呼び出しで例外: {e}")
+
+
+async def _synthesize_into_cache(key: str, payload: Dict[str, Any]) -> Path:
+    data = await _coeiroink_synthesize(payload)
+    return await _run_blocking(tts_cache.store, key, data)
+
+
+async def coeiroink_tts(text: str, style_id: int, tts_overrides: Optional[Dict[str, Any]] = None) -> Path:
+    if not RESOLVED_SPEAKER_UUID or RESOLVED_STYLE_ID is None:
+        raise RuntimeError("COEIROINK が未初期化です（speaker/style 未解決）")
+
+    payload = build_synthesis_payload(text, style_id, tts_overrides)
+
+    if not TTS_CACHE_ENABLED:
+        outpath = OUT_DIR / f"reply_{uuid.uuid4().hex}.wav"
+        await _run_blocking(outpath.write_bytes, await _coeiroink_synthesize(payload))
+        await _run_blocking(audio_artifacts.register, outpath)
+        _schedule_transcode(outpath)
+        return outpath
+
+    key = _TTSCache.key_for(payload)
+    hit = tts_cache.lookup(key)
+    if hit is None and shared_state is not None:
+        # 他のワーカー/ノードが同じ内容を合成済みならそれを使う
+        hit = await _run_blocking(tts_cache.adopt, key)
+    if hit is not None:
+        _log(f"[INFO] tts cache hit key={key} text='{text[:40]}'")
+        _schedule_transcode(hit)
+        return hit
+
+    # 同じ内容の合成が進行中なら相乗りする（single-flight）
+    task = _tts_inflight.get(key)
+    if task is not None:
+        tts_cache.coalesced += 1
+    else:
+        task = _spawn(_synthesize_into_cache(key, payload))
+        _tts_inflight[key] = task
+        task.add_done_callback(lambda _t, k=key: _tts_inflight.pop(k, None))
+    path = await asyncio.shield(task)
+    _schedule_transcode(path)
+    return path
+
+
+@app.get("/api/tts/cache")
+def tts_cache_stats():
+    return tts_cache.stats()
+
+# ==========================
+# 音声認識（STT）
+# ==========================
+STT_SAMPLE_RATE = 16000  # 認識器に渡す PCM（16kHz / mono / 16bit）
+
+
+stt_stats: Dict[str, _LatencyStat] = {"decode": metrics.summary("stt_decode_ms")}
+
+
+class SpeechNotRecognized(Exception):
+    """音声から文字を取り出せなかった（無音・聞き取れない）。"""
+
+
+class STTUnavailable(Exception):
+    """認識エンジンを使えない（モデル未導入・認識サービスに接続できない など）。"""
+
+
+def _decode_to_pcm16(data: bytes) -> bytes:
+    """webm 等のバイト列 → 16kHz mono s16le（ブロッキング）。ffmpeg にパイプで渡し、一時ファイルは作らない。"""
+    cmd = [
+        FFMPEG_BIN, "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0", "-vn", "-ac", "1", "-ar", str(STT_SAMPLE_RATE), "-f", "s16le", "pipe:1",
+    ]
+    t0 = time.perf_counter()
+    try:
+        try:
+            proc = subprocess.run(cmd, input=data, capture_output=True, timeout=30)
+        except subprocess.TimeoutExpired as e:
+            raise RuntimeError(f"音声のデコードが {e.timeout:.0f}s で終わらない") from e
+        except OSError as e:
+            # ffmpeg が無い・起動できない
+            raise RuntimeError(f"ffmpeg を起動できません: {e}") from e
+        if proc.returncode != 0:
+            raise RuntimeError(f"音声のデコードに失敗: {proc.stderr.decode('utf-8', 'replace')[:200]}")
+    except Exception:
+        stt_stats["decode"].add((time.perf_counter() - t0) * 1000, ok=False)
+        raise
+    ms = (time.perf_counter() - t0) * 1000
+    stt_stats["decode"].add(ms)
+    _log(f"[INFO] voice decode ok in_bytes={len(data)} pcm_bytes={len(proc.stdout)} ms={ms:.0f}")
+    return proc.stdout
+
+
+# 認識エンジン: google（従来・要ネット）/ vosk / whisper（faster-whisper, CPU）/ fixed（固定文字列。負荷試験・オフライン確認用）
+STT_ENGINE = os.getenv("STT_ENGINE", "google").strip().lower()
+STT_BATCH_MAX = max(1, int(os.getenv("STT_BATCH_MAX", "4")))          # ローカルエンジンで1回にまとめる発話数
+STT_BATCH_WINDOW_MS = float(os.getenv("STT_BATCH_WINDOW_MS", "30"))   # 同時に来た発話を待ち合わせる時間
+
+
+class _STTBackend(ABC):
+    """PCM（16kHz mono s16le）の列 → テキストの列。transcribe_batch はワーカースレッドで呼ばれる。
+
+    要素ごとに str か例外を返す。モデルは最初の呼び出しで読み込み、以降は共有する。
+    """
+
+    name = "base"
+    max_batch = 1        # 1回の呼び出しでまとめる件数
+    max_concurrency = 1  # 同時に走らせる呼び出し数（ローカルモデルは 1）
+
+    def __init__(self):
+        self._model: Any = None
+        self._load_lock = threading.Lock()
+
+    def _load(self) -> Any:
+        return None
+
+    def model(self) -> Any:
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    t0 = time.perf_counter()
+                    try:
+                        self._model = self._load()
+                    except Exception as e:
+                        raise STTUnavailable(f"STT engine {self.name} を読み込めません: {e}")
+                    _log(f"[INFO] stt model loaded engine={self.name} ms={(time.perf_counter() - t0) * 1000:.0f}")
+        return self._model
+
+    @abstractmethod
+    def transcribe_one(self, pcm: bytes) -> str:
+        """1発話を認識する。聞き取れなければ SpeechNotRecognized、エンジンが使えなければ STTUnavailable。"""
+
+    def open_stream(self) -> "_STTStream":
+        """発話の途中から音声を受け取るストリーム。既定は貯めておいて最後にまとめて認識する。"""
+        return _STTStream(self)
+
+    def transcribe_batch(self, pcms: List[bytes]) -> List[Any]:
+        out: List[Any] = []
+        for pcm in pcms:
+            try:
+                out.append(self.transcribe_one(pcm))
+            except Exception as e:
+                out.append(e)
+        return out
+
+
+class _GoogleSTT(_STTBackend):
+    name = "google"
+    max_concurrency = 4
+
+    def _load(self) -> Any:
+        import speech_recognition  # 読み込みが重いので google を使うときだけ
+
+        return speech_recognition
+
+    def transcribe_one(self, pcm: bytes) -> str:
+        sr = self.model()
+        try:
+            return sr.Recognizer().recognize_google(sr.AudioData(pcm, STT_SAMPLE_RATE, 2), language="ja-JP")
+        except sr.UnknownValueError:
+            raise SpeechNotRecognized()
+        except sr.RequestError as e:
+            raise STTUnavailable(str(e))
+
+
+class _VoskSTT(_STTBackend):
+    name = "vosk"
+    max_batch = STT_BATCH_MAX
+
+    def _load(self) -> Any:
+        import vosk  # 任意依存: pip install vosk
+
+        vosk.SetLogLevel(-1)
+        return vosk.Model(os.getenv("VOSK_MODEL_PATH", str(BASE_DIR / "models" / "vosk-model-small-ja-0.22")))
+
+    def open_stream(self) -> "_STTStream":
+        return _VoskSTTStream(self)
+
+    def transcribe_one(self, pcm: bytes) -> str:
+        model = self.model()
+        import vosk
+
+        rec = vosk.KaldiRecognizer(model, STT_SAMPLE_RATE)
+        rec.AcceptWaveform(pcm)
+        # 日本語モデルは単語をスペース区切りで返す
+        return "".join(str(json.loads(rec.FinalResult()).get("text", "")).split())
+
+
+class _WhisperSTT(_STTBackend):
+    name = "whisper"
+    max_batch = STT_BATCH_MAX
+
+    def _load(self) -> Any:
+        from faster_whisper import WhisperModel  # 任意依存: pip install faster-whisper
+
+        return WhisperModel(
+            os.getenv("WHISPER_MODEL", "small"),
+            device="cpu",
+            compute_type=os.getenv("WHISPER_COMPUTE_TYPE", "int8"),
+            cpu_threads=CPU_WORKERS,
+        )
+
+    def transcribe_one(self, pcm: bytes) -> str:
+        model = self.model()
+        import numpy as np
+
+        audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        segments, _ = model.transcribe(audio, language="ja", beam_size=1, vad_filter=True)
+        return "".join(seg.text for seg in segments).strip()
+
 
-    _log(f"[INFO] engine={engine_label} streaming done text_len={len(full_text)} segs={len(audio_paths)}")
-    return full_text, audio_paths
+class _FixedSTT(_STTBackend):
+    name = "fixed"
+    max_concurrency = 8
 
-# ==========================
-# TTS パラメータ自動決定（基本: Gemma via Ollama、フォールバック: Gemini）
-# ==========================
-VOICE_DIRECTOR_PROMPT = """あなたはTTS音声監督。ユーザー発話の感情・文脈から、以下のJSONだけを厳密に出力して。
-- styleId: 次の集合のいずれかだけ [1,7,40,41,42,43,44,45,46,47]
-- speedScale: 0.7〜1.4 の小数
-- volumeScale: 0.8〜1.3 の小数
-- pitchScale: -0.3〜0.3 の小数
-- intonationScale: 0.8〜1.6 の小数
-- prePhonemeLength: 0.05〜0.15 の小数
-- postPhonemeLength: 0.35〜0.7 の小数
-- outputSamplingRate: 24000 または 48000
-- reason: 50字以内の短い説明（ログ用）
+    def transcribe_one(self, pcm: bytes) -> str:
+        return os.getenv("STT_FIXED_TEXT", "こんにちは")
 
-出力は JSON オブジェクト1個のみ。説明や前置きは一切なし。"""
 
-def gemini_choose_tts(user_text: str) -> Dict[str, Any]:
-    res = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[VOICE_DIRECTOR_PROMPT, f"ユーザー発話:{user_text}"]
-    )
-    txt = getattr(res, "text", "").strip()
-    try:
-        obj = json.loads(txt)
-    except Exception:
-        obj = {}
+_STT_BACKENDS = {c.name: c for c in (_GoogleSTT, _VoskSTT, _WhisperSTT, _FixedSTT)}
 
-    style_id = obj.get("styleId")
-    if style_id not in VALID_STYLE_IDS:
-        low = user_text.lower()
-        if any(k in low for k in ["内緒", "ないしょ", "ひそひそ"]):
-            style_id = 43
-        elif any(k in low for k in ["楽しい", "最高", "嬉", "やった", "草", "ｗ"]):
-            style_id = 40
-        elif any(k in low for k in ["しょんぼり", "悲", "落ち込", "ごめん"]):
-            style_id = 42
-        elif any(k in low for k in ["怒", "ムカ", "ふくれ"]):
-            style_id = 41
-        else:
-            style_id = 1
 
-    def clamp(v, lo, hi, default):
-        try:
-            v = float(v)
-        except Exception:
-            return default
-        return max(lo, min(hi, v))
+class _STTStream:
+    """1発話ぶんの逐次入力。feed() は待たずに返り、finish() で確定テキストを返す。"""
 
-    params = {
-        "styleId": int(style_id),
-        "speedScale": clamp(obj.get("speedScale", 1.0), 0.7, 1.4, 1.0),
-        "volumeScale": clamp(obj.get("volumeScale", 1.0), 0.8, 1.3, 1.0),
-        "pitchScale": clamp(obj.get("pitchScale", 0.0), -0.3, 0.3, 0.0),
-        "intonationScale": clamp(obj.get("intonationScale", 1.0), 0.8, 1.6, 1.0),
-        "prePhonemeLength": clamp(obj.get("prePhonemeLength", 0.1), 0.05, 0.15, 0.1),
-        "postPhonemeLength": clamp(obj.get("postPhonemeLength", 0.5), 0.35, 0.7, 0.5),
-        "outputSamplingRate": 48000 if int(obj.get("outputSamplingRate", 24000)) == 48000 else 24000,
-        "reason": str(obj.get("reason", "推定で選択"))
-    }
-    return params
+    def __init__(self, backend: _STTBackend):
+        self.backend = backend
+        self._buf = bytearray()
 
-# ==========================
-# 背景LLM（Gemma via Ollama）でTTSとポーズを決める
-# 失敗時は従来のロジックにフォールバック
+    def feed(self, pcm: bytes) -> None:
+        self._buf += pcm
 
-def _ollama_generate(prompt: str) -> str:
-    try:
-        url = f"{OLLAMA_BASE_URL}/api/generate"
-        resp = requests.post(url, json={"model": OLLAMA_MODEL, "prompt": prompt, "stream": False}, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        return str(data.get("response", "")).strip()
-    except Exception as e:
-        _log(f"[OLLAMA][ERR] {e}")
-        raise
+    def partial(self) -> str:
+        return ""
 
-def choose_tts_by_gemma(user_text: str) -> Dict[str, Any]:
-    prompt = VOICE_DIRECTOR_PROMPT + "\nユーザー発話:" + user_text
-    try:
-        txt = _ollama_generate(prompt)
-        obj = json.loads(txt)
-    except Exception:
-        # フォールバック: 既存Geminiロジック
-        return gemini_choose_tts(user_text)
+    async def finish(self) -> str:
+        return await transcribe_pcm(bytes(self._buf))
 
-    def clamp(v, lo, hi, default):
-        try:
-            v = float(v)
-        except Exception:
-            return default
-        return max(lo, min(hi, v))
 
-    style_id = obj.get("styleId")
-    if style_id not in VALID_STYLE_IDS:
-        return gemini_choose_tts(user_text)
+class _VoskSTTStream(_STTStream):
+    """話している間に認識器へ流し込むので、発話終了時には FinalResult を取るだけで済む。"""
 
-    return {
-        "styleId": int(style_id),
-        "speedScale": clamp(obj.get("speedScale", 1.0), 0.7, 1.4, 1.0),
-        "volumeScale": clamp(obj.get("volumeScale", 1.0), 0.8, 1.3, 1.0),
-        "pitchScale": clamp(obj.get("pitchScale", 0.0), -0.3, 0.3, 0.0),
-        "intonationScale": clamp(obj.get("intonationScale", 1.0), 0.8, 1.6, 1.0),
-        "prePhonemeLength": clamp(obj.get("prePhonemeLength", 0.1), 0.05, 0.15, 0.1),
-        "postPhonemeLength": clamp(obj.get("postPhonemeLength", 0.5), 0.35, 0.7, 0.5),
-        "outputSamplingRate": 48000 if int(obj.get("outputSamplingRate", 24000)) == 48000 else 24000,
-        "reason": str(obj.get("reason", "ollama-gemma 推定"))
-    }
+    def __init__(self, backend: _STTBackend):
+        super().__init__(backend)
+        self._rec: Any = None
+        self._partial = ""
+        self._chain: Optional[asyncio.Task] = None
 
-POSE_TIMELINE_PROMPT = (
-    "あなたは3Dアバターのモーション生成AIです。JSONのみ出力してください。\n"
-    "形式: {\"head\":{\"timeline\":[[t,y], ...]}} tは0..1昇順、yは-0.6..0.6(ラジアン)。\n"
-    "終端は0付近に戻す。説明は一切不要。\n"
-)
+    def _accept(self, pcm: bytes) -> None:
+        if self._rec is None:
+            import vosk
 
-def pose_timeline_by_gemma(user_text: str) -> Dict[str, Any]:
-    try:
-        txt = _ollama_generate(POSE_TIMELINE_PROMPT + "ユーザー発話:" + user_text)
-        obj = json.loads(txt)
-        tl = (((obj or {}).get("head") or {}).get("timeline"))
-        if isinstance(tl, list) and tl:
-            cleaned = []
-            for kp in tl:
-                if isinstance(kp, (list, tuple)) and len(kp) == 2:
-                    try:
-                        t = float(kp[0]); y = float(kp[1])
-                    except Exception:
-                        continue
-                    t = max(0.0, min(1.0, t))
-                    y = max(-0.6, min(0.6, y))
-                    cleaned.append([t, y])
-            if cleaned:
-                cleaned.sort(key=lambda x: x[0])
-                return {"head": {"timeline": cleaned}}
-    except Exception as e:
-        _log(f"[POSE][OLLAMA][ERR] {e}")
+            self._rec = vosk.KaldiRecognizer(self.backend.model(), STT_SAMPLE_RATE)
+        if self._rec.AcceptWaveform(pcm):
+            self._partial = ""
+        else:
+            self._partial = "".join(str(json.loads(self._rec.PartialResult()).get("partial", "")).split())
 
-    # フォールバック: 適度な小振りのタイムライン
-    return {"head": {"timeline": [[0.0, 0.0],[0.25, 0.15],[0.6, -0.1],[1.0, 0.0]]}}
+    async def _after(self, prev: Optional[asyncio.Task], pcm: bytes) -> None:
+        if prev is not None:
+            await prev
+        await _run_blocking(self._accept, pcm)
 
-# 後方互換: /api/pose は 0 を返すだけ（フロントはもう使わない方針）
-@app.api_route("/api/pose", methods=["GET", "POST"])
-def api_pose_compat():
-    return {"head": {"y": 0.0}}
+    def feed(self, pcm: bytes) -> None:
+        # 順序を保つため前回の投入に数珠つなぎにする
+        self._chain = _spawn(self._after(self._chain, pcm))
 
+    def partial(self) -> str:
+        return self._partial
 
-async def _process_chat_request(
-    user_text: str,
-    styleId: Optional[int],
-    autoMode: Optional[str],
-    poseMode: Optional[str],
-    chatEngine: Optional[str],
-) -> Dict[str, Any]:
-    engine = (str(chatEngine).lower() if chatEngine is not None else "")
-    auto = _parse_bool(autoMode)
-    chosen_style = RESOLVED_STYLE_ID
-    tts_overrides = None
-    engine_name = engine or "cloud"
-    _log(f"[INFO] processing request engine={engine_name} auto={auto}")
+    async def finish(self) -> str:
+        t0 = time.perf_counter()
+        stat = stt_stats.setdefault(self.backend.name, metrics.summary("stt_engine_ms", engine=self.backend.name))
+        try:
+            if self._chain is not None:
+                await self._chain
+            if self._rec is None:
+                raise SpeechNotRecognized()
+            result = await _run_blocking(self._rec.FinalResult)
+            text = "".join(str(json.loads(result).get("text", "")).split())
+        except SpeechNotRecognized:
+            stat.add((time.perf_counter() - t0) * 1000, ok=False)
+            raise
+        except Exception as e:
+            stat.add((time.perf_counter() - t0) * 1000, ok=False)
+            raise STTUnavailable(str(e))
+        stat.add((time.perf_counter() - t0) * 1000)
+        if not text:
+            raise SpeechNotRecognized()
+        return text
 
-    def _apply_auto_params(src: str) -> None:
-        nonlocal chosen_style, tts_overrides
-        tts = choose_tts_by_gemma(src or "")
-        chosen_style = tts["styleId"]
-        tts_overrides = {
-            k: tts[k]
-            for k in (
-                "speedScale",
-                "volumeScale",
-                "pitchScale",
-                "intonationScale",
-                "prePhonemeLength",
-                "postPhonemeLength",
-                "outputSamplingRate",
-            )
-        }
 
-    audio_field: Any
-    reply_text: str
+class _STTBatcher:
+    """同時に来た発話を STT_BATCH_WINDOW_MS だけ待ち合わせ、まとめて1回のワーカー呼び出しにする。
 
-    if engine in ("local", "local12", "local4", "local-4b", "local4b"):
-        if auto:
-            _apply_auto_params(user_text)
-        elif styleId is not None and int(styleId) in VALID_STYLE_IDS:
-            chosen_style = int(styleId)
-        elif chosen_style is None and STYLE_PRESETS:
-            chosen_style = STYLE_PRESETS[0]["id"]
+    ローカルエンジンは max_concurrency=1 なので、認識中に来た発話は次のバッチにたまる。
+    """
 
-        engine_label = "local" if engine in ("local", "local12") else "local4"
-        model_to_use = LOCAL_CHAT_MODEL if engine_label == "local" else LOCAL_CHAT_MODEL_4B
-        reply_text, audio_list = local_reply_ollama_stream(
-            user_text,
-            model=model_to_use,
-            tts_style_id=chosen_style or RESOLVED_STYLE_ID or STYLE_PRESETS[0]["id"],
-            tts_overrides=tts_overrides,
-            engine_label=engine_label,
-        )
-        audio_field = audio_list
-        _log(f"[INFO] engine={engine_label} streaming ready segs={len(audio_list)}")
-    else:
-        _log(f"[INFO] engine={engine_name} full reply start")
-        reply_text = gemini_reply(user_text)
-        _log(f"[INFO] engine={engine_name} full reply done")
-        if auto:
-            _apply_auto_params(reply_text)
-        elif styleId is not None and int(styleId) in VALID_STYLE_IDS:
-            chosen_style = int(styleId)
-        elif chosen_style is None and STYLE_PRESETS:
-            chosen_style = STYLE_PRESETS[0]["id"]
+    def __init__(self, backend: _STTBackend):
+        self.backend = backend
+        self.batches = 0
+        self.items = 0
+        self._queue: "Optional[asyncio.Queue[Tuple[bytes, asyncio.Future]]]" = None
+        self._slots: Optional[asyncio.Semaphore] = None
 
+    async def transcribe(self, pcm: bytes) -> str:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.backend.max_concurrency)
+            _spawn(self._loop())
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        self._queue.put_nowait((pcm, fut))
+        stat = stt_stats.setdefault(self.backend.name, metrics.summary("stt_engine_ms", engine=self.backend.name))
         try:
-            outpath = coeiroink_tts(
-                reply_text,
-                style_id=chosen_style,
-                tts_overrides=tts_overrides,
-            )
-            audio_field = f"/audio/{outpath.name}"
-        except Exception as e:
-            _log(f"[ERR] engine={engine_name} synthesis error: {e}")
-            return {"error": f"COEIROINK error: {e}", "status_code": 502}
+            text = await fut
+        except Exception:
+            stat.add((time.perf_counter() - t0) * 1000, ok=False)
+            raise
+        stat.add((time.perf_counter() - t0) * 1000)
+        return text
 
-    pose_enabled = _parse_bool(poseMode) or auto
-    pose = {"head": {"timeline": [[0.0, 0.0], [1.0, 0.0]]}}
-    if pose_enabled:
-        pose = pose_timeline_by_gemma(user_text)
+    async def _loop(self) -> None:
+        window = STT_BATCH_WINDOW_MS / 1000
+        while True:
+            await self._slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = time.perf_counter() + window
+            while len(batch) < self.backend.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            _spawn(self._run(batch))
 
-    return {
-        "text": reply_text,
-        "audio": audio_field,
-        "auto": auto,
-        "tts": {"styleId": chosen_style, **(tts_overrides or {})},
-        "pose": pose,
-    }
+    async def _run(self, batch: List[Tuple[bytes, asyncio.Future]]) -> None:
+        try:
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = await _run_blocking(self.backend.transcribe_batch, [pcm for pcm, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, fut), res in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(res, BaseException):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+        finally:
+            self._slots.release()
 
-# ==========================
-# COEIROINK 呼び出し
-# ==========================
-def build_synthesis_payload(text: str, style_id: int, tts_overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    payload = {
-        "speakerUuid": RESOLVED_SPEAKER_UUID,
-        "styleId": int(style_id),
-        "text": text,
-        **DEFAULT_TTS,
-    }
-    if tts_overrides:
-        payload.update(tts_overrides)
-    return payload
 
-def coeiroink_tts(text: str, style_id: int, tts_overrides: Optional[Dict[str, Any]] = None) -> Path:
-    if not RESOLVED_SPEAKER_UUID or RESOLVED_STYLE_ID is None:
-        raise RuntimeError("COEIROINK が未初期化です（speaker/style 未解決）")
+_stt_batcher: Optional[_STTBatcher] = None
 
-    filename = f"reply_{uuid.uuid4().hex}.wav"
-    outpath = OUT_DIR / filename
-    payload = build_synthesis_payload(text, style_id, tts_overrides)
 
-    try:
-        s = requests.post(
-            f"{COEIROINK_URL}/v1/synthesis",
-            json=payload,
-            headers={"Accept": "audio/wav", "Content-Type": "application/json"},
-            timeout=120,
-        )
-        if not s.ok:
-            raise requests.HTTPError(f"{s.status_code} {s.reason} body={s.text}", response=s)
-        outpath.write_bytes(s.content)
-        return outpath
-    except requests.HTTPError as e:
-        body = e.response.text if e.response is not None else ""
-        raise RuntimeError(f"/v1/synthesis 失敗: HTTP {e.response.status_code if e.response else ''} {e} {body}")
-    except Exception as e:
-        raise RuntimeError(f"/v1/synthesis 呼び出しで例外: {e}")
+def _stt() -> _STTBatcher:
+    global _stt_batcher
+    if _stt_batcher is None:
+        cls = _STT_BACKENDS.get(STT_ENGINE)
+        if cls is None:
+            _log(f"[WARN] unknown STT_ENGINE={STT_ENGINE!r}; using google")
+            cls = _GoogleSTT
+        _stt_batcher = _STTBatcher(cls())
+    return _stt_batcher
+
+
+async def transcribe_pcm(pcm: bytes) -> str:
+    if not pcm:
+        raise SpeechNotRecognized()
+    text = await _stt().transcribe(pcm)
+    if not (text or "").strip():
+        raise SpeechNotRecognized()
+    return text
+
+
+@metrics.collector
+def _stt_metrics():
+    if _stt_batcher is not None:
+        yield "stt_batches_total", "counter", {"engine": _stt_batcher.backend.name}, _stt_batcher.batches
+        yield "stt_batch_items_total", "counter", {"engine": _stt_batcher.backend.name}, _stt_batcher.items
+
+
+@app.get("/api/stt/stats")
+def stt_stats_view():
+    b = _stt()
+    return {
+        "engine": b.backend.name,
+        "batches": b.batches,
+        "avg_batch": round(b.items / b.batches, 2) if b.batches else 0.0,
+        **{name: stat.snapshot() for name, stat in stt_stats.items()},
+    }
 
 # ==========================
 # API: スタイル一覧（固定）
@@ -672,6 +3956,15 @@ def list_styles():
 # ==========================
 # API: テキスト → 返答 + 音声 (+首ヨー角)
 # ==========================
+def _error_response(result: Dict[str, Any]) -> JSONResponse:
+    body: Dict[str, Any] = {"error": result["error"]}
+    headers = None
+    if result.get("retry_after"):
+        body["retryAfter"] = result["retry_after"]
+        headers = {"Retry-After": str(result["retry_after"])}
+    return JSONResponse(body, status_code=result.get("status_code", 500), headers=headers)
+
+
 def _parse_bool(v: Optional[str]) -> bool:
     if v is None:
         return False
@@ -684,15 +3977,19 @@ async def text_to_reply(
     autoMode: Optional[str] = Form(None),  # "1"/"true" ???????:?????????
     poseMode: Optional[str] = Form(None),  # "1"/"true" ?????????????????
     chatEngine: Optional[str] = Form(None),  # 'local' ??????LLM
+    sessionId: Optional[str] = Form(None),  # タブごとの会話ID（未指定なら X-Session-Id / default）
+    x_session_id: Optional[str] = Header(None),
 ):
     user_text = (text or "").strip()
     if not user_text:
         return JSONResponse({"error": "テキストが空です"}, status_code=400)
 
-    result = await _process_chat_request(user_text, styleId, autoMode, poseMode, chatEngine)
+    result = await _process_chat_request(
+        user_text, styleId, autoMode, poseMode, chatEngine, session_id=_session_id(sessionId, x_session_id)
+    )
 
     if "error" in result:
-        return JSONResponse({"error": result["error"]}, status_code=result.get("status_code", 500))
+        return _error_response(result)
 
     result["stt"] = user_text
     return result
@@ -704,54 +4001,491 @@ async def voice_to_reply(
     autoMode: Optional[str] = Form(None),
     poseMode: Optional[str] = Form(None),
     chatEngine: Optional[str] = Form(None),  # 'cloud'|'local'|'local4'
+    sessionId: Optional[str] = Form(None),
+    x_session_id: Optional[str] = Header(None),
 ):
-    tmp_path: Optional[Path] = None
-    wav_path: Optional[Path] = None
+    timings = _begin_request_timings()
+    cleaned_text, err = await _recognize_upload(file)
+    if err is not None:
+        return err
+
+    result = await _process_chat_request(
+        cleaned_text, styleId, autoMode, poseMode, chatEngine,
+        session_id=_session_id(sessionId, x_session_id), timings=timings,
+    )
+
+    if "error" in result:
+        return _error_response(result)
+
+    result["stt"] = cleaned_text
+    return result
+
+
+async def _recognize_upload(file: UploadFile) -> Tuple[str, Optional[JSONResponse]]:
+    """アップロードされた webm を文字起こしする。失敗時は ("", エラーレスポンス) を返す。"""
+    data = await file.read()
+    t0 = time.perf_counter()
+    ok = False
     try:
-        tmp_path = OUT_DIR / f"tmp_{uuid.uuid4().hex}.webm"
-        with open(tmp_path, "wb") as f:
-            f.write(await file.read())
+        pcm = await _run_blocking(_decode_to_pcm16, data)
+        user_text = await transcribe_pcm(pcm)
+        cleaned_text = (user_text or "").replace("\n", " ").strip()
+        ok = True
+        _log(f"[INFO] voice stt ok text={cleaned_text[:80]!r}")
+        return cleaned_text, None
+    except SpeechNotRecognized:
+        _log("[ERR] voice stt unknown")
+        return "", JSONResponse({"error": "音声を認識できませんでした"}, status_code=400)
+    except STTUnavailable as e:
+        _log(f"[ERR] voice stt request error: {e}")
+        return "", JSONResponse({"error": f"音声認識サービスに接続できません: {e}"}, status_code=502)
+    except RuntimeError as e:
+        _log(f"[ERR] voice decode: {e}")
+        return "", JSONResponse({"error": "音声を読み込めませんでした"}, status_code=400)
+    finally:
+        record_stage("stt", (time.perf_counter() - t0) * 1000, ok)
+        if not ok:
+            metrics.inc("errors_total", stage="stt")
 
-        wav_path = tmp_path.with_suffix(".wav")
-        AudioSegment.from_file(tmp_path, format="webm").export(wav_path, format="wav")
+# ==========================
+# API: ストリーミング版（NDJSON: 1行 = 1イベント）
+#   {"type":"stt","text":...}
+#   {"type":"segment","index":i,"text":...,"audio":"/audio/..."}
+#   {"type":"segment_error","index":i,"text":...,"error":...}  … 再試行しても合成できなかった文（音声は欠ける）
+#   {"type":"pose","pose":{...}}
+#   {"type":"done", ...通常版と同じ応答...} / {"type":"error","error":...,"status":...}
+# ==========================
+def _final_event(result: Dict[str, Any], user_text: str) -> Dict[str, Any]:
+    if "error" in result:
+        ev = {"type": "error", "error": result["error"], "status": result.get("status_code", 500)}
+        if result.get("retry_after"):
+            ev["retryAfter"] = result["retry_after"]
+        return ev
+    result["stt"] = user_text
+    return {"type": "done", **result}
 
-        rec = sr.Recognizer()
-        with sr.AudioFile(str(wav_path)) as src:
-            audio = rec.record(src)
 
+def _ndjson_reply_stream(
+    user_text: str,
+    styleId: Optional[int],
+    autoMode: Optional[str],
+    poseMode: Optional[str],
+    chatEngine: Optional[str],
+    first_events: Optional[List[Dict[str, Any]]] = None,
+    session_id: str = DEFAULT_SESSION_ID,
+    timings: Optional[Dict[str, Any]] = None,
+) -> StreamingResponse:
+    events: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+    for ev in first_events or []:
+        events.put_nowait(ev)
+
+    async def _worker():
         try:
-            user_text = rec.recognize_google(audio, language="ja-JP")
-            cleaned_text = (user_text or "").replace("\n", " ").strip()
-            _log(f"[INFO] voice stt ok text={cleaned_text[:80]!r}")
-        except sr.UnknownValueError:
-            _log("[ERR] voice stt unknown")
-            return JSONResponse({"error": "音声を認識できませんでした"}, status_code=400)
-        except sr.RequestError as e:
-            _log(f"[ERR] voice stt request error: {e}")
-            return JSONResponse({"error": f"音声認識サービスに接続できません: {e}"}, status_code=502)
+            result = await _process_chat_request(
+                user_text, styleId, autoMode, poseMode, chatEngine,
+                on_event=events.put_nowait, session_id=session_id, timings=timings,
+            )
+            events.put_nowait(_final_event(result, user_text))
+        except Exception as e:
+            _log(f"[ERR] stream worker failed: {e}")
+            events.put_nowait({"type": "error", "error": str(e), "status": 500})
+        finally:
+            events.put_nowait(None)
 
-        result = await _process_chat_request(cleaned_text, styleId, autoMode, poseMode, chatEngine)
+    async def _iter_lines():
+        # クライアントが切断しても生成は最後まで走らせる（履歴・音声の整合のため）
+        task = _spawn(_worker())
+        while True:
+            ev = await events.get()
+            if ev is None:
+                break
+            yield json.dumps(ev, ensure_ascii=False) + "\n"
+        await task
 
-        if "error" in result:
-            return JSONResponse({"error": result["error"]}, status_code=result.get("status_code", 500))
+    return StreamingResponse(
+        _iter_lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        result["stt"] = cleaned_text
-        return result
 
-    finally:
+@app.post("/api/text/stream")
+async def text_to_reply_stream(
+    text: str = Form(...),
+    styleId: Optional[int] = Form(None),
+    autoMode: Optional[str] = Form(None),
+    poseMode: Optional[str] = Form(None),
+    chatEngine: Optional[str] = Form(None),
+    sessionId: Optional[str] = Form(None),
+    x_session_id: Optional[str] = Header(None),
+):
+    user_text = (text or "").strip()
+    if not user_text:
+        return JSONResponse({"error": "テキストが空です"}, status_code=400)
+    return _ndjson_reply_stream(
+        user_text, styleId, autoMode, poseMode, chatEngine,
+        session_id=_session_id(sessionId, x_session_id),
+    )
+
+
+@app.post("/api/voice/stream")
+async def voice_to_reply_stream(
+    file: UploadFile = File(...),
+    styleId: Optional[int] = Form(None),
+    autoMode: Optional[str] = Form(None),
+    poseMode: Optional[str] = Form(None),
+    chatEngine: Optional[str] = Form(None),
+    sessionId: Optional[str] = Form(None),
+    x_session_id: Optional[str] = Header(None),
+):
+    timings = _begin_request_timings()
+    cleaned_text, err = await _recognize_upload(file)
+    if err is not None:
+        return err
+    return _ndjson_reply_stream(
+        cleaned_text, styleId, autoMode, poseMode, chatEngine,
+        first_events=[{"type": "stt", "text": cleaned_text}],
+        session_id=_session_id(sessionId, x_session_id),
+        timings=timings,
+    )
+
+# ==========================
+# API: 一括合成（挨拶・待機中のひとりごと・台本の台詞を事前に合成してキャッシュを温める）
+#   POST /api/batch/tts  file = JSONL（1行 = {"id"?, "text", "styleId"?, "prosody"?: {"speedScale": ...}}）
+#                        lipsync / pose = 1 で口パクトラック・首のタイムラインも付ける、concurrency = 同時合成数
+#   受信（NDJSON、終わった順）: {"type":"item","index":i,"id":...,"audio":"/audio/...","cached":bool,...}
+#                              / {"type":"item","index":i,"id":...,"error":...} → 最後に {"type":"done",...}
+#   会話は生成せず coeiroink_tts だけを通る。流量制御では "batch" という1セッションとして会話と交互に回す。
+#   CLI（再開・manifest 付き）は backend/batch.py
+# ==========================
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))          # 1リクエストあたりの件数上限
+BATCH_CONCURRENCY = max(1, int(os.getenv("BATCH_CONCURRENCY", str(admission["coeiroink"].limit))))  # 既定は合成の同時実行数
+BATCH_RETRY_MAX = int(os.getenv("BATCH_RETRY_MAX", "5"))           # 混雑（429/503）で断られたときの再試行回数
+BATCH_SESSION_ID = "batch"
+
+
+def _batch_item_id(text: str, style_id: Optional[int], prosody: Dict[str, Any]) -> str:
+    """id 未指定の行は内容から決める（同じ台詞は同じ id。backend/batch.py も同じ式を使う）。"""
+    raw = json.dumps([text, style_id, prosody], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _parse_batch_line(line: str) -> Dict[str, Any]:
+    """1行を検証して {"id","text","styleId","prosody"} にする。不正なら ValueError。"""
+    obj = json.loads(line)
+    if not isinstance(obj, dict):
+        raise ValueError("line is not an object")
+    text = str(obj.get("text") or "").strip()
+    if not text:
+        raise ValueError("text is empty")
+    style_id = obj.get("styleId")
+    if style_id is not None and (not isinstance(style_id, int) or style_id not in VALID_STYLE_IDS):
+        raise ValueError(f"invalid styleId: {style_id!r}")
+    prosody = obj.get("prosody") or {}
+    if not isinstance(prosody, dict):
+        raise ValueError("prosody is not an object")
+    # 範囲外は会話の監督と同じ範囲に丸める。指定の無いキーは DEFAULT_TTS のまま
+    clamped = _normalize_tts_params(prosody, style_id or 1, "")
+    prosody = {k: clamped[k] for k in _TTS_PARAM_KEYS if k in prosody}
+    item_id = str(obj.get("id") or _batch_item_id(text, style_id, prosody))
+    return {"id": item_id, "text": text, "styleId": style_id, "prosody": prosody}
+
+
+async def _render_batch_item(item: Dict[str, Any], *, lipsync: bool, pose: bool) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    style_id = item["styleId"] or RESOLVED_STYLE_ID or STYLE_PRESETS[0]["id"]
+    overrides = item["prosody"] or None
+    cached = TTS_CACHE_ENABLED and tts_cache.contains(_TTSCache.key_for(build_synthesis_payload(item["text"], style_id, overrides)))
+    attempt = 0
+    while True:
         try:
-            if tmp_path and tmp_path.exists():
-                tmp_path.unlink(missing_ok=True)
-            if wav_path and wav_path.exists():
-                wav_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+            path = await coeiroink_tts(item["text"], style_id=style_id, tts_overrides=overrides)
+            break
+        except AdmissionRejected as e:
+            # 会話の合成を優先し、混んでいる間は待ってからやり直す
+            attempt += 1
+            if attempt > BATCH_RETRY_MAX:
+                raise
+            await asyncio.sleep(e.retry_after)
+    rec: Dict[str, Any] = {
+        "id": item["id"], "text": item["text"], "styleId": style_id, "prosody": item["prosody"],
+        "audio": f"/audio/{path.name}", "cached": cached,
+    }
+    if lipsync:
+        rec["lipsync"] = await lipsync_for(path)
+    if pose:
+        rec["pose"] = await _with_deadline(
+            pose_timeline_by_gemma(item["text"]), POSE_DEADLINE_SEC, _fallback_pose(), "pose"
+        )
+    rec["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return rec
+
+
+@app.post("/api/batch/tts")
+async def batch_tts(
+    file: UploadFile = File(...),
+    lipsync: Optional[str] = Form(None),
+    pose: Optional[str] = Form(None),
+    concurrency: Optional[int] = Form(None),
+):
+    raw = (await file.read()).decode("utf-8-sig", "replace")
+    lines = [(i, ln) for i, ln in enumerate(raw.splitlines()) if ln.strip()]
+    if not lines:
+        return JSONResponse({"error": "JSONL が空です"}, status_code=400)
+    if len(lines) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            {"error": f"1回に送れるのは {BATCH_MAX_ITEMS} 行までです（{len(lines)} 行）"}, status_code=413
+        )
+    with_lipsync, with_pose = _parse_bool(lipsync), _parse_bool(pose)
+    limit = asyncio.Semaphore(max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)))
+    events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    counts = {"ok": 0, "cached": 0, "failed": 0, "duplicate": 0}
+
+    async def _one(index: int, item: Dict[str, Any]) -> None:
+        async with limit:
+            try:
+                rec = await _render_batch_item(item, lipsync=with_lipsync, pose=with_pose)
+            except AdmissionRejected as e:
+                rec = {"id": item["id"], "error": str(e), "status": e.status, "retryAfter": e.retry_after}
+            except Exception as e:
+                rec = {"id": item["id"], "error": str(e), "status": 502}
+        result = "error" if "error" in rec else "cached" if rec["cached"] else "ok"
+        counts["failed" if result == "error" else result] += 1
+        metrics.inc("batch_items_total", result=result)
+        events.put_nowait({"type": "item", "index": index, **rec})
+
+    async def _iter_lines():
+        t0 = time.perf_counter()
+        _request_session.set(BATCH_SESSION_ID)  # 以降に作るタスクへ引き継がれる
+        seen: Dict[str, int] = {}
+        tasks = []
+        for index, line in lines:
+            try:
+                item = _parse_batch_line(line)
+            except ValueError as e:
+                counts["failed"] += 1
+                metrics.inc("batch_items_total", result="invalid")
+                yield json.dumps({"type": "item", "index": index, "error": f"line {index + 1}: {e}", "status": 400},
+                                 ensure_ascii=False) + "\n"
+                continue
+            if item["id"] in seen:
+                counts["duplicate"] += 1
+                yield json.dumps({"type": "item", "index": index, "id": item["id"], "duplicateOf": seen[item["id"]]},
+                                 ensure_ascii=False) + "\n"
+                continue
+            seen[item["id"]] = index
+            # クライアントが切断しても合成は最後まで走らせる（キャッシュを温めるのが目的なので）
+            tasks.append(_spawn(_one(index, item)))
+        for _ in tasks:
+            yield json.dumps(await events.get(), ensure_ascii=False) + "\n"
+        done = {"type": "done", "items": len(lines), **counts, "ms": round((time.perf_counter() - t0) * 1000, 1)}
+        _log(f"[INFO] batch tts done {json.dumps(done, ensure_ascii=False)}")
+        yield json.dumps(done, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        _iter_lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ==========================
+# API: 音声ストリーミング入力（WebSocket /ws/voice）
+#   クエリ: styleId / autoMode / poseMode / chatEngine / sessionId（/api/voice と同じ意味）
+#   送信: バイナリ = 16kHz mono s16le の PCM（長さは任意）
+#         テキスト = {"type":"end"}（発話終了を明示。押して話す UI 用）
+#   受信: {"type":"vad","state":"start"|"end"} / {"type":"partial","text":...}
+#         以降は NDJSON 版と同じ stt / segment / pose / done / error
+# ==========================
+VAD_THRESHOLD = float(os.getenv("VAD_THRESHOLD", "500"))           # 有声とみなす RMS（16bit 振幅）
+VAD_START_MS = int(os.getenv("VAD_START_MS", "60"))                # これだけ有声が続いたら発話開始
+VAD_SILENCE_MS = int(os.getenv("VAD_SILENCE_MS", "600"))           # これだけ無音が続いたら発話終了
+VAD_PREROLL_MS = int(os.getenv("VAD_PREROLL_MS", "200"))           # 開始判定前の音声も頭に付ける
+VAD_MAX_UTTERANCE_SEC = float(os.getenv("VAD_MAX_UTTERANCE_SEC", "15"))
+VAD_FRAME_MS = 20
+
+
+class _EnergyVAD:
+    """20ms フレームの RMS で発話の開始/終了を判定する。push() は ("start"|"audio"|"end", pcm) の列を返す。"""
+
+    def __init__(self):
+        self.frame_bytes = STT_SAMPLE_RATE * VAD_FRAME_MS // 1000 * 2
+        self.in_speech = False
+        self._pending = bytearray()
+        self._voiced = 0
+        self._silent = 0
+        self._speech_frames = 0
+        self._preroll: "deque[bytes]" = deque(maxlen=max(1, VAD_PREROLL_MS // VAD_FRAME_MS))
+
+    @staticmethod
+    def _rms(frame: bytes) -> float:
+        samples = array("h")
+        samples.frombytes(frame)
+        if sys.byteorder != "little":
+            samples.byteswap()
+        return math.sqrt(sum(x * x for x in samples) / len(samples)) if samples else 0.0
+
+    def push(self, data: bytes) -> List[Tuple[str, bytes]]:
+        out: List[Tuple[str, bytes]] = []
+        self._pending += data
+        while len(self._pending) >= self.frame_bytes:
+            frame = bytes(self._pending[: self.frame_bytes])
+            del self._pending[: self.frame_bytes]
+            voiced = self._rms(frame) >= VAD_THRESHOLD
+            if not self.in_speech:
+                self._preroll.append(frame)
+                self._voiced = self._voiced + 1 if voiced else 0
+                if self._voiced * VAD_FRAME_MS >= VAD_START_MS:
+                    self.in_speech = True
+                    self._silent = 0
+                    self._speech_frames = len(self._preroll)
+                    out.append(("start", b"".join(self._preroll)))
+                    self._preroll.clear()
+                continue
+            out.append(("audio", frame))
+            self._speech_frames += 1
+            self._silent = 0 if voiced else self._silent + 1
+            if (
+                self._silent * VAD_FRAME_MS >= VAD_SILENCE_MS
+                or self._speech_frames * VAD_FRAME_MS >= VAD_MAX_UTTERANCE_SEC * 1000
+            ):
+                out.append(self.end())
+        return out
+
+    def end(self) -> Tuple[str, bytes]:
+        self.in_speech = False
+        self._voiced = 0
+        self._silent = 0
+        return ("end", b"")
+
+
+@app.websocket("/ws/voice")
+async def voice_ws(
+    ws: WebSocket,
+    styleId: Optional[int] = None,
+    autoMode: Optional[str] = None,
+    poseMode: Optional[str] = None,
+    chatEngine: Optional[str] = None,
+    sessionId: Optional[str] = None,
+):
+    await ws.accept()
+    session_id = _session_id(sessionId)
+    outbox: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    vad = _EnergyVAD()
+    stream: Optional[_STTStream] = None
+    replying: Optional[asyncio.Task] = None
+    last_partial = ""
+
+    async def _sender():
+        while True:
+            ev = await outbox.get()
+            await ws.send_text(json.dumps(ev, ensure_ascii=False))
+
+    async def _reply(utt: _STTStream):
+        _begin_request_timings()
+        t0 = time.perf_counter()
+        try:
+            text = (await utt.finish()).replace("\n", " ").strip()
+        except SpeechNotRecognized:
+            record_stage("stt", (time.perf_counter() - t0) * 1000, ok=False)
+            metrics.inc("errors_total", stage="stt")
+            outbox.put_nowait({"type": "error", "error": "音声を認識できませんでした", "status": 400})
+            return
+        except STTUnavailable as e:
+            record_stage("stt", (time.perf_counter() - t0) * 1000, ok=False)
+            metrics.inc("errors_total", stage="stt")
+            outbox.put_nowait({"type": "error", "error": f"音声認識サービスに接続できません: {e}", "status": 502})
+            return
+        # 発話終了から確定テキストまで（話している間の認識は含まない）
+        record_stage("stt", (time.perf_counter() - t0) * 1000)
+        _log(f"[INFO] ws voice stt ok ms={(time.perf_counter() - t0) * 1000:.0f} text={text[:80]!r}")
+        outbox.put_nowait({"type": "stt", "text": text})
+        try:
+            result = await _process_chat_request(
+                text, styleId, autoMode, poseMode, chatEngine,
+                on_event=outbox.put_nowait, session_id=session_id,
+            )
+            outbox.put_nowait(_final_event(result, text))
+        except Exception as e:
+            _log(f"[ERR] ws voice reply failed: {e}")
+            outbox.put_nowait({"type": "error", "error": str(e), "status": 500})
+
+    def _handle(kind: str, pcm: bytes) -> None:
+        nonlocal stream, replying, last_partial
+        if kind == "start":
+            stream = _stt().backend.open_stream()
+            last_partial = ""
+            outbox.put_nowait({"type": "vad", "state": "start"})
+        if stream is None:
+            return
+        if pcm:
+            stream.feed(pcm)
+            partial = stream.partial()
+            if partial and partial != last_partial:
+                last_partial = partial
+                outbox.put_nowait({"type": "partial", "text": partial})
+        if kind == "end":
+            outbox.put_nowait({"type": "vad", "state": "end"})
+            replying = _spawn(_reply(stream))
+            stream = None
+
+    sender = _spawn(_sender())
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            # 返答の生成中は聞かない（自分の声を拾わないよう半二重にする）
+            busy = replying is not None and not replying.done()
+            if msg.get("bytes") is not None:
+                if not busy:
+                    for kind, pcm in vad.push(msg["bytes"]):
+                        _handle(kind, pcm)
+            elif msg.get("text"):
+                try:
+                    ctrl = json.loads(msg["text"])
+                except Exception:
+                    continue
+                if ctrl.get("type") == "end" and vad.in_speech and not busy:
+                    _handle(*vad.end())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+
+
 @app.get("/audio/{filename}")
-def get_audio(filename: str):
-    path = OUT_DIR / filename
-    if not path.exists():
+async def get_audio(
+    filename: str,
+    fmt: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
+):
+    path = audio_artifacts.resolve(filename)
+    if shared_state is not None:
+        if path is not None and not path.exists():
+            audio_artifacts.forget(filename)  # 同じ OUT_DIR を使う他のワーカーが掃除した
+            path = None
+        if path is None and await _run_blocking(audio_artifacts.adopt, filename):
+            # 他のワーカー/ノードが作った音声（ロードバランサの振り分け先が違った）
+            path = audio_artifacts.resolve(filename)
+    if path is None:
         return JSONResponse({"error": "not found"}, status_code=404)
-    return FileResponse(path, media_type="audio/wav")
+    media_type = "audio/wav"
+    want = _negotiate_audio_format(fmt, accept)
+    if want != "wav":
+        variant = audio_artifacts.variant(filename, want)
+        if variant is not None:
+            path, media_type = variant, AUDIO_FORMATS[want][1]
+        else:
+            # まだ変換が終わっていなければ今回は WAV を返す
+            _schedule_transcode(path, [want])
+    # 送信中は掃除の対象から外す（Range 要求は FileResponse が 206 で返す）
+    audio_artifacts.pin(filename)
+    return FileResponse(
+        path,
+        media_type=media_type,
+        headers={"Vary": "Accept"},
+        background=BackgroundTask(audio_artifacts.unpin, filename),
+    )
 
 # ==========================
 # フロント配信
@@ -0,0 +1,193 @@
+﻿"""
+台本の一括合成（挨拶・待機中のひとりごと・シナリオの台詞を事前に合成する）
+
+JSONL（1行 = {"id": 任意, "text": ..., "styleId": 任意, "prosody": {"speedScale": ...}}）を
+--chunk 行ずつ /api/batch/tts に送り、サーバーの TTS キャッシュを温める。会話は生成しない。
+結果は --out に書く:
+  manifest.jsonl … 1件終わるごとに追記（再開用）。成功済みの id は次回送らない
+  manifest.json  … 入力順にまとめた最終版（id → 音声 URL / 口パク / ポーズ）
+  audio/<id>.wav … --download を付けたとき（サーバーの掃除に左右されずに配信できる）
+
+  cd shisaku
+  python -m backend.batch scripts/greetings.jsonl --out prerender/greetings --lipsync --pose
+  python -m backend.batch scripts/greetings.jsonl --out prerender/greetings --download   # 中断後も同じコマンドで再開
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+
+def _item_id(text: str, style_id: Optional[int], prosody: Dict[str, Any]) -> str:
+    # サーバーの _batch_item_id と同じ式（id 未指定の行は内容で決まる）。prosody はサーバーが丸める前の値
+    raw = json.dumps([text, style_id, prosody], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def load_script(path: Path) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """(id を付けた行, 読めなかった行の説明)。id が重なる行は最初のものだけ使う。"""
+    items: List[Dict[str, Any]] = []
+    errors: List[str] = []
+    seen = set()
+    for n, line in enumerate(path.read_text(encoding="utf-8-sig").splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            text = str(obj.get("text") or "").strip()
+            if not text:
+                raise ValueError("text is empty")
+        except (ValueError, AttributeError) as e:
+            errors.append(f"{path.name}:{n}: {e}")
+            continue
+        obj["id"] = str(obj.get("id") or _item_id(text, obj.get("styleId"), obj.get("prosody") or {}))
+        if obj["id"] in seen:
+            continue
+        seen.add(obj["id"])
+        items.append(obj)
+    return items, errors
+
+
+def load_done(manifest: Path, audio_dir: Optional[Path]) -> Dict[str, Dict[str, Any]]:
+    """前回までに成功した id → 結果（--download 時はファイルが残っているものだけ）。"""
+    done: Dict[str, Dict[str, Any]] = {}
+    if not manifest.exists():
+        return done
+    for line in manifest.read_text(encoding="utf-8").splitlines():
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue  # 中断で書きかけになった最後の行
+        if "error" in rec or "id" not in rec:
+            continue
+        if audio_dir is not None and not (audio_dir / f"{rec['id']}.wav").exists():
+            continue
+        done[rec["id"]] = rec
+    return done
+
+
+def _download(client: httpx.Client, base: str, rec: Dict[str, Any], audio_dir: Path) -> None:
+    dst = audio_dir / f"{rec['id']}.wav"
+    tmp = dst.with_name(dst.name + ".part")
+    with client.stream("GET", base + rec["audio"]) as r:
+        r.raise_for_status()
+        with open(tmp, "wb") as f:
+            for chunk in r.iter_bytes():
+                f.write(chunk)
+    tmp.replace(dst)
+    rec["file"] = str(dst.relative_to(audio_dir.parent))
+
+
+def run_chunk(client: httpx.Client, args: argparse.Namespace, chunk: List[Dict[str, Any]], on_item) -> Dict[str, Any]:
+    body = "\n".join(json.dumps(it, ensure_ascii=False) for it in chunk) + "\n"
+    form = {"lipsync": "1" if args.lipsync else "0", "pose": "1" if args.pose else "0"}
+    if args.concurrency:
+        form["concurrency"] = str(args.concurrency)
+    files = {"file": ("script.jsonl", body.encode("utf-8"), "application/x-ndjson")}
+    summary: Dict[str, Any] = {}
+    with client.stream("POST", args.server + "/api/batch/tts", data=form, files=files) as r:
+        if r.status_code != 200:
+            r.read()
+            raise RuntimeError(f"HTTP {r.status_code}: {r.text[:200]}")
+        for line in r.iter_lines():
+            if not line.strip():
+                continue
+            ev = json.loads(line)
+            if ev.get("type") == "done":
+                summary = ev
+            elif "duplicateOf" not in ev:
+                on_item(chunk[ev["index"]], ev)
+    if not summary:
+        raise RuntimeError("stream ended before done")  # 途中で切れた: 書けた分は manifest.jsonl に残っている
+    return summary
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="台本（JSONL）を一括で事前合成する")
+    ap.add_argument("script", help="入力 JSONL")
+    ap.add_argument("--out", required=True, help="manifest と（--download 時の）音声の出力先")
+    ap.add_argument("--server", default="http://127.0.0.1:8000")
+    ap.add_argument("--chunk", type=int, default=50, help="1リクエストで送る行数（中断時にやり直す単位）")
+    ap.add_argument("--concurrency", type=int, help="同時合成数（サーバーの BATCH_CONCURRENCY が上限）")
+    ap.add_argument("--lipsync", action="store_true", help="口パクトラックも manifest に入れる")
+    ap.add_argument("--pose", action="store_true", help="首のタイムラインも manifest に入れる（Ollama を使う）")
+    ap.add_argument("--download", action="store_true", help="音声を --out/audio/<id>.wav に保存する")
+    ap.add_argument("--retries", type=int, default=3, help="接続が切れたチャンクをやり直す回数")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    args = ap.parse_args()
+    args.server = args.server.rstrip("/")
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    audio_dir = out / "audio" if args.download else None
+    if audio_dir is not None:
+        audio_dir.mkdir(exist_ok=True)
+    manifest_log = out / "manifest.jsonl"
+
+    items, errors = load_script(Path(args.script))
+    for e in errors:
+        print(f"[batch] skip {e}", file=sys.stderr)
+    done = load_done(manifest_log, audio_dir)
+    todo = [it for it in items if it["id"] not in done]
+    print(f"[batch] items={len(items)} done={len(items) - len(todo)} todo={len(todo)}", file=sys.stderr)
+
+    totals = {"ok": 0, "cached": 0, "failed": 0}
+    failed: Dict[str, Dict[str, Any]] = {}
+    t0 = time.perf_counter()
+    with httpx.Client(timeout=args.timeout) as client, open(manifest_log, "a", encoding="utf-8") as log:
+        def on_item(item: Dict[str, Any], ev: Dict[str, Any]) -> None:
+            rec = {"id": item["id"], **{k: v for k, v in ev.items() if k not in ("type", "index")}}
+            if "error" not in rec and audio_dir is not None:
+                try:
+                    _download(client, args.server, rec, audio_dir)
+                except Exception as e:
+                    rec = {"id": item["id"], "error": f"download: {e}"}
+            if "error" in rec:
+                failed[item["id"]] = rec
+                totals["failed"] += 1
+                print(f"[batch] fail id={item['id']}: {rec['error']}", file=sys.stderr)
+            else:
+                failed.pop(item["id"], None)
+                done[item["id"]] = rec
+                totals["cached" if rec.get("cached") else "ok"] += 1
+            log.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            log.flush()
+
+        for start in range(0, len(todo), max(1, args.chunk)):
+            for attempt in range(args.retries + 1):
+                chunk = [it for it in todo[start:start + args.chunk] if it["id"] not in done]
+                if not chunk:
+                    break
+                try:
+                    run_chunk(client, args, chunk, on_item)
+                    break
+                except (httpx.HTTPError, RuntimeError) as e:
+                    print(f"[batch] chunk at {start} failed (attempt {attempt + 1}): {e}", file=sys.stderr)
+                    if attempt == args.retries:
+                        sys.exit(f"[batch] giving up; rerun the same command to resume ({manifest_log})")
+                    time.sleep(min(30, 2 ** attempt))
+            print(f"[batch] {min(start + args.chunk, len(todo))}/{len(todo)} {totals}", file=sys.stderr)
+
+    manifest = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "server": args.server,
+        "script": str(args.script),
+        "items": [done.get(it["id"]) or failed.get(it["id"]) or {"id": it["id"], "error": "not rendered"} for it in items],
+    }
+    tmp = out / "manifest.json.part"
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(out / "manifest.json")
+    ms = (time.perf_counter() - t0) * 1000
+    print(f"[batch] done {totals} in {ms / 1000:.1f}s → {out / 'manifest.json'}", file=sys.stderr)
+    if any("error" in rec for rec in manifest["items"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+﻿"""
+リクエスト処理のレイテンシ計測（ベンチマーク）
+
+Ollama / COEIROINK / Gemini の偽サーバーをローカルで立て、backend.app を uvicorn で起動して
+/api/text（と /api/voice）に N 並列でリクエストを投げる。モードごとにスループット・
+最初の音声までの時間（TTFA）・p50/p95/p99 を出す。
+
+  cd shisaku
+  python -m backend.bench --modes cloud,local,local4,auto --concurrency 4 --requests 20
+  python -m backend.bench --token-ms 40 --synth-ms 150 --fail-rate ollama=0.1 --json before.json
+
+--stream を付けると /api/text/stream（NDJSON）を使い、TTFA をクライアント側で最初の segment
+を受け取った時刻で測る。付けない場合はサーバーが返す timings.first_audio を使う。
+/api/voice は STT_ENGINE=fixed で認識部分を固定にして測る（デコードに ffmpeg が必要）。
+
+--segmenter はサーバーを立てずに文の切り出し（_Segmenter）だけを測る。毎トークン全体を
+走査し直す旧方式と比べ、1トークンあたりの処理時間と切り出される文の長さを出す。
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT_DIR = Path(__file__).resolve().parent.parent  # shisaku/
+
+# モード → フォームの中身
+MODES: Dict[str, Dict[str, str]] = {
+    "cloud": {"chatEngine": "cloud"},
+    "local": {"chatEngine": "local"},
+    "local4": {"chatEngine": "local4"},
+    "auto": {"chatEngine": "local", "autoMode": "1"},
+    "cloud-auto": {"chatEngine": "cloud", "autoMode": "1"},
+}
+
+REPLY_TOKENS = ["こんにちは", "！", "今日は", "とても", "いい天気", "だね。", "一緒に", "散歩", "しない", "？", "きっと", "楽しい", "よ。"]
+DIRECTOR_JSON = {
+    "styleId": 40, "speedScale": 1.05, "volumeScale": 1.0, "pitchScale": 0.05, "intonationScale": 1.1,
+    "prePhonemeLength": 0.1, "postPhonemeLength": 0.5, "outputSamplingRate": 24000, "reason": "bench",
+    "head": {"timeline": [[0.0, 0.0], [0.4, 0.2], [1.0, 0.0]]},
+}
+
+
+# ==========================
+# 偽サーバー
+# ==========================
+class FakeConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.token_ms = args.token_ms
+        self.ttft_ms = args.ttft_ms
+        self.director_ms = args.director_ms
+        self.synth_ms = args.synth_ms
+        self.synth_ms_per_char = args.synth_ms_per_char
+        self.gemini_ms = args.gemini_ms
+        self.fail = dict(args.fail_rate)
+        self.calls: Dict[str, int] = {"ollama": 0, "coeiroink": 0, "gemini": 0}
+        self.failures: Dict[str, int] = {"ollama": 0, "coeiroink": 0, "gemini": 0}
+        self._lock = threading.Lock()
+        self._rng = random.Random(args.seed)
+
+    def hit(self, backend: str) -> bool:
+        """呼び出しを数え、故障注入するなら True を返す。"""
+        with self._lock:
+            self.calls[backend] += 1
+            failed = self._rng.random() < self.fail.get(backend, 0.0)
+            if failed:
+                self.failures[backend] += 1
+            return failed
+
+
+def _wav_bytes(seconds: float, rate: int = 24000) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        n = int(rate * seconds)
+        w.writeframes(b"".join(struct.pack("<h", int(6000 * math.sin(i / 12))) for i in range(n)))
+    return buf.getvalue()
+
+
+def _make_handler(cfg: FakeConfig, backend: str):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *a):
+            pass
+
+        def _send(self, status: int, body: bytes, ctype: str = "application/json") -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, obj: Dict[str, Any]) -> None:
+            data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if backend == "ollama":
+                self._send(200, b'{"models":[]}')
+            elif backend == "coeiroink":
+                self._send(200, b"[]")
+            else:
+                self._send(404, b"{}")
+
+        def do_POST(self):
+            n = int(self.headers.get("Content-Length") or 0)
+            try:
+                req = json.loads(self.rfile.read(n) or b"{}")
+            except Exception:
+                req = {}
+            if cfg.hit(backend):
+                self._send(500, b'{"error":"injected failure"}')
+                return
+            getattr(self, f"_{backend}")(req)
+
+        def _ollama(self, req: Dict[str, Any]) -> None:
+            chat = self.path.endswith("/api/chat")
+            if "prompt" not in req and "messages" not in req:
+                self._send(200, b'{"done":true}')  # warm-up
+                return
+            if not req.get("stream", True):
+                # 監督/ポーズ（format 付き、または JSON を要求するプロンプト）
+                time.sleep(cfg.director_ms / 1000)
+                text = json.dumps(DIRECTOR_JSON) if (req.get("format") or not chat) else "".join(REPLY_TOKENS)
+                body = {"message": {"role": "assistant", "content": text}} if chat else {"response": text}
+                self._send(200, json.dumps({**body, "done": True}, ensure_ascii=False).encode("utf-8"))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(cfg.ttft_ms / 1000)
+            for tok in REPLY_TOKENS:
+                self._chunk({"message": {"role": "assistant", "content": tok}, "done": False} if chat
+                            else {"response": tok, "done": False})
+                time.sleep(cfg.token_ms / 1000)
+            self._chunk({"done": True})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _coeiroink(self, req: Dict[str, Any]) -> None:
+            text = str(req.get("text", ""))
+            time.sleep((cfg.synth_ms + cfg.synth_ms_per_char * len(text)) / 1000)
+            rate = int(req.get("outputSamplingRate") or 24000)
+            self._send(200, _wav_bytes(min(3.0, 0.12 * max(1, len(text))), rate), "audio/wav")
+
+        def _gemini(self, req: Dict[str, Any]) -> None:
+            time.sleep(cfg.gemini_ms / 1000)
+            want_json = "application/json" in json.dumps(req.get("generationConfig", {}))
+            contents = json.dumps(req.get("contents", []), ensure_ascii=False)
+            if want_json or "JSON" in contents:
+                text = json.dumps(DIRECTOR_JSON)
+            else:
+                text = "".join(REPLY_TOKENS)
+            body = {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                "usageMetadata": {"promptTokenCount": 1, "candidatesTokenCount": 1, "totalTokenCount": 2},
+            }
+            self._send(200, json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+    return Handler
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fakes(cfg: FakeConfig) -> Dict[str, str]:
+    urls = {}
+    for backend in ("ollama", "coeiroink", "gemini"):
+        port = _free_port()
+        srv = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(cfg, backend))
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        urls[backend] = f"http://127.0.0.1:{port}"
+    return urls
+
+
+# ==========================
+# アプリ起動
+# ==========================
+def start_app(urls: Dict[str, str], args: argparse.Namespace) -> "tuple[subprocess.Popen, str]":
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_API_KEY": env.get("GEMINI_API_KEY") or "bench",
+        "GEMINI_BASE_URL": urls["gemini"],
+        "OLLAMA_BASE_URL": urls["ollama"],
+        "COEIROINK_URL": urls["coeiroink"],
+        "TTS_CACHE": "1" if args.tts_cache else "0",
+        "STT_ENGINE": "fixed",
+        "OLLAMA_WARMUP": "0",
+    })
+    for kv in args.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    cmd = [sys.executable, "-m", "uvicorn", "backend.app:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=str(ROOT_DIR), env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"backend.app が起動できませんでした (exit={proc.returncode})")
+        try:
+            if httpx.get(f"{base}/api/styles", timeout=1).status_code == 200:
+                return proc, base
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("backend.app の起動待ちがタイムアウトしました")
+
+
+# ==========================
+# 負荷生成と集計
+# ==========================
+def _pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(math.ceil(p * len(s))) - 1)], 1)
+
+
+async def _one(client: httpx.AsyncClient, base: str, kind: str, form: Dict[str, str], stream: bool,
+               voice_wav: bytes, sid: str) -> Dict[str, Any]:
+    path = "/api/voice" if kind == "voice" else "/api/text"
+    if stream:
+        path += "/stream"
+    data = {**form, "sessionId": sid}
+    files = None
+    if kind == "voice":
+        files = {"file": ("input.wav", voice_wav, "audio/wav")}
+    else:
+        data["text"] = "ねえ、今日はなにして遊ぶ？"
+    t0 = time.perf_counter()
+    ttfa = None
+    missing = 0
+    try:
+        if stream:
+            final: Dict[str, Any] = {}
+            async with client.stream("POST", base + path, data=data, files=files) as r:
+                if r.status_code != 200:
+                    return {"ok": False, "ms": (time.perf_counter() - t0) * 1000}
+                async for line in r.aiter_lines():
+                    if not line:
+                        continue
+                    ev = json.loads(line)
+                    if ev.get("type") == "segment" and ttfa is None:
+                        ttfa = (time.perf_counter() - t0) * 1000
+                    if ev.get("type") == "segment_error":
+                        missing += 1
+                    if ev.get("type") in ("done", "error"):
+                        final = ev
+            ok = final.get("type") == "done"
+        else:
+            r = await client.post(base + path, data=data, files=files)
+            final = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
+            ok = r.status_code == 200 and "error" not in final
+            ttfa = (final.get("timings") or {}).get("first_audio")
+    except Exception:
+        return {"ok": False, "ms": (time.perf_counter() - t0) * 1000}
+    return {
+        "ok": ok, "ms": (time.perf_counter() - t0) * 1000, "ttfa": ttfa, "timings": final.get("timings") or {},
+        "missing_segments": missing,
+    }
+
+
+async def run_mode(base: str, mode: str, kind: str, args: argparse.Namespace, voice_wav: bytes) -> Dict[str, Any]:
+    form = MODES[mode]
+    results: List[Dict[str, Any]] = []
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        # ウォームアップ（接続確立・初回の遅延を除く）
+        await _one(client, base, kind, form, args.stream, voice_wav, f"bench-warm-{mode}")
+
+        async def worker(w: int) -> None:
+            for i in range(args.requests):
+                results.append(await _one(client, base, kind, form, args.stream, voice_wav, f"bench-{mode}-{w}"))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+        wall = time.perf_counter() - t0
+
+    ok = [r for r in results if r["ok"]]
+    lat = [r["ms"] for r in ok]
+    ttfa = [r["ttfa"] for r in ok if r.get("ttfa") is not None]
+    stages: Dict[str, List[float]] = {}
+    for r in ok:
+        for k, v in r["timings"].items():
+            if isinstance(v, (int, float)):
+                stages.setdefault(k, []).append(float(v))
+    return {
+        "mode": mode,
+        "endpoint": kind,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "missing_segments": sum(r.get("missing_segments", 0) for r in results),  # --stream のみ: 再試行しても合成できなかった文
+        "wall_sec": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 2) if wall > 0 else 0.0,
+        "latency_ms": {"p50": _pct(lat, 0.5), "p95": _pct(lat, 0.95), "p99": _pct(lat, 0.99)},
+        "ttfa_ms": {"p50": _pct(ttfa, 0.5), "p95": _pct(ttfa, 0.95), "p99": _pct(ttfa, 0.99)},
+        "stages_p50_ms": {k: _pct(v, 0.5) for k, v in sorted(stages.items())},
+    }
+
+
+def _print_table(rows: List[Dict[str, Any]]) -> None:
+    head = f"{'mode':<11}{'ep':<6}{'n':>5}{'err':>5}{'rps':>8}{'lat p50':>9}{'p95':>8}{'p99':>8}{'ttfa p50':>10}{'p95':>8}{'p99':>8}"
+    print(head)
+    print("-" * len(head))
+    fmt = lambda v: "-" if v is None else f"{v:.0f}"  # noqa: E731
+    for r in rows:
+        l, t = r["latency_ms"], r["ttfa_ms"]
+        print(
+            f"{r['mode']:<11}{r['endpoint']:<6}{r['requests']:>5}{r['errors']:>5}{r['throughput_rps']:>8.2f}"
+            f"{fmt(l['p50']):>9}{fmt(l['p95']):>8}{fmt(l['p99']):>8}{fmt(t['p50']):>10}{fmt(t['p95']):>8}{fmt(t['p99']):>8}"
+        )
+
+
+# ==========================
+# 文の切り出しのマイクロベンチ
+# ==========================
+_LEGACY_SENT_END = {"。", "！", "？", ".", "!", "?", "．"}
+
+
+def _legacy_split(accum: str) -> "tuple[List[str], str]":
+    # 旧 _split_sentences（毎回バッファ全体を走査し、句点だけで切る）
+    out: List[str] = []
+    start = 0
+    for i, ch in enumerate(accum):
+        if ch in _LEGACY_SENT_END:
+            seg = accum[start:i + 1].strip()
+            if seg:
+                out.append(seg)
+            start = i + 1
+    return out, accum[start:].lstrip()
+
+
+def _segmenter_corpus(replies: int, seed: int) -> List[List[str]]:
+    """句点の少ない長い節・短い相づち・括弧・絵文字を混ぜた返答をトークン（1〜3文字）に刻む。"""
+    rng = random.Random(seed)
+    parts = [
+        "うん！", "そうだね。", "えっと、", "今日はとってもいい天気だから、", "一緒に散歩しに行かない？",
+        "「それ、ほんと？」って思ったでしょ", "😊", "駅前の新しいカフェのケーキがすごくおいしいらしくて", "3.14 とか",
+        "ちょっと待ってね…", "わたしはずっと前から行ってみたかったんだけど", "ね！", "(笑)", "きっと楽しいよ。",
+    ]
+    corpus = []
+    for _ in range(replies):
+        text = "".join(rng.choice(parts) for _ in range(rng.randint(4, 14)))
+        toks, i = [], 0
+        while i < len(text):
+            k = rng.randint(1, 3)
+            toks.append(text[i:i + k])
+            i += k
+        corpus.append(toks)
+    return corpus
+
+
+def run_segmenter_bench(args: argparse.Namespace) -> Dict[str, Any]:
+    sys.path.insert(0, str(ROOT_DIR))
+    from backend.app import _Segmenter  # import は軽い（重いクライアントは遅延生成）
+
+    corpus = _segmenter_corpus(args.requests * 50, args.seed)
+    n_tokens = sum(len(t) for t in corpus)
+
+    # どちらも (切り出した文, 最初の文が出たトークン位置) を返す
+    def legacy(toks: List[str]) -> "tuple[List[str], int]":
+        out, buf, first = [], "", len(toks)
+        for i, tok in enumerate(toks):
+            buf += tok
+            segs, buf = _legacy_split(buf)
+            if segs and not out:
+                first = i
+            out += segs
+        return out + ([buf.strip()] if buf.strip() else []), first
+
+    def incremental(toks: List[str]) -> "tuple[List[str], int]":
+        sg, out, first = _Segmenter(), [], len(toks)
+        for i, tok in enumerate(toks):
+            segs = sg.feed(tok)
+            if segs and not out:
+                first = i
+            out += segs
+        return out + sg.flush(), first
+
+    report: Dict[str, Any] = {"replies": len(corpus), "tokens": n_tokens}
+    for name, fn in (("legacy", legacy), ("segmenter", incremental)):
+        t0 = time.perf_counter()
+        results = [fn(toks) for toks in corpus]
+        us = (time.perf_counter() - t0) * 1e6
+        lens = [len(c) for cs, _ in results for c in cs]
+        firsts = [len(cs[0]) for cs, _ in results if cs]
+        report[name] = {
+            "us_per_token": round(us / n_tokens, 3),
+            "chunks_per_reply": round(len(lens) / len(corpus), 2),
+            "chunk_len": {"p50": _pct(lens, 0.5), "max": max(lens), "under_4": sum(1 for x in lens if x < 4)},
+            "first_chunk_len_p50": _pct(firsts, 0.5),
+            # 最初の文を TTS に渡せるまでに読んだトークン数（TTFA の目安）
+            "first_chunk_at_token": {"p50": _pct([f for _, f in results], 0.5), "p95": _pct([f for _, f in results], 0.95)},
+        }
+    return report
+
+
+def _parse_fail_rate(v: str) -> "tuple[str, float]":
+    k, _, rate = v.partition("=")
+    if k not in ("ollama", "coeiroink", "gemini"):
+        raise argparse.ArgumentTypeError("ollama=0.1 / coeiroink=0.05 / gemini=0.2 の形式で指定してください")
+    return k, float(rate)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="vrm_talk バックエンドの E2E レイテンシ計測")
+    ap.add_argument("--modes", default="cloud,local,local4,auto", help=f"カンマ区切り: {','.join(MODES)}")
+    ap.add_argument("--endpoints", default="text", help="text,voice（voice は ffmpeg が必要）")
+    ap.add_argument("--concurrency", type=int, default=4, help="同時クライアント数")
+    ap.add_argument("--requests", type=int, default=10, help="クライアントあたりのリクエスト数")
+    ap.add_argument("--stream", action="store_true", help="NDJSON 版を使い TTFA をクライアント側で測る")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--token-ms", type=float, default=25.0, help="偽 Ollama のトークン間隔")
+    ap.add_argument("--ttft-ms", type=float, default=150.0, help="偽 Ollama の最初のトークンまで")
+    ap.add_argument("--director-ms", type=float, default=300.0, help="偽 Ollama の非ストリーム応答（監督/ポーズ）")
+    ap.add_argument("--synth-ms", type=float, default=120.0, help="偽 COEIROINK の固定遅延")
+    ap.add_argument("--synth-ms-per-char", type=float, default=4.0, help="偽 COEIROINK の1文字あたり遅延")
+    ap.add_argument("--gemini-ms", type=float, default=700.0, help="偽 Gemini の応答遅延")
+    ap.add_argument("--fail-rate", type=_parse_fail_rate, action="append", default=[],
+                    help="故障注入（例: --fail-rate ollama=0.1）。複数指定可")
+    ap.add_argument("--tts-cache", action="store_true", help="TTS キャッシュを有効のまま測る（既定は無効）")
+    ap.add_argument("--env", action="append", default=[], help="アプリに渡す追加の環境変数 KEY=VALUE")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", dest="json_out", help="結果を JSON で保存（比較用）")
+    ap.add_argument("--segmenter", action="store_true", help="文の切り出しのマイクロベンチだけを行う")
+    args = ap.parse_args()
+
+    if args.segmenter:
+        report = run_segmenter_bench(args)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if args.json_out:
+            Path(args.json_out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        return
+
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        ap.error(f"unknown mode: {', '.join(unknown)}")
+    kinds = [k.strip() for k in args.endpoints.split(",") if k.strip()]
+    if "voice" in kinds and not shutil.which(os.getenv("FFMPEG_BIN") or "ffmpeg"):
+        print("[bench] ffmpeg が見つからないので /api/voice は省略します", file=sys.stderr)
+        kinds = [k for k in kinds if k != "voice"]
+
+    cfg = FakeConfig(args)
+    urls = start_fakes(cfg)
+    proc, base = start_app(urls, args)
+    voice_wav = _wav_bytes(1.5, 16000)
+    rows: List[Dict[str, Any]] = []
+    try:
+        for kind in kinds:
+            for mode in modes:
+                rows.append(asyncio.run(run_mode(base, mode, kind, args, voice_wav)))
+                print(f"[bench] {kind}/{mode} done", file=sys.stderr)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    _print_table(rows)
+    print(f"\nbackend calls: {cfg.calls}  injected failures: {cfg.failures}")
+    if args.json_out:
+        report = {
+            "config": {k: v for k, v in vars(args).items() if k != "json_out"},
+            "results": rows,
+            "backend_calls": cfg.calls,
+            "injected_failures": cfg.failures,
+        }
+        Path(args.json_out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
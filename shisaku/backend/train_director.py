@@ -0,0 +1,199 @@
+﻿"""
+音声監督のローカル分類器（文字 n-gram ＋ 線形モデル）の学習・書き出し・オフライン評価
+
+LLM の監督が実際に決めた結果を教師にして styleId を当てる多クラスのロジスティック回帰を学習し、
+アプリが読む .npz（DIRECTOR_CLASSIFIER_PATH）に書き出す。話速などの数値はスタイルごとの平均を持つ。
+教師データは次のどちらか（両方可）:
+  - 監督ログ（DIRECTOR_LOG_JSONL=1 で outputs/director.jsonl に溜まる）
+  - 監督キャッシュ（outputs/tts/director_cache.json。発話は正規化済みで句読点が落ちている）
+
+  cd shisaku
+  python -m backend.train_director --log outputs/director.jsonl --cache outputs/tts/director_cache.json
+  python -m backend.train_director --log outputs/director.jsonl --eval-only   # 今のモデルを測るだけ
+
+一部（--holdout）を取り分けて正解率・確信度のしきい値ごとの「即答できる割合」と正解率・
+1件あたりの判定時間を出し、キーワード推定（_keyword_style）とも比べる。そのあと全件で学習し直して書き出す。
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import time
+import unicodedata
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent  # shisaku/
+
+Sample = Tuple[str, Dict[str, Any]]  # (発話, LLM が決めた TTS パラメータ)
+
+
+def _dedup_key(text: str) -> str:
+    s = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in s if not ch.isspace())
+
+
+def load_samples(logs: List[str], caches: List[str], valid_styles: set) -> List[Sample]:
+    """同じ発話が何度も出てきたら新しい方を使う。styleId が不正なものは捨てる。"""
+    found: Dict[str, Sample] = {}
+
+    def _add(text: str, tts: Any) -> None:
+        if not text or not isinstance(tts, dict) or tts.get("styleId") not in valid_styles:
+            return
+        key = _dedup_key(text)
+        found.pop(key, None)
+        found[key] = (text, tts)
+
+    for p in logs:
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                _add(str(rec.get("text", "")), rec.get("tts"))
+    for p in caches:
+        for item in json.loads(Path(p).read_text(encoding="utf-8")):
+            kind, _, rest = str(item.get("key", "")).partition("\t")
+            value = json.loads(item["value"])
+            if kind == "tts":
+                _add(rest, value)
+            elif kind == "combined":
+                user, _, reply = rest.partition("|")
+                _add(reply or user, value.get("tts"))
+    return list(found.values())
+
+
+def fit(samples: List[Sample], *, buckets: int, n_max: int, epochs: int, lr: float, l2: float, seed: int):
+    """確率的勾配法で学習する（触った列だけに L2 をかける）。"""
+    import numpy as np
+    from backend.app import _StyleClassifier, _TTS_PARAM_KEYS, _char_ngrams
+
+    classes = sorted({int(t["styleId"]) for _, t in samples})
+    col = {c: i for i, c in enumerate(classes)}
+    feats = []
+    for text, tts in samples:
+        idx, vals = _char_ngrams(text, n_max=n_max, buckets=buckets)
+        feats.append((np.asarray(idx), np.asarray(vals, dtype=np.float32), col[int(tts["styleId"])]))
+
+    W = np.zeros((len(classes), buckets), dtype=np.float32)
+    b = np.zeros(len(classes), dtype=np.float32)
+    order = list(range(len(feats)))
+    rng = random.Random(seed)
+    for ep in range(epochs):
+        rng.shuffle(order)
+        eta = lr / (1.0 + ep)
+        for i in order:
+            idx, v, y = feats[i]
+            w = W[:, idx]
+            z = w @ v + b
+            g = np.exp(z - z.max())
+            g /= g.sum()
+            g[y] -= 1.0
+            W[:, idx] = w - eta * (np.outer(g, v) + l2 * w)
+            b -= eta * g
+
+    # 数値パラメータはスタイルごとの平均（_normalize_tts_params で範囲に収めてから平均する）
+    from backend.app import _normalize_tts_params
+
+    params = np.zeros((len(classes), len(_TTS_PARAM_KEYS)), dtype=np.float32)
+    for c, k in col.items():
+        rows = [_normalize_tts_params(t, c, "") for _, t in samples if int(t["styleId"]) == c]
+        params[k] = [sum(float(r[key]) for r in rows) / len(rows) for key in _TTS_PARAM_KEYS]
+
+    meta = {
+        "version": 1, "n_max": n_max, "buckets": buckets, "samples": len(samples),
+        "trained_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+    return _StyleClassifier(W, b, classes, params, meta)
+
+
+def _pct(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(math.ceil(p * len(s))) - 1)], 1)
+
+
+def evaluate(clf, samples: List[Sample], thresholds: List[float]) -> Dict[str, Any]:
+    from backend.app import _keyword_style
+
+    preds, lat_us = [], []
+    for text, _ in samples:
+        t0 = time.perf_counter()
+        clf.tts_params(text)  # アプリと同じ経路（特徴量→確率→パラメータ）で時間を測る
+        lat_us.append((time.perf_counter() - t0) * 1e6)
+        style_id, conf, _ = clf.predict(text)
+        preds.append((style_id, conf))
+    gold = [int(t["styleId"]) for _, t in samples]
+    n = len(samples)
+    report: Dict[str, Any] = {
+        "samples": n,
+        "accuracy": round(sum(p == g for (p, _), g in zip(preds, gold)) / n, 3),
+        "keyword_accuracy": round(sum(_keyword_style(t) == g for (t, _), g in zip(samples, gold)) / n, 3),
+        "latency_us": {"p50": _pct(lat_us, 0.5), "p95": _pct(lat_us, 0.95), "p99": _pct(lat_us, 0.99)},
+        "by_threshold": [],
+    }
+    for th in thresholds:
+        hit = [(p, g) for (p, c), g in zip(preds, gold) if c >= th]
+        report["by_threshold"].append({
+            "min_conf": th,
+            "coverage": round(len(hit) / n, 3),  # LLM を呼ばずに済む割合
+            "accuracy": round(sum(p == g for p, g in hit) / len(hit), 3) if hit else None,
+        })
+    return report
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="音声監督のローカル分類器を学習・評価する")
+    ap.add_argument("--log", action="append", default=[], help="監督ログ JSONL（複数指定可）")
+    ap.add_argument("--cache", action="append", default=[], help="監督キャッシュ JSON（複数指定可）")
+    ap.add_argument("--out", help="書き出し先（既定: DIRECTOR_CLASSIFIER_PATH）")
+    ap.add_argument("--eval-only", action="store_true", help="学習せず、既存モデルを全件で評価する")
+    ap.add_argument("--holdout", type=float, default=0.2, help="評価用に取り分ける割合")
+    ap.add_argument("--buckets", type=int, default=1 << 15, help="n-gram のハッシュ先の数")
+    ap.add_argument("--ngram", type=int, default=3, help="文字 n-gram の最大長")
+    ap.add_argument("--epochs", type=int, default=10)
+    ap.add_argument("--lr", type=float, default=0.5)
+    ap.add_argument("--l2", type=float, default=1e-4)
+    ap.add_argument("--thresholds", default="0.5,0.6,0.7,0.75,0.8,0.9")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", dest="json_out", help="評価結果を JSON で保存")
+    args = ap.parse_args()
+
+    sys.path.insert(0, str(ROOT_DIR))
+    from backend.app import DIRECTOR_CLASSIFIER_PATH, VALID_STYLE_IDS, _StyleClassifier  # import は軽い
+
+    out = Path(args.out or DIRECTOR_CLASSIFIER_PATH)
+    thresholds = [float(x) for x in args.thresholds.split(",") if x.strip()]
+    samples = load_samples(args.log, args.cache, VALID_STYLE_IDS)
+    if not samples:
+        ap.error("教師データがありません（--log / --cache を指定してください）")
+    print(f"[train] samples={len(samples)}", file=sys.stderr)
+
+    if args.eval_only:
+        report = {"model": str(out), "eval": evaluate(_StyleClassifier.load(out), samples, thresholds)}
+    else:
+        hp = dict(buckets=args.buckets, n_max=args.ngram, epochs=args.epochs, lr=args.lr, l2=args.l2, seed=args.seed)
+        shuffled = samples[:]
+        random.Random(args.seed).shuffle(shuffled)
+        n_test = int(len(shuffled) * args.holdout)
+        report = {"model": str(out), "hyperparams": hp}
+        if n_test:
+            report["eval"] = evaluate(fit(shuffled[n_test:], **hp), shuffled[:n_test], thresholds)
+        clf = fit(samples, **hp)
+        if "eval" in report:
+            clf.meta["holdout_accuracy"] = report["eval"]["accuracy"]
+        out.parent.mkdir(parents=True, exist_ok=True)
+        clf.save(out)
+        print(f"[train] wrote {out} classes={clf.classes}", file=sys.stderr)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json_out:
+        Path(args.json_out).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
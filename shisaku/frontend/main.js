@@ -558,6 +558,60 @@ function mouthFromAudio() {
 
 
 
+// サーバーが返す口パクトラック（{fps, keys, frames: [[aa, ih, ou, ee, oh], ...]}、各 0〜100）
+
+// があれば、再生位置でフレーム間を補間するだけにする（音量解析より軽く、口の形も母音ごとに変わる）
+
+const LIP_KEYS = ["aa", "ih", "ou", "ee", "oh"];
+
+let currentLipTrack = null;
+
+
+
+function mouthFromTrack(track, t) {
+
+  if (!vrm || !vrm.expressionManager) return;
+
+  const frames = track.frames || [];
+
+  if (!frames.length) return;
+
+  const pos = Math.max(0, t * (track.fps || 30));
+
+  const i = Math.min(frames.length - 1, Math.floor(pos));
+
+  const a = frames[i];
+
+  const b = frames[Math.min(frames.length - 1, i + 1)];
+
+  const f = Math.min(1, pos - i);
+
+  const keys = track.keys || LIP_KEYS;
+
+  for (let k = 0; k < keys.length; k++) {
+
+    vrm.expressionManager.setValue(keys[k], (a[k] + (b[k] - a[k]) * f) / 100);
+
+  }
+
+  vrm.expressionManager.update();
+
+}
+
+
+
+function resetMouth() {
+
+  if (!vrm || !vrm.expressionManager) return;
+
+  for (const k of LIP_KEYS) vrm.expressionManager.setValue(k, 0);
+
+  vrm.expressionManager.update();
+
+}
+
+
+
 /* ==========================
 
    処理インジケータ（元コメントを保持）
@@ -1119,7 +1173,13 @@ function animate() {
 
     // 口パク
 
-    if (!audioEl.paused) mouthFromAudio();
+    if (!audioEl.paused) {
+
+      if (currentLipTrack) mouthFromTrack(currentLipTrack, audioEl.currentTime);
+
+      else mouthFromAudio();
+
+    }
 
 
 
@@ -2359,6 +2419,155 @@ let chunks = [];
 
 
 
+/* ---------- 会話セッション ---------- */
+// タブごとに別の会話として扱う（サーバー側の履歴はこの ID ごとに分かれる）
+const chatSessionId = (() => {
+  const KEY = "vrmTalkSessionId";
+  try {
+    const saved = sessionStorage.getItem(KEY);
+    if (saved) return saved;
+  } catch (_) { /* storage unavailable */ }
+  const id = (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : `s-${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+  try { sessionStorage.setItem(KEY, id); } catch (_) { /* ignore */ }
+  return id;
+})();
+
+/* ---------- ストリーミング応答（NDJSON） ---------- */
+// /api/text/stream・/api/voice/stream は1行1イベントで返す。
+// segment が届いた時点で再生を始め、後続の segment は順番に続けて再生する。
+
+async function readNdjson(res, onEvent) {
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  const flush = (line) => {
+    const s = line.trim();
+    if (!s) return;
+    try { onEvent(JSON.parse(s)); } catch (_) { /* ignore broken line */ }
+  };
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let nl;
+    while ((nl = buf.indexOf("\n")) >= 0) {
+      flush(buf.slice(0, nl));
+      buf = buf.slice(nl + 1);
+    }
+  }
+  flush(buf + decoder.decode());
+}
+
+// 再生できるなら圧縮版（サーバー側で AUDIO_TRANSCODE が有効なときだけ返ってくる）を要求する
+const preferredAudioFormat = (() => {
+  const probe = document.createElement("audio");
+  if (probe.canPlayType('audio/webm; codecs="opus"')) return "opus";
+  if (probe.canPlayType('audio/mp4; codecs="mp4a.40.2"')) return "aac";
+  return "";
+})();
+
+function withAudioFormat(src) {
+  if (!preferredAudioFormat || !src.startsWith("/audio/")) return src;
+  return `${src}${src.includes("?") ? "&" : "?"}format=${preferredAudioFormat}`;
+}
+
+function playAudioSrc(src, lipTrack = null) {
+  audioEl.pause();
+  audioEl.currentTime = 0;
+  audioEl.src = withAudioFormat(src);
+  resetMouth();
+  currentLipTrack = lipTrack;
+  return new Promise((resolve) => {
+    const done = () => {
+      audioEl.removeEventListener("ended", done);
+      currentLipTrack = null;
+      resetMouth();
+      resolve();
+    };
+    audioEl.addEventListener("ended", done);
+    audioEl.play().catch(done);
+  });
+}
+
+async function runStreamedReply(url, form, { onStt } = {}) {
+  const res = await fetch(url, { method: "POST", body: form });
+  const type = res.headers.get("content-type") || "";
+  if (!res.ok || !res.body || !type.includes("ndjson")) {
+    // 入力エラーなどは通常の JSON で返る
+    const data = await res.json().catch(() => ({}));
+    return data.error ? data : { error: `HTTP ${res.status}` };
+  }
+
+  const pending = [];
+  let wake = null;
+  let finished = false;
+  let final = null;
+  let spoken = "";
+  const minimalOn = !!(minimalModeEl && minimalModeEl.checked);
+  const notify = () => { if (wake) { const w = wake; wake = null; w(); } };
+
+  ensureAudioGraph();
+  if (minimalOn) {
+    poseTimeline = null;
+    poseActive = false;
+    targetHeadYaw = 0;
+  }
+
+  const playback = (async () => {
+    for (;;) {
+      if (pending.length === 0) {
+        if (finished) break;
+        await new Promise((r) => { wake = r; });
+        continue;
+      }
+      const item = pending.shift();
+      await playAudioSrc(item.src, item.lipsync);
+    }
+  })();
+
+  await readNdjson(res, (ev) => {
+    if (ev.type === "stt") {
+      if (onStt) onStt(ev.text);
+    } else if (ev.type === "segment") {
+      if (!spoken) {
+        progressMarkReceived();
+        progressStageSet("Playing audio");
+        const onReady = () => {
+          progressFinish("Ready");
+          audioEl.removeEventListener("canplaythrough", onReady);
+        };
+        audioEl.addEventListener("canplaythrough", onReady);
+      }
+      spoken += ev.text || "";
+      // 途中経過は表示だけ更新し、履歴には done 時の全文を1回だけ残す
+      if (chatLog) chatLog.textContent = `AI: ${spoken}`;
+      if (ev.audio) pending.push({ src: ev.audio, lipsync: ev.lipsync || null });
+      notify();
+    } else if (ev.type === "segment_error") {
+      // 合成できなかった文は音声が欠けるので、黙って飛ばさずに知らせる
+      spoken += ev.text || "";
+      if (chatLog) chatLog.textContent = `AI: ${spoken}`;
+      addChatLog("System", `Could not synthesize voice for: "${ev.text || ""}"`);
+    } else if (ev.type === "pose") {
+      if (!minimalOn) applyPoseFromResponse(ev);
+    } else if (ev.type === "done" || ev.type === "error") {
+      final = ev;
+    }
+  });
+
+  finished = true;
+  notify();
+  if (final && !final.error) {
+    addChatLog("AI", final.text);
+    renderSteps(final.steps || []);
+    if (!spoken) progressFinish("No audio");
+  }
+  await playback;
+  return final || { error: "empty response" };
+}
+
 /* ---------- 録音 ---------- */
 
 if (!recBtn || !stopBtn) {
@@ -2426,6 +2635,7 @@ if (!recBtn || !stopBtn) {
         const form = new FormData();
         form.append("file", blob, "input.webm");
         if (chatEngineSelect) form.append("chatEngine", chatEngineSelect.value);
+        form.append("sessionId", chatSessionId);
 
         const minimalOn = !!(minimalModeEl && minimalModeEl.checked);
         if (!minimalOn) {
@@ -2436,57 +2646,17 @@ if (!recBtn || !stopBtn) {
           form.append("minimalMode", "1");
         }
 
-        const res = await fetch("/api/voice", { method: "POST", body: form });
-        const data = await res.json();
-        progressMarkReceived();
+        const data = await runStreamedReply("/api/voice/stream", form, {
+          onStt: (text) => {
+            addChatLog("あなた", text || "(voice input)");
+            progressStageSet("Generating reply");
+          },
+        });
 
         if (data.error) {
           addChatLog("System", data.error);
+          progressFinish("Error");
         } else {
-          addChatLog("あなた", data.stt || "(voice input)");
-          addChatLog("AI", data.text);
-          renderSteps(data.steps || []);
-          progressStageSet("Preparing TTS");
-
-          if (minimalModeEl && minimalModeEl.checked) {
-            poseTimeline = null;
-            poseActive = false;
-            targetHeadYaw = 0;
-          } else {
-            applyPoseFromResponse(data);
-          }
-
-          const audioListV = Array.isArray(data.audio) ? data.audio : (data.audio ? [data.audio] : []);
-          ensureAudioGraph();
-
-          if (audioListV.length === 0) {
-            progressFinish("No audio");
-          } else {
-            const onReadyV = () => {
-              progressFinish("Ready");
-              audioEl.removeEventListener("canplaythrough", onReadyV);
-            };
-            audioEl.addEventListener("canplaythrough", onReadyV);
-            progressStageSet("Playing audio");
-
-            for (const src of audioListV) {
-              audioEl.pause();
-              audioEl.currentTime = 0;
-              audioEl.src = src;
-              await new Promise((resolve) => {
-                const onEnded = () => {
-                  audioEl.removeEventListener("ended", onEnded);
-                  resolve();
-                };
-                audioEl.addEventListener("ended", onEnded);
-                audioEl.play().catch(() => {
-                  audioEl.removeEventListener("ended", onEnded);
-                  resolve();
-                });
-              });
-            }
-          }
-
           if (data.auto) updateModeStatusAuto(data.tts);
           else updateModeStatusManual();
         }
@@ -2527,6 +2697,7 @@ async function sendTextMessage(msg) {
     form.append("text", msg);
 
       if (chatEngineSelect) form.append("chatEngine", chatEngineSelect.value);
+      form.append("sessionId", chatSessionId);
 
       const minimalOnT = !!(minimalModeEl && minimalModeEl.checked);
 
@@ -2546,62 +2717,16 @@ async function sendTextMessage(msg) {
 
 
 
-    const res = await fetch("/api/text", { method: "POST", body: form });
+    addChatLog("あなた", msg);
 
-    const data = await res.json();
-
-    progressMarkReceived();
+    const data = await runStreamedReply("/api/text/stream", form);
 
 
 
     if (data.error) {
       addChatLog("System", data.error);
+      progressFinish("Error");
     } else {
-      addChatLog("あなた", msg);
-      addChatLog("AI", data.text);
-
-      renderSteps(data.steps || []);
-      progressStageSet("Preparing TTS");
-
-      if (minimalModeEl && minimalModeEl.checked) {
-        poseTimeline = null;
-        poseActive = false;
-        targetHeadYaw = 0;
-      } else {
-        applyPoseFromResponse(data);
-      }
-
-      const audioListT = Array.isArray(data.audio) ? data.audio : (data.audio ? [data.audio] : []);
-      ensureAudioGraph();
-
-      if (audioListT.length === 0) {
-        progressFinish("No audio");
-      } else {
-        const onReadyT = () => {
-          progressFinish("Ready");
-          audioEl.removeEventListener("canplaythrough", onReadyT);
-        };
-        audioEl.addEventListener("canplaythrough", onReadyT);
-        progressStageSet("Playing audio");
-
-        for (const src of audioListT) {
-          audioEl.pause();
-          audioEl.currentTime = 0;
-          audioEl.src = src;
-          await new Promise((resolve) => {
-            const onEnded = () => {
-              audioEl.removeEventListener("ended", onEnded);
-              resolve();
-            };
-            audioEl.addEventListener("ended", onEnded);
-            audioEl.play().catch(() => {
-              audioEl.removeEventListener("ended", onEnded);
-              resolve();
-            });
-          });
-        }
-      }
-
       if (data.auto) updateModeStatusAuto(data.tts);
       else updateModeStatusManual();
     }
@@ -0,0 +1,13 @@
+import os
+import sys
+from pathlib import Path
+
+# backend.app を import できるように shisaku/ を通す（cd shisaku && python -m pytest tests）
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# import 時に外部へ出ていかないように（テストはネットワークを使わない）
+os.environ.setdefault("OLLAMA_WARMUP", "0")
+
+
+def pytest_configure(config):
+    # @app.on_event の非推奨警告（アプリ側の書き方はそのまま）
+    config.addinivalue_line("filterwarnings", "ignore:\\s*on_event is deprecated:DeprecationWarning")
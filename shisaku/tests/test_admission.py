@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import pytest
+
+from backend.app import AdmissionRejected, _error_response, _FairLimiter, _request_session
+
+
+def make_limiter(limit=1, queue_max=10, session_queue_max=10, wait_sec=5.0):
+    return _FairLimiter("test", limit=limit, queue_max=queue_max, session_queue_max=session_queue_max, wait_sec=wait_sec)
+
+
+async def as_session(sid, coro):
+    _request_session.set(sid)
+    return await coro
+
+
+async def hold(limiter, sid, order, gate):
+    """枠を取ったら order に記録し、gate が開くまで握っておく。"""
+    async def body():
+        async with limiter.slot():
+            order.append(sid)
+            await gate.wait()
+    await as_session(sid, body())
+
+
+def test_free_slots_are_taken_without_queueing():
+    lim = make_limiter(limit=2)
+
+    async def main():
+        await lim.acquire()
+        await lim.acquire()
+        assert (lim.active, lim.queued) == (2, 0)
+        lim.release()
+        lim.release()
+        assert lim.active == 0
+
+    asyncio.run(main())
+    assert lim.admitted == 2
+
+
+def test_waiting_sessions_are_served_round_robin():
+    lim = make_limiter(limit=1)
+    order = []
+
+    async def main():
+        gate = asyncio.Event()
+        first = asyncio.create_task(hold(lim, "busy", order, gate))
+        await asyncio.sleep(0)
+        # A が3件並べてから B・C が1件ずつ並ぶ
+        tasks = [asyncio.create_task(hold(lim, sid, order, gate)) for sid in ("A", "A", "A", "B", "C")]
+        await asyncio.sleep(0)
+        assert lim.queued == 5
+        gate.set()
+        await asyncio.gather(first, *tasks)
+
+    asyncio.run(main())
+    assert order == ["busy", "A", "B", "C", "A", "A"]
+
+
+def test_session_queue_limit_rejects_with_429():
+    lim = make_limiter(limit=1, session_queue_max=1)
+
+    async def main():
+        await lim.acquire()
+        waiting = asyncio.create_task(as_session("A", lim.acquire()))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as e:
+            await as_session("A", lim.acquire())
+        # 他のセッションはまだ並べる
+        other = asyncio.create_task(as_session("B", lim.acquire()))
+        await asyncio.sleep(0)
+        assert lim.queued == 2
+        lim.release()
+        lim.release()
+        await asyncio.gather(waiting, other)
+        return e.value
+
+    err = asyncio.run(main())
+    assert (err.status, err.reason) == (429, "session_queue_full")
+    assert err.retry_after >= 1
+    assert lim.rejected == {"session_queue_full": 1}
+
+
+def test_global_queue_limit_rejects_with_503():
+    lim = make_limiter(limit=1, queue_max=1)
+
+    async def main():
+        await lim.acquire()
+        waiting = asyncio.create_task(as_session("A", lim.acquire()))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as e:
+            await as_session("B", lim.acquire())
+        lim.release()
+        await waiting
+        return e.value
+
+    err = asyncio.run(main())
+    assert (err.status, err.reason) == (503, "queue_full")
+
+
+def test_wait_timeout_rejects_with_503_and_leaves_the_queue():
+    lim = make_limiter(limit=1, wait_sec=0.01)
+
+    async def main():
+        await lim.acquire()
+        with pytest.raises(AdmissionRejected) as e:
+            await as_session("A", lim.acquire())
+        assert (lim.queued, lim.active) == (0, 1)
+        lim.release()
+        return e.value
+
+    err = asyncio.run(main())
+    assert (err.status, err.reason) == (503, "wait_timeout")
+    assert lim.active == 0
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    lim = make_limiter(limit=1)
+
+    async def main():
+        await lim.acquire()
+        waiting = asyncio.create_task(as_session("A", lim.acquire()))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert lim.queued == 0
+        lim.release()
+
+    asyncio.run(main())
+    assert lim.active == 0
+
+
+def test_retry_after_grows_with_queue_depth():
+    lim = make_limiter(limit=2)
+    lim._hold_ms = 2000.0
+    assert lim._retry_after() == 2
+    lim.queued = 4
+    assert lim._retry_after() == 6
+
+
+def test_error_response_sets_retry_after_header():
+    resp = _error_response({"error": "混み合っています", "status_code": 429, "retry_after": 3})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "3"
+    assert json.loads(resp.body) == {"error": "混み合っています", "retryAfter": 3}
+
+    resp = _error_response({"error": "x", "status_code": 502})
+    assert resp.status_code == 502 and "Retry-After" not in resp.headers
@@ -0,0 +1,134 @@
+import os
+import time
+
+import pytest
+
+from backend.app import _AudioArtifacts
+
+
+@pytest.fixture
+def arts(tmp_path):
+    return _AudioArtifacts(tmp_path, ttl_sec=60, max_bytes=100, protect_sec=0)
+
+
+def put(arts, name, size, age=0.0):
+    path = arts.root / name
+    path.write_bytes(b"x" * size)
+    arts.register(path)
+    if age:
+        size_, last = arts._index[name]
+        arts._index[name] = (size_, last - age)
+    return path
+
+
+def test_resolve_only_serves_indexed_names(arts):
+    path = put(arts, "reply_a.wav", 10)
+    assert arts.resolve("reply_a.wav") == path
+    (arts.root / "reply_b.wav").write_bytes(b"x")
+    assert arts.resolve("reply_b.wav") is None
+    assert arts.resolve("../reply_a.wav") is None
+
+
+def test_sweep_removes_expired_files(arts):
+    old = put(arts, "reply_old.wav", 10, age=120)
+    new = put(arts, "reply_new.wav", 10)
+    assert arts.sweep() == ["reply_old.wav"]
+    assert not old.exists() and new.exists()
+    assert arts.stats()["expired"] == 1
+    assert arts.stats()["bytes"] == 10
+
+
+def test_sweep_enforces_quota_oldest_first(arts):
+    first = put(arts, "reply_1.wav", 40, age=3)
+    put(arts, "reply_2.wav", 40, age=2)
+    put(arts, "reply_3.wav", 40, age=1)
+    assert arts.sweep() == ["reply_1.wav"]
+    assert not first.exists()
+    assert arts.stats()["bytes"] == 80
+    assert arts.stats()["evicted"] == 1
+
+
+def test_touch_moves_file_to_the_back_of_the_quota_queue(arts):
+    put(arts, "reply_1.wav", 40, age=3)
+    second = put(arts, "reply_2.wav", 40, age=2)
+    put(arts, "reply_3.wav", 40, age=1)
+    arts.resolve("reply_1.wav")
+    assert arts.sweep() == ["reply_2.wav"]
+    assert not second.exists()
+
+
+def test_pinned_files_survive_ttl_and_quota(arts):
+    path = put(arts, "reply_p.wav", 200, age=120)
+    arts.pin(path.name)
+    arts.pin(path.name)
+    assert arts.sweep() == []
+    arts.unpin(path.name)
+    assert arts.sweep() == []  # まだ1つ pin が残っている
+    arts.unpin(path.name)
+    assert arts.sweep() == ["reply_p.wav"]
+    assert not path.exists()
+
+
+def test_recent_files_are_protected(arts):
+    arts.protect_sec = 30
+    put(arts, "reply_1.wav", 80, age=90)
+    recent = put(arts, "reply_2.wav", 80, age=5)
+    assert arts.sweep() == ["reply_1.wav"]
+    assert recent.exists()
+    # 総量はまだ超えているが、猶予中なので消さない
+    assert arts.sweep() == []
+    assert arts.stats()["bytes"] == 80
+
+
+def test_variants_count_towards_quota_and_go_with_their_wav(arts):
+    wav = put(arts, "reply_v.wav", 30, age=120)
+    webm = arts.variant_path(wav.name, "opus")
+    webm.write_bytes(b"y" * 20)
+    arts.add_variant(wav.name, "opus")
+    assert arts.stats()["bytes"] == 50
+    assert arts.variant(wav.name, "opus") == webm
+    arts.sweep()
+    assert not wav.exists() and not webm.exists()
+    assert arts.stats()["bytes"] == 0
+
+
+def test_variant_for_a_removed_wav_is_deleted(arts):
+    wav = put(arts, "reply_v.wav", 30)
+    arts.discard(wav.name)
+    webm = arts.variant_path(wav.name, "opus")
+    webm.write_bytes(b"y")
+    arts.add_variant(wav.name, "opus")
+    assert not webm.exists()
+    assert arts.variant(wav.name, "opus") is None
+
+
+def test_evict_skips_pinned_and_protected(arts):
+    pinned = put(arts, "tts_a.wav", 10)
+    arts.pin(pinned.name)
+    free = put(arts, "tts_b.wav", 10)
+    assert arts.evict(["tts_a.wav", "tts_b.wav", "tts_missing.wav"]) == ["tts_b.wav"]
+    assert pinned.exists() and not free.exists()
+    arts.protect_sec = 30
+    recent = put(arts, "tts_c.wav", 10)
+    assert arts.evict(["tts_c.wav"]) == []
+    assert recent.exists()
+
+
+def test_load_from_disk_indexes_servable_files_and_cleans_leftovers(tmp_path):
+    (tmp_path / "reply_a.wav").write_bytes(b"x" * 5)
+    (tmp_path / "tts_b.wav").write_bytes(b"x" * 7)
+    (tmp_path / "tts_b.webm").write_bytes(b"y" * 3)
+    (tmp_path / "reply_gone.webm").write_bytes(b"y")
+    (tmp_path / "other.wav").write_bytes(b"x")
+    part = tmp_path / "tts_c.wav.part"
+    part.write_bytes(b"x")
+    old = time.time() - 7200
+    os.utime(part, (old, old))
+
+    arts = _AudioArtifacts(tmp_path, ttl_sec=60, max_bytes=100, protect_sec=0)
+    arts.load_from_disk()
+    st = arts.stats()
+    assert (st["files"], st["variants"], st["bytes"]) == (2, 1, 15)
+    assert arts.resolve("other.wav") is None
+    assert not (tmp_path / "reply_gone.webm").exists()
+    assert not part.exists()
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import app as backend_app
+from backend.app import _AudioArtifacts, _negotiate_audio_format
+
+
+@pytest.fixture
+def formats(monkeypatch):
+    def enable(*names):
+        monkeypatch.setattr(backend_app, "AUDIO_TRANSCODE", list(names))
+    enable("opus", "aac")
+    return enable
+
+
+@pytest.fixture
+def arts(tmp_path, monkeypatch):
+    arts = _AudioArtifacts(tmp_path, ttl_sec=60, max_bytes=10 ** 6, protect_sec=0)
+    monkeypatch.setattr(backend_app, "audio_artifacts", arts)
+    return arts
+
+
+@pytest.mark.parametrize(
+    "requested, accept, expected",
+    [
+        ("opus", None, "opus"),
+        ("AAC", "audio/webm", "aac"),
+        ("wav", "audio/webm", "wav"),
+        ("mp3", "audio/mp4", "aac"),          # 知らない形式は Accept に任せる
+        (None, "audio/webm;q=0.5, audio/mp4", "aac"),
+        (None, "audio/mp4;q=0.4, audio/ogg;q=0.9", "opus"),
+        (None, "audio/webm;q=0, audio/wav", "wav"),
+        (None, "audio/webm;q=oops, audio/mp4", "aac"),
+        (None, "*/*", "wav"),
+        (None, None, "wav"),
+    ],
+)
+def test_negotiation(formats, requested, accept, expected):
+    assert _negotiate_audio_format(requested, accept) == expected
+
+
+def test_formats_that_are_not_produced_are_never_chosen(formats):
+    formats("aac")
+    assert _negotiate_audio_format("opus", None) == "wav"
+    assert _negotiate_audio_format(None, "audio/webm, audio/mp4;q=0.1") == "aac"
+    formats()
+    assert _negotiate_audio_format(None, "audio/webm, audio/mp4") == "wav"
+
+
+def put_wav(arts, name="reply_a.wav"):
+    path = arts.root / name
+    path.write_bytes(b"RIFF-wav")
+    arts.register(path)
+    return path
+
+
+def test_get_audio_falls_back_to_wav_and_schedules_the_variant(formats, arts, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(backend_app, "_schedule_transcode", lambda src, fmts=None: scheduled.append((src.name, fmts)))
+    put_wav(arts)
+    resp = TestClient(backend_app.app).get("/audio/reply_a.wav", headers={"Accept": "audio/webm"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "audio/wav"
+    assert "Accept" in resp.headers["vary"]  # CORS ミドルウェアが Origin を足す
+    assert resp.content == b"RIFF-wav"
+    assert scheduled == [("reply_a.wav", ["opus"])]
+
+
+def test_get_audio_serves_a_finished_variant(formats, arts):
+    wav = put_wav(arts)
+    arts.variant_path(wav.name, "opus").write_bytes(b"webm")
+    arts.add_variant(wav.name, "opus")
+    resp = TestClient(backend_app.app).get("/audio/reply_a.wav?format=opus")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "audio/webm"
+    assert resp.content == b"webm"
+
+
+def test_get_audio_unknown_file_is_404(arts):
+    assert TestClient(backend_app.app).get("/audio/reply_missing.wav").status_code == 404
+
+
+def test_failed_transcode_leaves_no_variant(formats, arts, monkeypatch, tmp_path):
+    monkeypatch.setattr(backend_app, "FFMPEG_BIN", str(tmp_path / "no-such-ffmpeg"))
+    wav = put_wav(arts)
+    backend_app._transcode_inflight.add((wav.name, "opus"))
+    asyncio.run(backend_app._transcode(wav, "opus"))
+    assert arts.variant(wav.name, "opus") is None
+    assert (wav.name, "opus") not in backend_app._transcode_inflight
+    assert sorted(p.name for p in arts.root.iterdir()) == ["reply_a.wav"]
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from backend import batch
+from backend.app import _batch_item_id, _parse_batch_line
+
+
+def line(**obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def test_minimal_line():
+    item = _parse_batch_line(line(text="  おはよう  "))
+    assert item == {"id": _batch_item_id("おはよう", None, {}), "text": "おはよう", "styleId": None, "prosody": {}}
+
+
+def test_explicit_id_is_kept_as_a_string():
+    assert _parse_batch_line(line(id=42, text="やあ"))["id"] == "42"
+
+
+def test_prosody_is_clamped_and_unknown_keys_are_dropped():
+    item = _parse_batch_line(line(text="はい", styleId=40, prosody={"speedScale": 3, "pitchScale": -1, "foo": 1}))
+    assert item["styleId"] == 40
+    assert item["prosody"] == {"speedScale": 1.4, "pitchScale": -0.3}
+
+
+def test_id_depends_on_text_style_and_prosody():
+    base = _batch_item_id("はい", 1, {})
+    assert len(base) == 16 and base == _batch_item_id("はい", 1, {})
+    assert base != _batch_item_id("はい", 40, {})
+    assert base != _batch_item_id("はい", 1, {"speedScale": 1.2})
+    # キーの順番には左右されない
+    assert _batch_item_id("はい", 1, {"speedScale": 1.2, "pitchScale": 0.1}) == _batch_item_id(
+        "はい", 1, {"pitchScale": 0.1, "speedScale": 1.2}
+    )
+
+
+def test_same_line_gets_the_same_id_on_server_and_cli():
+    prosody = {"speedScale": 1.1, "volumeScale": 0.9}
+    item = _parse_batch_line(line(text="こんにちは", styleId=7, prosody=prosody))
+    assert item["id"] == batch._item_id("こんにちは", 7, prosody)
+
+
+@pytest.mark.parametrize(
+    "raw, message",
+    [
+        ("[1, 2]", "not an object"),
+        (line(text="   "), "text is empty"),
+        (line(text="a", styleId=999), "invalid styleId"),
+        (line(text="a", styleId="1"), "invalid styleId"),
+        (line(text="a", prosody=[1]), "prosody is not an object"),
+    ],
+)
+def test_invalid_lines_raise_value_error(raw, message):
+    with pytest.raises(ValueError, match=message):
+        _parse_batch_line(raw)
+
+
+def test_broken_json_is_a_value_error():
+    with pytest.raises(ValueError):
+        _parse_batch_line("{text:")
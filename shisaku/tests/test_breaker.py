@@ -0,0 +1,236 @@
+import asyncio
+
+import pytest
+
+from backend import app as backend_app
+from backend.app import AdmissionRejected, CircuitOpenError, _CircuitBreaker, _hedged
+
+
+def make_breaker(threshold=2, cooldown=30.0):
+    return _CircuitBreaker("test", failure_threshold=threshold, cooldown_sec=cooldown)
+
+
+def cool_down(breaker):
+    breaker._opened_at -= breaker.cooldown_sec + 1
+
+
+async def call(breaker, fail=False, exc=RuntimeError):
+    async with breaker:
+        if fail:
+            raise exc("boom")
+    return "ok"
+
+
+def test_opens_after_consecutive_failures():
+    b = make_breaker(threshold=2)
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await call(b, fail=True)
+        assert b.state == "open" and b.is_open()
+        with pytest.raises(CircuitOpenError):
+            await call(b)
+
+    asyncio.run(main())
+    assert b.snapshot() == {"state": "open", "failures": 2, "trips": 1, "rejected": 1}
+
+
+def test_success_resets_failure_count():
+    b = make_breaker(threshold=2)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await call(b, fail=True)
+        await call(b)
+        with pytest.raises(RuntimeError):
+            await call(b, fail=True)
+
+    asyncio.run(main())
+    assert b.state == "closed" and b.failures == 1
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    b = make_breaker(threshold=1)
+    b.record_failure()
+    cool_down(b)
+    assert not b.is_open()
+    assert b.allow()
+    assert b.state == "half_open"
+    # 試しの1本が返るまで他は断る
+    assert not b.allow()
+    b.record_success()
+    assert b.state == "closed"
+    assert b.allow()
+
+
+def test_failed_probe_reopens_immediately():
+    b = make_breaker(threshold=3)
+    for _ in range(3):
+        b.record_failure()
+    cool_down(b)
+    assert b.allow()
+    b.record_failure()
+    assert b.state == "open" and b.is_open()
+    assert b.trips == 2
+
+
+def test_cancelled_or_rejected_calls_do_not_count():
+    b = make_breaker(threshold=1)
+
+    async def main():
+        with pytest.raises(AdmissionRejected):
+            async with b:
+                raise AdmissionRejected("test", "queue_full", 503, 1)
+
+    asyncio.run(main())
+    assert b.state == "closed" and b.failures == 0
+
+    b.record_failure()
+    cool_down(b)
+    assert b.allow()
+    b._release()  # 試しの1本が取り消された
+    assert b.state == "half_open"
+    assert b.allow()
+
+
+def test_hedge_not_started_when_primary_answers_in_time():
+    calls = []
+
+    async def primary():
+        calls.append("primary")
+        return "p"
+
+    async def backup():
+        calls.append("backup")
+        return "b"
+
+    assert asyncio.run(_hedged(primary, backup, 0.5, "test")) == "p"
+    assert calls == ["primary"]
+
+
+def test_hedge_backup_wins_when_primary_is_slow():
+    cancelled = []
+
+    async def primary():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append("primary")
+            raise
+        return "p"
+
+    async def backup():
+        return "b"
+
+    async def main():
+        result = await _hedged(primary, backup, 0.01, "test")
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == "b"
+    assert cancelled == ["primary"]
+
+
+def test_hedge_slow_primary_can_still_win():
+    async def primary():
+        await asyncio.sleep(0.05)
+        return "p"
+
+    async def backup():
+        raise RuntimeError("backup down")
+
+    assert asyncio.run(_hedged(primary, backup, 0.01, "test")) == "p"
+
+
+def test_hedge_starts_backup_at_once_when_primary_fails():
+    async def primary():
+        raise RuntimeError("primary down")
+
+    async def backup():
+        return "b"
+
+    assert asyncio.run(_hedged(primary, backup, 5, "test")) == "b"
+
+
+def test_hedge_raises_last_error_when_both_fail():
+    async def primary():
+        raise RuntimeError("primary down")
+
+    async def backup():
+        raise ValueError("backup down")
+
+    with pytest.raises(ValueError, match="backup down"):
+        asyncio.run(_hedged(primary, backup, 0.01, "test"))
+
+
+class FakeGemini:
+    """gemini_client() の代わり。text をそのまま返す（例外を渡すとそれを投げる）。"""
+
+    def __init__(self, text):
+        self.aio = self
+        self.models = self
+        self.text = text
+
+    async def generate_content(self, **kwargs):
+        if isinstance(self.text, Exception):
+            raise self.text
+        return type("Res", (), {"text": self.text})()
+
+
+@pytest.fixture
+def director(monkeypatch):
+    """Ollama は遅れて正しい答えを返し、Gemini の答えは gemini で差し替える。"""
+    monkeypatch.setattr(backend_app, "DIRECTOR_CACHE_ENABLED", False)
+    monkeypatch.setattr(backend_app, "DIRECTOR_HEDGE_SEC", 0.01)
+    for name in ("ollama", "gemini"):
+        monkeypatch.setitem(backend_app.breakers, name, make_breaker(threshold=5))
+
+    async def slow_ollama(prompt, *, fmt=None):
+        await asyncio.sleep(0.05)
+        return '{"styleId": 42, "speedScale": 0.9}'
+
+    monkeypatch.setattr(backend_app, "_ollama_generate", slow_ollama)
+
+    def gemini(text):
+        monkeypatch.setattr(backend_app, "gemini_client", lambda: FakeGemini(text))
+
+    return gemini
+
+
+@pytest.mark.parametrize("answer", ["{}", "not json", '{"styleId": 999}', RuntimeError("quota")])
+def test_hedge_waits_for_late_primary_when_gemini_falls_back(director, answer):
+    director(answer)
+    tts = asyncio.run(backend_app.choose_tts_by_gemma("こんにちは"))
+    assert tts["styleId"] == 42
+    assert tts["speedScale"] == 0.9
+
+
+@pytest.mark.parametrize("answer", ["{}", "", '{"speedScale": 1.2}'])
+def test_combined_hedge_waits_for_late_primary_when_gemini_falls_back(director, answer):
+    director(answer)
+    tts, _ = asyncio.run(backend_app.direct_by_gemma("こんにちは"))
+    assert tts["styleId"] == 42
+
+
+def test_hedge_backup_still_wins_with_a_real_answer(director):
+    director('{"styleId": 40}')
+    assert asyncio.run(backend_app.choose_tts_by_gemma("こんにちは"))["styleId"] == 40
+
+
+def test_gemini_choose_tts_still_falls_back_to_keywords(director):
+    director("not json")
+    assert asyncio.run(backend_app.gemini_choose_tts("やった！"))["styleId"] == 40
+
+
+def test_failed_warmup_does_not_trip_the_ollama_breaker(monkeypatch):
+    monkeypatch.setitem(backend_app.breakers, "ollama", make_breaker(threshold=1))
+
+    async def refused(url, **kwargs):
+        raise ConnectionError("connection refused")
+
+    monkeypatch.setattr(backend_app, "_http_post", refused)
+    for _ in range(3):
+        with pytest.raises(RuntimeError, match="warmup failed"):
+            asyncio.run(backend_app._warm_ollama(["gemma"]))
+    assert backend_app.breakers["ollama"].state == "closed"
@@ -0,0 +1,105 @@
+import pytest
+
+from backend.app import _DirectorCache, _normalize_utterance
+
+
+def make_cache(tmp_path=None, max_entries=100, ttl_sec=3600):
+    path = tmp_path / "director_cache.json" if tmp_path is not None else None
+    return _DirectorCache(max_entries=max_entries, ttl_sec=ttl_sec, path=path)
+
+
+def age(cache, key, sec):
+    value, created = cache._entries[key]
+    cache._entries[key] = (value, created - sec)
+
+
+@pytest.mark.parametrize("variant", ["おはよう！", "おはよう 。", "  おはよう…", "おはよう\n"])
+def test_normalization_drops_punctuation_and_spaces(variant):
+    assert _normalize_utterance(variant) == "おはよう"
+
+
+def test_normalization_folds_halfwidth_kana():
+    assert _normalize_utterance("ｵﾊﾖｳ") == _normalize_utterance("オハヨウ")
+
+
+def test_normalization_lowercases_and_keeps_meaningful_symbols():
+    assert _normalize_utterance("ＨＥＬＬＯ, World!") == "helloworld"
+    assert _normalize_utterance("3＋4") == "3+4"
+
+
+def test_key_separates_kinds_and_joins_texts():
+    assert _DirectorCache.key("tts", "おはよう！") == _DirectorCache.key("tts", "おはよう")
+    assert _DirectorCache.key("tts", "おはよう") != _DirectorCache.key("pose", "おはよう")
+    assert _DirectorCache.key("combined", "ねえ", "うん") != _DirectorCache.key("combined", "ねえう", "ん")
+
+
+def test_put_get_returns_a_copy():
+    cache = make_cache()
+    key = _DirectorCache.key("tts", "こんにちは")
+    cache.put(key, {"styleId": 1, "speedScale": 1.1})
+    got = cache.get(key)
+    assert got == {"styleId": 1, "speedScale": 1.1}
+    got["styleId"] = 99
+    assert cache.get(key)["styleId"] == 1
+
+
+def test_expired_entries_are_dropped_on_get_and_sweep():
+    cache = make_cache(ttl_sec=60)
+    cache.put("tts\ta", 1)
+    cache.put("tts\tb", 2)
+    cache.put("tts\tc", 3)
+    age(cache, "tts\ta", 120)
+    age(cache, "tts\tb", 120)
+    assert cache.get("tts\ta") is None
+    assert cache.sweep() == 1
+    assert cache.stats()["entries"] == 1
+    assert cache.get("tts\tc") == 3
+
+
+def test_lru_drops_least_recently_used():
+    cache = make_cache(max_entries=2)
+    cache.put("tts\ta", 1)
+    cache.put("tts\tb", 2)
+    assert cache.get("tts\ta") == 1
+    cache.put("tts\tc", 3)
+    assert cache.get("tts\tb") is None
+    assert cache.get("tts\ta") == 1 and cache.get("tts\tc") == 3
+
+
+def test_hit_and_miss_counters():
+    cache = make_cache()
+    cache.record("tts", "exact")
+    cache.record("tts", "semantic")
+    cache.record("tts", None)
+    cache.record("pose", None)
+    st = cache.stats()
+    assert st["tts"] == {"hits": 1, "semantic_hits": 1, "misses": 1, "hit_rate": 0.667}
+    assert st["pose"]["hit_rate"] == 0.0
+
+
+def test_nearest_matches_only_the_same_kind_above_threshold():
+    pytest.importorskip("numpy")
+    cache = make_cache()
+    cache.remember_vector("tts\ta", [1.0, 0.0])
+    cache.put("tts\ta", "A")
+    cache.remember_vector("pose\tb", [0.0, 1.0])
+    cache.put("pose\tb", "B")
+    assert cache.nearest("tts", [0.99, 0.14], 0.9) == "A"
+    assert cache.nearest("tts", [0.0, 1.0], 0.9) is None
+    assert cache.nearest("pose", [0.0, 1.0], 0.9) == "B"
+    assert cache.nearest("combined", [1.0, 0.0], 0.1) is None
+
+
+def test_save_and_load_round_trip_skips_expired(tmp_path):
+    cache = make_cache(tmp_path, ttl_sec=60)
+    cache.remember_vector("tts\ta", [1.0, 0.0])
+    cache.put("tts\ta", {"styleId": 2})
+    cache.put("tts\told", {"styleId": 3})
+    age(cache, "tts\told", 120)
+    cache.save()
+
+    restored = make_cache(tmp_path, ttl_sec=60)
+    restored.load()
+    assert restored.get("tts\ta") == {"styleId": 2}
+    assert restored.get("tts\told") is None
+    assert restored.stats()["vectors"] == 1
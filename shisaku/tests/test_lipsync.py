@@ -0,0 +1,91 @@
+import asyncio
+import math
+import wave
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from backend import app as backend_app  # noqa: E402
+from backend.app import _AudioArtifacts, _lipsync_track_blocking  # noqa: E402
+
+RATE = 24000
+
+
+def write_wav(path, samples, *, rate=RATE, channels=1, width=2):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(width)
+        w.setframerate(rate)
+        if width == 2:
+            w.writeframes(np.asarray(samples, dtype="<i2").tobytes())
+        else:
+            w.writeframes(bytes(samples))
+    return path
+
+
+def tone(sec, freq=700.0, amp=12000):
+    t = np.arange(int(sec * RATE)) / RATE
+    return (amp * np.sin(2 * math.pi * freq * t)).astype(np.int16)
+
+
+def silence(sec):
+    return np.zeros(int(sec * RATE), dtype=np.int16)
+
+
+@pytest.fixture(autouse=True)
+def fps(monkeypatch):
+    monkeypatch.setattr(backend_app, "LIPSYNC_FPS", 30)
+
+
+def test_one_frame_per_hop_and_values_in_range(tmp_path):
+    path = write_wav(tmp_path / "reply_a.wav", np.concatenate([silence(0.5), tone(0.5), silence(0.5)]))
+    track = _lipsync_track_blocking(path)
+    hop = RATE // 30
+    assert track["fps"] == 30
+    assert track["keys"] == ["aa", "ih", "ou", "ee", "oh"]
+    assert len(track["frames"]) == math.ceil(int(1.5 * RATE) / hop)
+    assert all(len(f) == 5 and all(0 <= v <= 100 for v in f) for f in track["frames"])
+
+
+def test_mouth_is_closed_in_silence_and_open_while_speaking(tmp_path):
+    path = write_wav(tmp_path / "reply_a.wav", np.concatenate([silence(0.5), tone(0.5), silence(0.5)]))
+    frames = _lipsync_track_blocking(path)["frames"]
+    assert max(sum(f) for f in frames[:10]) == 0
+    assert max(sum(f) for f in frames[-10:]) == 0
+    assert min(sum(f) for f in frames[18:28]) > 50
+
+
+def test_stereo_is_mixed_down(tmp_path):
+    mono = tone(0.3)
+    stereo = np.stack([mono, mono], axis=1).reshape(-1)
+    a = _lipsync_track_blocking(write_wav(tmp_path / "reply_m.wav", mono))
+    b = _lipsync_track_blocking(write_wav(tmp_path / "reply_s.wav", stereo, channels=2))
+    assert a["frames"] == b["frames"]
+
+
+def test_unsupported_or_empty_audio_has_no_track(tmp_path):
+    assert _lipsync_track_blocking(write_wav(tmp_path / "reply_8.wav", [128] * 1000, width=1)) is None
+    assert _lipsync_track_blocking(write_wav(tmp_path / "reply_e.wav", [])) is None
+
+
+def test_track_is_stored_next_to_the_wav_and_reused(tmp_path, monkeypatch):
+    arts = _AudioArtifacts(tmp_path, ttl_sec=60, max_bytes=10 ** 7, protect_sec=0)
+    monkeypatch.setattr(backend_app, "audio_artifacts", arts)
+    monkeypatch.setattr(backend_app, "_lipsync_memo", type(backend_app._lipsync_memo)())
+    path = write_wav(tmp_path / "reply_a.wav", tone(0.2))
+    arts.register(path)
+
+    track = asyncio.run(backend_app.lipsync_for(path))
+    assert arts.variant(path.name, "lips") == path.with_suffix(".lips")
+    assert backend_app._lipsync_lookup("/audio/reply_a.wav") == track
+
+    calls = []
+    monkeypatch.setattr(backend_app, "_lipsync_track_blocking", lambda p: calls.append(p))
+    assert backend_app._lipsync_load_or_build(path) == track
+    assert calls == []
+
+
+def test_disabled_lipsync_returns_none(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend_app, "LIPSYNC_ENABLED", False)
+    assert asyncio.run(backend_app.lipsync_for(tmp_path / "reply_a.wav")) is None
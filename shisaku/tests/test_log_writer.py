@@ -0,0 +1,68 @@
+from backend.app import _LogWriter
+
+
+def make_writer(max_bytes=0, backups=2, queue_max=100):
+    return _LogWriter(max_bytes=max_bytes, backups=backups, flush_sec=0.01, queue_max=queue_max)
+
+
+def test_lines_are_written_in_order_by_a_background_thread(tmp_path):
+    w = make_writer()
+    a, b = tmp_path / "a.log", tmp_path / "sub" / "b.log"
+    for i in range(50):
+        w.write(a, f"a{i}\n")
+        w.write(b, f"b{i}\n")
+    assert w._thread is not None and w._thread.name == "log-writer"
+    w.close()
+    assert a.read_text(encoding="utf-8") == "".join(f"a{i}\n" for i in range(50))
+    assert b.read_text(encoding="utf-8") == "".join(f"b{i}\n" for i in range(50))
+    assert (w.written, w.dropped, w.pending()) == (100, 0, 0)
+    assert not w._thread.is_alive()
+
+
+def test_full_queue_drops_instead_of_blocking(tmp_path, monkeypatch):
+    w = make_writer(queue_max=2)
+    monkeypatch.setattr(w, "_start", lambda: None)  # 書き手を止めたまま積む
+    for i in range(5):
+        w.write(tmp_path / "a.log", f"{i}\n")
+    assert (w.pending(), w.dropped) == (2, 3)
+
+
+def test_writes_after_close_go_straight_to_disk(tmp_path):
+    w = make_writer()
+    w.close()
+    w.write(tmp_path / "late.log", "bye\n")
+    assert (tmp_path / "late.log").read_text(encoding="utf-8") == "bye\n"
+    assert w._thread is None
+
+
+def append_lines(w, path, n):
+    files = {}
+    for i in range(n):
+        w._append(files, path, f"{i:09d}\n")  # 1行10バイト
+    files[path].close()
+
+
+def test_rotation_keeps_the_configured_number_of_backups(tmp_path):
+    w = make_writer(max_bytes=25, backups=2)
+    path = tmp_path / "server.log"
+    append_lines(w, path, 7)
+    # 2行ずつで回り、一番古い 0, 1 行目は捨てられる
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["server.log", "server.log.1", "server.log.2"]
+    assert path.read_text(encoding="utf-8") == "000000006\n"
+    assert path.with_name("server.log.1").read_text(encoding="utf-8") == "000000004\n000000005\n"
+    assert path.with_name("server.log.2").read_text(encoding="utf-8") == "000000002\n000000003\n"
+
+
+def test_rotation_without_backups_starts_over(tmp_path):
+    w = make_writer(max_bytes=25, backups=0)
+    path = tmp_path / "server.log"
+    append_lines(w, path, 5)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["server.log"]
+    assert path.read_text(encoding="utf-8") == "000000004\n"
+
+
+def test_no_rotation_when_disabled(tmp_path):
+    w = make_writer(max_bytes=0)
+    path = tmp_path / "server.log"
+    append_lines(w, path, 10)
+    assert path.stat().st_size == 100
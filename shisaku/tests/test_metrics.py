@@ -0,0 +1,78 @@
+from fastapi.testclient import TestClient
+
+from backend import app as backend_app
+from backend.app import _LatencyStat, _Metrics
+
+
+def lines(m):
+    return m.render().splitlines()
+
+
+def test_summary_renders_quantiles_sum_and_count():
+    m = _Metrics()
+    for ms in (10.0, 20.0, 30.0, 40.0):
+        m.observe("stage_ms", ms, stage="tts")
+    m.observe("stage_ms", 5.0, ok=False, stage="tts")
+    assert lines(m) == [
+        "# TYPE vrm_talk_stage_ms summary",
+        'vrm_talk_stage_ms{stage="tts",quantile="0.5"} 20.0',
+        'vrm_talk_stage_ms{stage="tts",quantile="0.95"} 40.0',
+        'vrm_talk_stage_ms{stage="tts",quantile="0.99"} 40.0',
+        'vrm_talk_stage_ms_sum{stage="tts"} 105.0',
+        'vrm_talk_stage_ms_count{stage="tts"} 5',
+    ]
+
+
+def test_type_line_is_written_once_per_metric_and_labels_are_sorted():
+    m = _Metrics()
+    m.inc("fallbacks_total", kind="tts", engine="local")
+    m.inc("fallbacks_total", 2, kind="pose")
+    m.inc("fallbacks_total", kind="pose")
+    assert lines(m) == [
+        "# TYPE vrm_talk_fallbacks_total counter",
+        'vrm_talk_fallbacks_total{engine="local",kind="tts"} 1',
+        'vrm_talk_fallbacks_total{kind="pose"} 3',
+    ]
+
+
+def test_label_values_are_escaped():
+    m = _Metrics()
+    m.inc("errors_total", stage='a"b\\c\nd')
+    assert lines(m)[1] == 'vrm_talk_errors_total{stage="a\\"b\\\\c\\nd"} 1'
+
+
+def test_collectors_are_read_at_render_time_and_failures_are_skipped(monkeypatch):
+    monkeypatch.setattr(backend_app, "_log", lambda msg: None)
+    m = _Metrics()
+    depth = {"n": 1}
+
+    @m.collector
+    def broken():
+        raise RuntimeError("boom")
+
+    @m.collector
+    def gauges():
+        yield "queue_depth", "gauge", {"backend": "ollama"}, depth["n"]
+        yield "queue_depth", "gauge", {}, 0.5
+
+    assert lines(m) == [
+        "# TYPE vrm_talk_queue_depth gauge",
+        'vrm_talk_queue_depth{backend="ollama"} 1',
+        "vrm_talk_queue_depth 0.5",
+    ]
+    depth["n"] = 7
+    assert 'vrm_talk_queue_depth{backend="ollama"} 7' in lines(m)
+
+
+def test_latency_snapshot_of_an_empty_stat():
+    assert _LatencyStat().snapshot() == {
+        "count": 0, "errors": 0, "avg_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0,
+    }
+
+
+def test_metrics_endpoint_serves_prometheus_text():
+    resp = TestClient(backend_app.app).get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert resp.text.endswith("\n")
+    assert all(line.startswith(("# TYPE vrm_talk_", "vrm_talk_")) for line in resp.text.splitlines())
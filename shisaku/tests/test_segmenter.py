@@ -0,0 +1,160 @@
+import itertools
+import random
+
+import pytest
+
+from backend.app import _Segmenter
+
+
+def run(tokens, **kw):
+    sg = _Segmenter(**{"min_chars": 8, "max_chars": 80, "first_min_chars": 2, "first_clause_chars": 0, **kw})
+    out = []
+    for tok in tokens:
+        out += sg.feed(tok)
+    return out + sg.flush()
+
+
+def test_splits_at_sentence_end_and_keeps_trailing_marks():
+    # 最初の文は即出しなので、2文目以降で確かめる
+    text = "最初の文はここまでです。今日はとても楽しかったよ！？😊「そうなんだ」と言われた。明日もまた一緒に遊ぼうね！"
+    assert run([text]) == [
+        "最初の文はここまでです。", "今日はとても楽しかったよ！？😊", "「そうなんだ」と言われた。", "明日もまた一緒に遊ぼうね！",
+    ]
+
+
+def test_closing_bracket_stays_with_its_sentence():
+    assert run(["彼は「もう帰るよ。」", "と言って、そのまま家に帰りました。"]) == [
+        "彼は「もう帰るよ。」と言って、そのまま家に帰りました。"
+    ]
+
+
+def test_no_split_inside_brackets():
+    text = "最初の文はここまでです。「これは。括弧の中。です」と彼女は静かに言った。"
+    assert run([text]) == ["最初の文はここまでです。", "「これは。括弧の中。です」と彼女は静かに言った。"]
+
+
+@pytest.mark.parametrize("number", ["3.14", "1,000"])
+def test_no_split_inside_numbers(number):
+    text = f"最初の文はここまでです。円周率はだいたい{number}くらいだと覚えておいてね。"
+    assert run([text]) == ["最初の文はここまでです。", f"円周率はだいたい{number}くらいだと覚えておいてね。"]
+
+
+def test_short_sentences_are_merged():
+    text = "最初の文はここまでです。うん！そうだね。それで次はどうしようか。"
+    assert run([text]) == ["最初の文はここまでです。", "うん！そうだね。それで次はどうしようか。"]
+
+
+def test_max_chars_cuts_at_clause_mark():
+    text = "最初の文はここまでです。" + "あ" * 12 + "、" + "い" * 12 + "、" + "う" * 10 + "。"
+    out = run([text], max_chars=20)
+    assert out == ["最初の文はここまでです。", "あ" * 12 + "、", "い" * 12 + "、", "う" * 10 + "。"]
+
+
+def test_max_chars_does_not_emit_short_head():
+    text = "最初の文はここまでです。それから、" + "あ" * 30 + "、" + "い" * 10 + "。"
+    out = run([text], max_chars=20)
+    assert "それから、" not in out
+    assert out[1].startswith("それから、あ")
+    assert all(len(seg) >= 8 for seg in out)
+
+
+def test_max_chars_without_clause_cuts_in_place():
+    out = run(["最初の文はここまでです。" + "あ" * 45], max_chars=20)
+    assert out[1:] == ["あ" * 20, "あ" * 20, "あ" * 5]
+
+
+def test_first_chunk_is_emitted_eagerly():
+    sg = _Segmenter(min_chars=8, max_chars=80, first_min_chars=2, first_clause_chars=0)
+    assert sg.feed("はい") == []
+    # 最初の文は句点を見た時点で出る（続く ！ や次の文を待たない）
+    assert sg.feed("！") == ["はい！"]
+    assert sg.feed("！次の") == []
+    assert sg.flush() == ["次の"]
+
+
+def test_first_chunk_cut_at_clause_mark():
+    out = run(["こんにちは、今日はいい天気だね。散歩しよう。"], first_clause_chars=5)
+    assert out[0] == "こんにちは、"
+
+
+def first_chunk_at(tokens, **kw):
+    """最初の文が出たトークンの位置と、その文。"""
+    sg = _Segmenter(**kw)
+    for i, tok in enumerate(tokens):
+        segs = sg.feed(tok)
+        if segs:
+            return i, segs[0]
+    return None
+
+
+@pytest.mark.parametrize(
+    "tokens, expected",
+    [
+        (["うん", "！", "そう", "だね"], (1, "うん！")),
+        (["えっ", "と、", "今日", "はね"], (1, "えっと、")),
+        # 括弧の中でも、最初の1文は閉じ括弧を待たない
+        (["「それ", "、ほ", "んと？", "」って"], (1, "「それ、")),
+        # 最小の長さに届かない区切りでは切らない
+        (["ね", "！き", "っと", "楽し", "いよ。"], (4, "ね！きっと楽しいよ。")),
+    ],
+)
+def test_first_chunk_is_cut_at_the_first_boundary_that_clears_the_minimum(tokens, expected):
+    assert first_chunk_at(tokens) == expected
+
+
+def test_first_chunk_comes_no_later_than_the_legacy_splitter():
+    from backend import bench
+
+    def legacy_at(tokens):
+        buf = ""
+        for i, tok in enumerate(tokens):
+            segs, buf = bench._legacy_split(buf + tok)
+            if segs:
+                return i
+        return len(tokens)
+
+    corpus = bench._segmenter_corpus(300, 0)
+    ours = sorted((first_chunk_at(toks) or (len(toks),))[0] for toks in corpus)
+    legacy = sorted(legacy_at(toks) for toks in corpus)
+    assert ours[len(ours) // 2] <= legacy[len(legacy) // 2]
+
+
+def test_first_chunk_does_not_cut_decimal():
+    assert run(["3.14です。"]) == ["3.14です。"]
+
+
+def test_symbol_only_remainder_is_dropped():
+    assert run(["最初の文はここまでです。", "次の文もここまでです。", "😊！！…"]) == [
+        "最初の文はここまでです。", "次の文もここまでです。😊！！…",
+    ]
+    # 句点の後ろに記号だけが残った場合も、それだけの断片は出さない
+    assert run(["最初の文はここまでです。", "😊！！…"]) == ["最初の文はここまでです。"]
+    sg = _Segmenter(min_chars=8, max_chars=80, first_min_chars=2, first_clause_chars=0)
+    sg.feed("")
+    assert sg.feed("……😊") == []
+    assert sg.flush() == []
+
+
+CORPUS = (
+    "こんにちは！今日はいい天気だね。「散歩。しよう」と思うんだけど、どうかな？😊"
+    "円周率は3.14で、人口は1,000人くらい。うん！そうだね。"
+    + "ながいながい" * 20 + "、おわり。"
+)
+
+
+def test_output_is_independent_of_token_split():
+    expected = run([CORPUS])
+    assert run(list(CORPUS)) == expected
+    rng = random.Random(0)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(CORPUS)), rng.randint(1, 40)))
+        tokens = [CORPUS[a:b] for a, b in zip([0] + cuts, cuts + [len(CORPUS)])]
+        assert run(tokens) == expected
+
+
+def test_feed_scans_only_new_text():
+    sg = _Segmenter()
+    for ch in itertools.islice(itertools.cycle("あいうえお"), 5000):
+        sg.feed(ch)
+    # 返した部分は捨てているので、バッファは max_chars 程度に収まる
+    assert len(sg._buf) <= 2 * sg.max_chars
@@ -0,0 +1,89 @@
+import pytest
+
+from backend import app as backend_app
+from backend.app import DEFAULT_SESSION_ID, SessionStore, _session_id
+
+MAX_TURNS = backend_app.HISTORY_TURNS * 2
+
+
+def make_store(max_sessions=3, idle_sec=3600, snapshot_path=None):
+    return SessionStore(max_sessions=max_sessions, idle_sec=idle_sec, snapshot_path=snapshot_path)
+
+
+def age(store, sid, sec):
+    store._sessions[sid].last_seen -= sec
+
+
+def test_turns_keep_only_the_last_history_turns():
+    store = make_store()
+    for i in range(backend_app.HISTORY_TURNS + 3):
+        store.append("a", f"u{i}", f"r{i}")
+    turns = store.turns("a")
+    assert len(turns) == MAX_TURNS
+    assert turns[0] == ("user", "u3")
+    assert turns[-2:] == [("user", f"u{backend_app.HISTORY_TURNS + 2}"), ("assistant", f"r{backend_app.HISTORY_TURNS + 2}")]
+
+
+def test_sessions_do_not_share_history():
+    store = make_store()
+    store.append("a", "こんにちは", "やあ")
+    assert store.turns("b") == []
+    assert store.turns("a") == [("user", "こんにちは"), ("assistant", "やあ")]
+
+
+def test_least_recently_used_session_is_dropped_over_the_limit():
+    store = make_store(max_sessions=2)
+    store.append("a", "1", "1")
+    store.append("b", "2", "2")
+    store.turns("a")  # a を使ったので次に消えるのは b
+    store.append("c", "3", "3")
+    assert len(store) == 2
+    assert list(store._sessions) == ["a", "c"]
+    assert store.turns("b") == []
+
+
+def test_sweep_drops_idle_sessions():
+    store = make_store(idle_sec=60)
+    store.append("old", "1", "1")
+    store.append("new", "2", "2")
+    age(store, "old", 120)
+    assert store.sweep() == 1
+    assert list(store._sessions) == ["new"]
+
+
+def test_snapshot_round_trip_keeps_order_and_limit(tmp_path):
+    path = tmp_path / "sessions.json"
+    store = make_store(snapshot_path=path)
+    for sid in ("a", "b", "c"):
+        store.append(sid, f"u-{sid}", f"r-{sid}")
+    age(store, "b", 10)
+    store.save()
+
+    restored = make_store(max_sessions=2, snapshot_path=path)
+    restored.load()
+    # 古い b から詰めて、上限を超えた分（b）は落とす
+    assert list(restored._sessions) == ["a", "c"]
+    assert restored.turns("c") == [("user", "u-c"), ("assistant", "r-c")]
+
+
+def test_save_and_load_without_path_do_nothing(tmp_path):
+    store = make_store()
+    store.append("a", "1", "1")
+    store.save()
+    store.load()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "candidates, expected",
+    [
+        (("abc-DEF_123",), "abc-DEF_123"),
+        ((None, "  xyz  "), "xyz"),
+        (("bad id", "ok"), "ok"),
+        (("x" * 65,), DEFAULT_SESSION_ID),
+        (("../etc",), DEFAULT_SESSION_ID),
+        ((), DEFAULT_SESSION_ID),
+    ],
+)
+def test_session_id_validation(candidates, expected):
+    assert _session_id(*candidates) == expected
@@ -0,0 +1,135 @@
+import asyncio
+import sys
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from backend import app as backend_app  # noqa: E402
+from backend.app import _RedisBlobStore, _RedisSessionStore, _RedisState  # noqa: E402
+
+MAX_TURNS = backend_app.HISTORY_TURNS * 2
+
+
+@pytest.fixture
+def state():
+    s = _RedisState("redis://unused", "test:", timeout=1.0)
+    s._client = fakeredis.FakeRedis()
+    return s
+
+
+def make_store(state, max_sessions=3, idle_sec=3600):
+    return _RedisSessionStore(state, max_sessions=max_sessions, idle_sec=idle_sec)
+
+
+def indexed(state):
+    return sorted(m.decode() for m in state.client.zrange(state.key("sessions"), 0, -1))
+
+
+# --- _RedisState ---
+
+def test_keys_are_prefixed(state):
+    assert state.key("session", "abc") == "test:session:abc"
+
+
+def test_probe_reports_round_trip(state):
+    res = asyncio.run(state.probe())
+    assert res["backend"] == "redis" and res["rtt_ms"] >= 0
+
+
+def test_missing_redis_package_is_a_runtime_error(monkeypatch):
+    monkeypatch.setitem(sys.modules, "redis", None)
+    with pytest.raises(RuntimeError, match="pip install redis"):
+        _RedisState("redis://localhost:6379/0", "test:", timeout=1.0).client
+
+
+# --- _RedisSessionStore ---
+
+def test_turns_keep_only_the_last_history_turns(state):
+    store = make_store(state)
+    for i in range(backend_app.HISTORY_TURNS + 3):
+        store.append("a", f"u{i}", f"r{i}")
+    turns = store.turns("a")
+    assert len(turns) == MAX_TURNS
+    assert turns[0] == ("user", "u3")
+    assert turns[-1] == ("assistant", f"r{backend_app.HISTORY_TURNS + 2}")
+    assert 0 < state.client.ttl(state.key("session", "a")) <= 3600
+
+
+def test_reading_an_unknown_session_does_not_index_it(state):
+    store = make_store(state)
+    assert store.turns("ghost") == []
+    assert len(store) == 0
+
+
+def test_oldest_session_is_dropped_over_the_limit(state):
+    store = make_store(state, max_sessions=2)
+    for sid, ts in (("a", 1.0), ("b", 2.0)):
+        store.append(sid, "u", "r")
+        state.client.zadd(state.key("sessions"), {sid: ts})
+    store.append("c", "u", "r")
+    assert indexed(state) == ["b", "c"]
+    assert not state.client.exists(state.key("session", "a"))
+
+
+def test_reading_keeps_the_index_within_the_limit(state):
+    store = make_store(state, max_sessions=2)
+    for sid in ("a", "b", "c"):
+        store.append(sid, "u", "r")
+    # 追い出された a を何度読んでも索引には戻らず、上限も超えない
+    for sid in ("a", "x", "y", "a"):
+        assert store.turns(sid) == []
+    assert len(store) == 2
+    assert indexed(state) == ["b", "c"]
+
+
+def test_reading_refreshes_the_index(state):
+    store = make_store(state, max_sessions=2)
+    for sid, ts in (("a", 1.0), ("b", 2.0)):
+        store.append(sid, "u", "r")
+        state.client.zadd(state.key("sessions"), {sid: ts})
+    assert store.turns("a") == [("user", "u"), ("assistant", "r")]
+    store.append("c", "u", "r")
+    assert indexed(state) == ["a", "c"]
+
+
+def test_sweep_drops_idle_sessions(state):
+    store = make_store(state, idle_sec=60)
+    store.append("old", "u", "r")
+    store.append("new", "u", "r")
+    state.client.zadd(state.key("sessions"), {"old": 1.0})
+    assert store.sweep() == 1
+    assert indexed(state) == ["new"]
+    assert store.turns("old") == []
+
+
+# --- _RedisBlobStore ---
+
+def test_blob_round_trip(state, tmp_path):
+    blobs = _RedisBlobStore(state, ttl_sec=120)
+    src = tmp_path / "reply_a.wav"
+    src.write_bytes(b"RIFF....")
+    blobs.put(src)
+    assert 0 < state.client.ttl(state.key("blob", "reply_a.wav")) <= 120
+
+    dst = tmp_path / "other" / "reply_a.wav"
+    dst.parent.mkdir()
+    assert blobs.fetch("reply_a.wav", dst)
+    assert dst.read_bytes() == b"RIFF...."
+    assert [p.name for p in dst.parent.iterdir()] == ["reply_a.wav"]  # 書きかけの .part は残らない
+
+
+def test_missing_blob_is_not_fetched(state, tmp_path):
+    assert not _RedisBlobStore(state, ttl_sec=120).fetch("nope.wav", tmp_path / "nope.wav")
+    assert not (tmp_path / "nope.wav").exists()
+
+
+def test_blob_delete(state, tmp_path):
+    blobs = _RedisBlobStore(state, ttl_sec=120)
+    for name in ("a.wav", "b.wav"):
+        (tmp_path / name).write_bytes(b"x")
+        blobs.put(tmp_path / name)
+    blobs.delete(["a.wav"])
+    blobs.delete([])
+    assert not blobs.fetch("a.wav", tmp_path / "got_a.wav")
+    assert blobs.fetch("b.wav", tmp_path / "got_b.wav")
@@ -0,0 +1,127 @@
+import asyncio
+import subprocess
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend import app as backend_app
+from backend.app import SpeechNotRecognized, STTUnavailable, _FixedSTT, _STTBackend, _STTBatcher
+
+
+class RecordingSTT(_STTBackend):
+    """呼ばれたバッチを記録する。b"bad" は聞き取れなかった扱い。"""
+
+    name = "recording"
+    max_batch = 3
+    max_concurrency = 1
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.threads = set()
+
+    def transcribe_one(self, pcm):
+        if pcm == b"bad":
+            raise SpeechNotRecognized()
+        return pcm.decode()
+
+    def transcribe_batch(self, pcms):
+        self.calls.append(list(pcms))
+        self.threads.add(threading.current_thread().name)
+        return super().transcribe_batch(pcms)
+
+
+@pytest.fixture(autouse=True)
+def short_window(monkeypatch):
+    monkeypatch.setattr(backend_app, "STT_BATCH_WINDOW_MS", 20)
+
+
+def run(batcher, pcms):
+    async def main():
+        return await asyncio.gather(*(batcher.transcribe(p) for p in pcms), return_exceptions=True)
+    return asyncio.run(main())
+
+
+def test_concurrent_utterances_are_grouped_up_to_max_batch():
+    backend = RecordingSTT()
+    batcher = _STTBatcher(backend)
+    results = run(batcher, [b"a", b"b", b"c", b"d", b"e"])
+    assert results == ["a", "b", "c", "d", "e"]
+    assert backend.calls == [[b"a", b"b", b"c"], [b"d", b"e"]]
+    assert (batcher.batches, batcher.items) == (2, 5)
+    # 認識はイベントループではなくワーカースレッドで走る
+    assert threading.main_thread().name not in backend.threads
+
+
+def test_single_engine_without_batching_runs_one_per_call():
+    backend = RecordingSTT()
+    backend.max_batch = 1
+    batcher = _STTBatcher(backend)
+    assert run(batcher, [b"a", b"b"]) == ["a", "b"]
+    assert backend.calls == [[b"a"], [b"b"]]
+
+
+def test_errors_are_delivered_only_to_their_own_caller():
+    batcher = _STTBatcher(RecordingSTT())
+    ok, bad, ok2 = run(batcher, [b"x", b"bad", b"y"])
+    assert (ok, ok2) == ("x", "y")
+    assert isinstance(bad, SpeechNotRecognized)
+
+
+def test_backend_crash_fails_the_whole_batch():
+    class Broken(RecordingSTT):
+        def transcribe_batch(self, pcms):
+            raise STTUnavailable("model missing")
+
+    results = run(_STTBatcher(Broken()), [b"a", b"b"])
+    assert all(isinstance(r, STTUnavailable) for r in results)
+
+
+def test_fixed_backend_returns_the_configured_text(monkeypatch):
+    monkeypatch.setenv("STT_FIXED_TEXT", "テストです")
+    batcher = _STTBatcher(_FixedSTT())
+    assert run(batcher, [b"\x00\x01", b"\x02\x03"]) == ["テストです", "テストです"]
+
+
+def test_transcribe_pcm_uses_the_configured_engine(monkeypatch):
+    monkeypatch.setattr(backend_app, "STT_ENGINE", "fixed")
+    monkeypatch.setattr(backend_app, "_stt_batcher", None)
+    monkeypatch.setenv("STT_FIXED_TEXT", "固定")
+    assert asyncio.run(backend_app.transcribe_pcm(b"\x00\x01")) == "固定"
+    assert backend_app._stt().backend.name == "fixed"
+
+
+def test_empty_audio_or_text_is_not_recognized(monkeypatch):
+    monkeypatch.setattr(backend_app, "STT_ENGINE", "fixed")
+    monkeypatch.setattr(backend_app, "_stt_batcher", None)
+    with pytest.raises(SpeechNotRecognized):
+        asyncio.run(backend_app.transcribe_pcm(b""))
+    monkeypatch.setattr(backend_app, "_stt_batcher", None)
+    monkeypatch.setenv("STT_FIXED_TEXT", "  ")
+    with pytest.raises(SpeechNotRecognized):
+        asyncio.run(backend_app.transcribe_pcm(b"\x00\x01"))
+
+
+def hang(cmd, **kwargs):
+    raise subprocess.TimeoutExpired(cmd, kwargs["timeout"])
+
+
+def test_missing_ffmpeg_is_a_decode_error(monkeypatch):
+    monkeypatch.setattr(backend_app, "FFMPEG_BIN", "/nonexistent/ffmpeg")
+    with pytest.raises(RuntimeError, match="ffmpeg"):
+        backend_app._decode_to_pcm16(b"webm")
+
+
+def test_decode_timeout_is_a_decode_error(monkeypatch):
+    monkeypatch.setattr(backend_app.subprocess, "run", hang)
+    with pytest.raises(RuntimeError, match="30s"):
+        backend_app._decode_to_pcm16(b"webm")
+
+
+@pytest.mark.parametrize("target, value", [("FFMPEG_BIN", "/nonexistent/ffmpeg"), ("subprocess.run", hang)])
+def test_voice_upload_that_cannot_be_decoded_is_a_400(monkeypatch, target, value):
+    monkeypatch.setattr(f"backend.app.{target}", value)
+    resp = TestClient(backend_app.app).post("/api/voice", files={"file": ("a.webm", b"webm", "audio/webm")})
+    assert resp.status_code == 400
+    assert resp.json() == {"error": "音声を読み込めませんでした"}
@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from backend import app as backend_app  # noqa: E402
+from backend.app import _StyleClassifier, classify_tts  # noqa: E402
+
+CLASSES = [10, 20]
+PARAMS = [
+    [1.0, 1.0, 0.0, 1.0, 0.1, 0.5, 24000],
+    [1.2, 1.1, 0.1, 1.3, 0.1, 0.4, 48000],
+]
+
+
+def make_classifier(bias):
+    """W を 0 にして b だけで確率を決める（どの文でも同じ確信度になる）。"""
+    buckets = 64
+    return _StyleClassifier(
+        np.zeros((2, buckets)), np.asarray(bias, dtype=float), CLASSES, np.asarray(PARAMS, dtype=float),
+        {"n_max": 2, "buckets": buckets},
+    )
+
+
+@pytest.fixture
+def use_classifier(monkeypatch):
+    def install(clf, min_conf=0.75):
+        monkeypatch.setattr(backend_app, "director_classifier", lambda: clf)
+        monkeypatch.setattr(backend_app, "DIRECTOR_CLASSIFIER_MIN_CONF", min_conf)
+    return install
+
+
+def test_confident_prediction_returns_tts_params(use_classifier):
+    use_classifier(make_classifier([0.0, 3.0]))  # p ≈ 0.95
+    tts = classify_tts("やったー！")
+    assert tts["styleId"] == 20
+    assert tts["speedScale"] == 1.2 and tts["intonationScale"] == 1.3
+    assert tts["outputSamplingRate"] == 48000
+    assert "ローカル分類器" in tts["reason"]
+
+
+def test_unsure_prediction_escalates_to_the_llm(use_classifier):
+    use_classifier(make_classifier([0.0, 0.5]))  # p ≈ 0.62
+    assert classify_tts("うーん") is None
+
+
+def test_threshold_is_inclusive(use_classifier):
+    clf = make_classifier([0.0, 1.0])
+    _, conf, _ = clf.predict("a")
+    use_classifier(clf, min_conf=conf)
+    assert classify_tts("a") is not None
+    use_classifier(clf, min_conf=conf + 1e-6)
+    assert classify_tts("a") is None
+
+
+def test_no_model_or_empty_text_returns_none(use_classifier):
+    use_classifier(None)
+    assert classify_tts("こんにちは") is None
+    use_classifier(make_classifier([0.0, 5.0]))
+    assert classify_tts("") is None
+
+
+def test_params_are_clamped_to_the_allowed_range(use_classifier):
+    clf = make_classifier([0.0, 5.0])
+    clf.params = np.asarray([PARAMS[0], [9.0, 9.0, 9.0, 9.0, 9.0, 9.0, 36000]], dtype=float)
+    use_classifier(clf)
+    tts = classify_tts("x")
+    assert tts["speedScale"] == 1.4 and tts["pitchScale"] == 0.3
+    assert tts["outputSamplingRate"] == 48000
+
+
+def test_trained_model_separates_styles_and_round_trips(tmp_path, monkeypatch):
+    from backend.train_director import fit
+
+    happy = ["やったー！", "うれしい！", "最高だね！", "たのしい！", "わーい！"]
+    calm = ["そうですね。", "なるほど。", "わかりました。", "そうなんですね。", "承知しました。"]
+    samples = [(t, {"styleId": 20, **dict(zip(backend_app._TTS_PARAM_KEYS, PARAMS[1]))}) for t in happy]
+    samples += [(t, {"styleId": 10, **dict(zip(backend_app._TTS_PARAM_KEYS, PARAMS[0]))}) for t in calm]
+    clf = fit(samples, buckets=1 << 12, n_max=3, epochs=30, lr=0.5, l2=1e-4, seed=0)
+    assert clf.predict("うれしい！")[0] == 20
+    assert clf.predict("なるほど。")[0] == 10
+
+    path = tmp_path / "director_model.npz"
+    clf.save(path)
+    monkeypatch.setattr(backend_app, "DIRECTOR_CLASSIFIER_PATH", str(path))
+    monkeypatch.setattr(backend_app, "DIRECTOR_CLASSIFIER_ENABLED", True)
+    monkeypatch.setattr(backend_app, "_classifier", None)
+    monkeypatch.setattr(backend_app, "_classifier_mtime", 0.0)
+    loaded = backend_app.director_classifier()
+    assert loaded.classes == CLASSES
+    assert np.allclose(loaded.predict_proba("うれしい！"), clf.predict_proba("うれしい！"))
+    assert backend_app.director_classifier() is loaded  # 更新されていなければ読み直さない
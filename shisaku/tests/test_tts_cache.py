@@ -0,0 +1,183 @@
+import asyncio
+import time
+
+import pytest
+
+from backend import app as backend_app
+from backend.app import _AudioArtifacts, _TTSCache
+
+
+@pytest.fixture
+def artifacts(tmp_path, monkeypatch):
+    arts = _AudioArtifacts(tmp_path, ttl_sec=3600, max_bytes=10**9, protect_sec=0)
+    monkeypatch.setattr(backend_app, "audio_artifacts", arts)
+    return arts
+
+
+def make_cache(tmp_path, **kw):
+    opts = {"max_entries": 100, "max_bytes": 10**9, "max_age_sec": 3600}
+    opts.update(kw)
+    return _TTSCache(tmp_path, **opts)
+
+
+def age(cache, key, sec):
+    size, created = cache._index[key]
+    cache._index[key] = (size, created - sec)
+
+
+def test_store_then_lookup_hits(tmp_path, artifacts):
+    cache = make_cache(tmp_path)
+    path = cache.store("k1", b"RIFF1")
+    assert path.read_bytes() == b"RIFF1"
+    assert cache.lookup("k1") == path
+    assert cache.lookup("nope") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_ignores_dict_order():
+    assert _TTSCache.key_for({"a": 1, "b": "x"}) == _TTSCache.key_for({"b": "x", "a": 1})
+    assert _TTSCache.key_for({"a": 1}) != _TTSCache.key_for({"a": 2})
+
+
+def test_evicts_least_recently_used_over_entry_limit(tmp_path, artifacts):
+    cache = make_cache(tmp_path, max_entries=2)
+    a = cache.store("a", b"1")
+    cache.store("b", b"2")
+    assert cache.lookup("a") == a  # a を最近使ったものにする
+    cache.store("c", b"3")
+    assert cache.lookup("b") is None
+    assert not cache.path_for("b").exists()
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+    assert cache.evictions == 1
+
+
+def test_evicts_over_byte_limit(tmp_path, artifacts):
+    cache = make_cache(tmp_path, max_bytes=10)
+    cache.store("a", b"x" * 6)
+    cache.store("b", b"x" * 6)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 6
+    assert not cache.path_for("a").exists()
+
+
+def test_expired_entries_behind_the_lru_front_age_out(tmp_path, artifacts):
+    cache = make_cache(tmp_path, max_age_sec=60)
+    cache.store("old", b"1")
+    cache.store("fresh", b"2")
+    cache.lookup("old")  # LRU の並びは fresh, old … 作成の古い old が先頭の後ろに回る
+    age(cache, "old", 120)
+    cache.store("new", b"3")
+    assert "old" not in cache._index
+    assert not cache.path_for("old").exists()
+    assert cache.path_for("fresh").exists()
+
+
+def test_lookup_of_expired_entry_is_a_miss_and_leaves_the_file(tmp_path, artifacts):
+    cache = make_cache(tmp_path, max_age_sec=60)
+    path = cache.store("k", b"1")
+    age(cache, "k", 120)
+    assert cache.lookup("k") is None
+    # ファイルはイベントループ上では消さない（合成し直した store が上書きする）
+    assert path.exists()
+    cache.store("k", b"2")
+    assert cache.lookup("k") == path
+    assert path.read_bytes() == b"2"
+
+
+def test_eviction_keeps_pinned_and_protected_files(tmp_path, artifacts):
+    cache = make_cache(tmp_path, max_entries=1)
+    pinned = cache.store("pinned", b"1")
+    artifacts.pin(pinned.name)
+    cache.store("next", b"2")
+    assert "pinned" not in cache._index
+    assert pinned.exists()
+    assert artifacts.resolve(pinned.name) == pinned
+
+    artifacts.protect_sec = 300
+    protected = cache.path_for("next")
+    cache.store("last", b"3")
+    assert "next" not in cache._index
+    assert protected.exists()
+
+
+def test_contains_does_not_touch_stats_or_order(tmp_path, artifacts):
+    cache = make_cache(tmp_path)
+    cache.store("a", b"1")
+    cache.store("b", b"2")
+    assert cache.contains("a") and not cache.contains("zz")
+    assert list(cache._index) == ["a", "b"]
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_forget_after_sweep(tmp_path, artifacts):
+    cache = make_cache(tmp_path)
+    path = cache.store("k", b"1")
+    artifacts.discard(path.name)
+    cache.forget(path.name)
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
+
+
+def test_load_from_disk_restores_index(tmp_path, artifacts):
+    cache = make_cache(tmp_path)
+    cache.store("a", b"12")
+    cache.store("b", b"345")
+    reloaded = make_cache(tmp_path)
+    reloaded.load_from_disk()
+    assert reloaded.stats()["entries"] == 2
+    assert reloaded.stats()["bytes"] == 5
+
+
+def test_concurrent_requests_share_one_synthesis(tmp_path, artifacts, monkeypatch):
+    cache = make_cache(tmp_path)
+    monkeypatch.setattr(backend_app, "tts_cache", cache)
+    monkeypatch.setattr(backend_app, "RESOLVED_SPEAKER_UUID", "speaker")
+    monkeypatch.setattr(backend_app, "RESOLVED_STYLE_ID", 0)
+    monkeypatch.setattr(backend_app, "shared_state", None)
+    calls = []
+
+    async def fake_synthesize(payload):
+        calls.append(payload["text"])
+        await asyncio.sleep(0.05)
+        return b"RIFF" + payload["text"].encode()
+
+    monkeypatch.setattr(backend_app, "_coeiroink_synthesize", fake_synthesize)
+
+    async def main():
+        same = await asyncio.gather(*(backend_app.coeiroink_tts("こんにちは", 0) for _ in range(5)))
+        other = await backend_app.coeiroink_tts("さようなら", 0)
+        again = await backend_app.coeiroink_tts("こんにちは", 0)
+        return same, other, again
+
+    same, other, again = asyncio.run(main())
+    assert calls == ["こんにちは", "さようなら"]
+    assert len(set(same)) == 1 and again == same[0] and other != same[0]
+    assert cache.coalesced == 4
+    assert cache.hits == 1
+    assert backend_app._tts_inflight == {}
+
+
+def test_failed_synthesis_is_not_cached(tmp_path, artifacts, monkeypatch):
+    cache = make_cache(tmp_path)
+    monkeypatch.setattr(backend_app, "tts_cache", cache)
+    monkeypatch.setattr(backend_app, "RESOLVED_SPEAKER_UUID", "speaker")
+    monkeypatch.setattr(backend_app, "RESOLVED_STYLE_ID", 0)
+    monkeypatch.setattr(backend_app, "shared_state", None)
+    attempts = []
+
+    async def flaky(payload):
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            raise RuntimeError("boom")
+        return b"RIFF"
+
+    monkeypatch.setattr(backend_app, "_coeiroink_synthesize", flaky)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await backend_app.coeiroink_tts("もう一度", 0)
+        return await backend_app.coeiroink_tts("もう一度", 0)
+
+    path = asyncio.run(main())
+    assert path.read_bytes() == b"RIFF"
+    assert len(attempts) == 2
@@ -0,0 +1,130 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from backend import app as backend_app
+from backend.app import AdmissionRejected, _TTSPipeline
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    monkeypatch.setattr(backend_app, "TTS_SEGMENT_RETRY_DELAY_SEC", 0.0)
+    monkeypatch.setattr(backend_app, "TTS_SEGMENT_RETRIES", 1)
+
+    async def no_lipsync(path):
+        return None
+
+    monkeypatch.setattr(backend_app, "lipsync_for", no_lipsync)
+
+
+def run_pipeline(monkeypatch, synth, texts):
+    monkeypatch.setattr(backend_app, "coeiroink_tts", synth)
+    results = []
+
+    async def params():
+        return 0, None
+
+    async def main():
+        pipeline = _TTSPipeline(params=params, engine_label="test", on_result=results.append)
+        for text in texts:
+            await pipeline.submit(text)
+        await pipeline.close()
+
+    asyncio.run(main())
+    return results
+
+
+def test_results_arrive_in_submit_order(monkeypatch):
+    async def synth(text, style_id, tts_overrides=None):
+        await asyncio.sleep(0.03 if text == "一" else 0.0)
+        return Path(f"/tmp/{text}.wav")
+
+    results = run_pipeline(monkeypatch, synth, ["一", "二", "三"])
+    assert [r.text for r in results] == ["一", "二", "三"]
+    assert all(r.path is not None for r in results)
+
+
+def test_failed_segment_is_retried(monkeypatch):
+    attempts = {}
+
+    async def synth(text, style_id, tts_overrides=None):
+        attempts[text] = attempts.get(text, 0) + 1
+        if text == "二" and attempts[text] == 1:
+            raise RuntimeError("/v1/synthesis 失敗: HTTP 500")
+        return Path(f"/tmp/{text}.wav")
+
+    results = run_pipeline(monkeypatch, synth, ["一", "二", "三"])
+    assert [r.path.name for r in results] == ["一.wav", "二.wav", "三.wav"]
+    assert results[1].error is None
+    assert attempts == {"一": 1, "二": 2, "三": 1}
+
+
+def test_segment_that_keeps_failing_is_reported(monkeypatch):
+    attempts = []
+
+    async def synth(text, style_id, tts_overrides=None):
+        attempts.append(text)
+        raise RuntimeError("down")
+
+    results = run_pipeline(monkeypatch, synth, ["一"])
+    assert len(attempts) == 2
+    assert results[0].path is None and results[0].error == "down"
+
+
+def test_admission_rejection_is_not_retried(monkeypatch):
+    attempts = []
+
+    async def synth(text, style_id, tts_overrides=None):
+        attempts.append(text)
+        raise AdmissionRejected("coeiroink", "queue_full", 503, 1)
+
+    results = run_pipeline(monkeypatch, synth, ["一"])
+    assert attempts == ["一"]
+    assert results[0].path is None
+
+
+def test_streaming_reply_reports_missing_segments(monkeypatch):
+    monkeypatch.setattr(backend_app, "TTS_SEGMENT_RETRIES", 0)
+
+    async def synth(text, style_id, tts_overrides=None):
+        if "二" in text:
+            raise RuntimeError("down")
+        return Path(f"/tmp/{text[0]}.wav")
+
+    monkeypatch.setattr(backend_app, "coeiroink_tts", synth)
+    monkeypatch.setattr(backend_app, "_local_chat_request", lambda *a, **kw: ("http://ollama.invalid", {}))
+    monkeypatch.setattr(backend_app, "_append_chat_history", lambda *a, **kw: None)
+    monkeypatch.setattr(backend_app.sessions, "append", lambda *a, **kw: None)
+
+    SENTENCES = ["一つ目の文です。", "二つ目の文はまとめられない長さにしておきます。", "三つ目の文もまとめられない長さにしておきます。"]
+
+    class FakeResponse:
+        def raise_for_status(self):
+            pass
+
+        async def aiter_lines(self):
+            for token in SENTENCES:
+                yield '{"message": {"content": "%s"}}' % token
+            yield '{"done": true}'
+
+    class FakeStream:
+        async def __aenter__(self):
+            return FakeResponse()
+
+        async def __aexit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(backend_app, "_http_stream", lambda *a, **kw: FakeStream())
+    segments, errors = [], []
+
+    async def main():
+        return await backend_app.local_reply_ollama_stream(
+            "こんにちは", tts_style_id=0, on_segment=segments.append, on_segment_error=errors.append,
+        )
+
+    text, audio = asyncio.run(main())
+    assert text == "".join(SENTENCES)
+    assert audio == ["/audio/一.wav", "/audio/三.wav"]
+    assert [s["index"] for s in segments] == [0, 1]
+    assert errors == [{"index": 1, "text": SENTENCES[1], "error": "down"}]
@@ -0,0 +1,96 @@
+from array import array
+
+import pytest
+
+from backend import app as backend_app
+from backend.app import _EnergyVAD
+
+FRAME_SAMPLES = backend_app.STT_SAMPLE_RATE * backend_app.VAD_FRAME_MS // 1000
+
+
+@pytest.fixture(autouse=True)
+def vad_settings(monkeypatch):
+    # 1フレーム 20ms: 3フレームで開始、5フレームの無音で終了、先頭に最大4フレーム付ける
+    monkeypatch.setattr(backend_app, "VAD_THRESHOLD", 500.0)
+    monkeypatch.setattr(backend_app, "VAD_START_MS", 60)
+    monkeypatch.setattr(backend_app, "VAD_SILENCE_MS", 100)
+    monkeypatch.setattr(backend_app, "VAD_PREROLL_MS", 80)
+    monkeypatch.setattr(backend_app, "VAD_MAX_UTTERANCE_SEC", 10)
+
+
+def frames(n, amp):
+    """振幅 amp の矩形波（RMS = amp）を n フレーム分。"""
+    one = array("h", [amp if i % 2 else -amp for i in range(FRAME_SAMPLES)]).tobytes()
+    return one * n
+
+
+def kinds(events):
+    return [k for k, _ in events]
+
+
+def test_silence_never_starts():
+    vad = _EnergyVAD()
+    assert vad.push(frames(50, 100)) == []
+    assert not vad.in_speech
+
+
+def test_start_needs_consecutive_voiced_frames():
+    vad = _EnergyVAD()
+    assert vad.push(frames(2, 1000) + frames(1, 0) + frames(2, 1000)) == []
+    events = vad.push(frames(1, 1000))
+    assert kinds(events) == ["start"]
+    assert vad.in_speech
+
+
+def test_start_carries_the_preroll():
+    vad = _EnergyVAD()
+    events = vad.push(frames(5, 0) + frames(3, 1000))
+    assert kinds(events) == ["start"]
+    # 先頭に付くのは VAD_PREROLL_MS 分（4フレーム）だけ
+    assert events[0][1] == frames(1, 0) + frames(3, 1000)
+
+
+def test_threshold_is_inclusive():
+    vad = _EnergyVAD()
+    assert kinds(vad.push(frames(3, 500))) == ["start"]
+    vad = _EnergyVAD()
+    assert vad.push(frames(3, 499)) == []
+
+
+def test_end_after_enough_silence_and_short_pauses_are_kept():
+    vad = _EnergyVAD()
+    vad.push(frames(3, 1000))
+    # 4フレーム（80ms）の間は発話が続く
+    events = vad.push(frames(4, 0) + frames(2, 1000))
+    assert kinds(events) == ["audio"] * 6
+    events = vad.push(frames(5, 0))
+    assert kinds(events) == ["audio"] * 5 + ["end"]
+    assert not vad.in_speech
+
+
+def test_max_utterance_forces_end(monkeypatch):
+    monkeypatch.setattr(backend_app, "VAD_MAX_UTTERANCE_SEC", 0.2)  # 先頭の3フレームを含めて10フレーム
+    vad = _EnergyVAD()
+    events = vad.push(frames(3, 1000))
+    events += vad.push(frames(7, 1000))
+    assert kinds(events) == ["start"] + ["audio"] * 7 + ["end"]
+    # 終わった直後も声が続いていれば次の発話として始まり直す
+    assert kinds(vad.push(frames(3, 1000))) == ["start"]
+
+
+def test_partial_frames_are_buffered():
+    vad = _EnergyVAD()
+    data = frames(3, 1000)
+    out = []
+    for i in range(0, len(data), 7):
+        out += vad.push(data[i:i + 7])
+    assert kinds(out) == ["start"]
+    assert out[0][1] == data
+
+
+def test_end_resets_state():
+    vad = _EnergyVAD()
+    vad.push(frames(3, 1000))
+    assert vad.end() == ("end", b"")
+    assert not vad.in_speech
+    assert vad.push(frames(2, 1000)) == []